@@ -1,10 +1,99 @@
-from flask import Flask, request, send_file, jsonify
-from rembg import remove
+from flask import Flask, current_app, request, send_file, jsonify
+from PIL import Image
 import numpy as np
 import cv2
+import os
 from io import BytesIO
+from guided_filter import guided_upsample
+from image_io import decode_image, encode_image, to_8bit
+from metrics import timed
+from model_registry import registry
+
+# rembg model used when none is given, e.g. u2net, u2netp, isnet-general-use
+DEFAULT_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+# Longest side the segmentation model is shown; masks are refined back to full size
+WORKING_SIZE = int(os.environ.get('REMBG_WORKING_SIZE', 1024))
+# Images per session call in BackgroundRemoval.masks
+BATCH_SIZE = int(os.environ.get('REMBG_BATCH_SIZE', 4))
+# Models whose ONNX graph takes a batch dimension, with rembg's input normalization
+BATCH_INPUTS = {
+    name: ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320))
+    for name in ('u2net', 'u2netp', 'u2net_human_seg', 'silueta')
+}
+
+
+def _new_session(model):
+    # rembg pulls in onnxruntime, so it is imported with the first session
+    from rembg import new_session
+    return new_session(model)
+
+
+def session_pool(model=None):
+    """Registry pool of rembg sessions for ``model``, registered on first use.
+
+    The default model is registered as 'background_removal' (so
+    PRELOAD_MODELS=background_removal loads it), others as
+    'background_removal:<model>'.
+    """
+    model = model or DEFAULT_MODEL
+    name = 'background_removal' if model == DEFAULT_MODEL else f'background_removal:{model}'
+    return registry.register(name, lambda: _new_session(model),
+                             pool_size=int(os.environ.get('REMBG_POOL_SIZE', 1)))
+
+
+session_pool()
+
+
+def _working_copy(img):
+    """RGB copy of ``img`` no larger than WORKING_SIZE on its longest side"""
+    height, width = img.shape[:2]
+    scale = WORKING_SIZE / max(height, width)
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    # Convert only the small copy
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def _gray(img, order='BGR'):
+    if img.ndim == 2:
+        return img
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY if order == 'RGB' else cv2.COLOR_BGR2GRAY)
+
+
+def _predict(session, model, smalls):
+    """Masks for working-size RGB images, in one ONNX run when the model allows it"""
+    inner = getattr(session, 'inner_session', None)
+    if len(smalls) > 1 and model in BATCH_INPUTS and inner is not None:
+        model_input = inner.get_inputs()[0]
+        if not isinstance(model_input.shape[0], int):
+            mean, std, size = BATCH_INPUTS[model]
+            batch = np.concatenate([session.normalize(Image.fromarray(small), mean, std, size)[model_input.name]
+                                    for small in smalls])
+            predictions = inner.run(None, {model_input.name: batch})[0][:, 0]
+            masks = []
+            for prediction, small in zip(predictions, smalls):
+                # Same per-image min/max scaling as rembg's predict()
+                low, high = prediction.min(), prediction.max()
+                prediction = (prediction - low) / max(high - low, 1e-8)
+                mask = (prediction * 255).astype(np.uint8)
+                masks.append(cv2.resize(mask, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_LINEAR))
+            return masks
+    return [np.asarray(session.predict(Image.fromarray(small))[0]) for small in smalls]
+
+
+def _refine(img, small, mask):
+    """Upsample a working-size mask to the size of ``img`` along the image's own edges"""
+    if mask.shape == img.shape[:2]:
+        return mask
+    return guided_upsample(_gray(img), _gray(small, 'RGB'), mask, radius=2, eps=64.0)
 
-app = Flask(__name__)
 
 class BackgroundRemoval:
     def __init__(self, file):
@@ -12,41 +101,63 @@ class BackgroundRemoval:
 
     def convert(self):
         try:
-            self.file.seek(0)
-            file_bytes = np.frombuffer(self.file.read(), np.uint8)
-            input_image = cv2.imdecode(file_bytes, cv2.IMREAD_UNCHANGED)
-            
-            if input_image is None:
-                raise ValueError("Invalid image file")
-                
-            # Check for grayscale/single channel images
-            if len(input_image.shape) < 3:
-                input_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2RGB)
-            elif input_image.shape[2] == 1:
-                input_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2RGB)
-            elif input_image.shape[2] == 3:
-                input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)
-            elif input_image.shape[2] == 4:
-                input_image = cv2.cvtColor(input_image, cv2.COLOR_BGRA2RGBA)
-            
-            output_image = remove(input_image)
-            
-            # Convert back for OpenCV
-            if output_image.shape[2] == 4:
-                output_image = cv2.cvtColor(output_image, cv2.COLOR_RGBA2BGRA)
-            else:
-                output_image = cv2.cvtColor(output_image, cv2.COLOR_RGB2BGR)
-            
-            success, buffer = cv2.imencode('.png', output_image)
-            if not success:
-                raise ValueError("Image encoding failed")
-                
-            return BytesIO(buffer)
+            try:
+                input_image = decode_image(self.file, cv2.IMREAD_UNCHANGED)
+            except ValueError:
+                raise ValueError("Invalid image file") from None
+
+            return BytesIO(encode_image(self.apply(input_image), '.png'))
             
         finally:
             self.file.close()
 
-@app.route('/remove-bg', methods=['POST'])
+    @staticmethod
+    def masks(images, model=None):
+        """Full-size uint8 alpha masks for decoded images.
+
+        Images are segmented at WORKING_SIZE, BATCH_SIZE per session call,
+        and each mask is guide-upsampled back to its image's size.
+        """
+        model = model or DEFAULT_MODEL
+        images = [to_8bit(img) for img in images]
+        results = []
+        for start in range(0, len(images), BATCH_SIZE):
+            chunk = images[start:start + BATCH_SIZE]
+            smalls = [_working_copy(img) for img in chunk]
+            with session_pool(model).acquire() as session, timed('background_removal', 'segment'):
+                low_masks = _predict(session, model, smalls)
+            for img, small, mask in zip(chunk, smalls, low_masks):
+                with timed('background_removal', 'refine', img):
+                    results.append(_refine(img, small, mask))
+        return results
+
+    @staticmethod
+    def mask(input_image, model=None):
+        """Alpha mask (uint8, same size) separating the foreground of a decoded image"""
+        return BackgroundRemoval.masks([input_image], model)[0]
+
+    @staticmethod
+    def composite(input_image, mask):
+        """BGRA cutout of a decoded image; an existing alpha channel is kept where it is lower"""
+        if mask.shape != input_image.shape[:2]:
+            raise ValueError("Mask size does not match the image")
+        input_image = to_8bit(input_image)
+        if input_image.ndim == 2:
+            output_image = cv2.cvtColor(input_image, cv2.COLOR_GRAY2BGRA)
+        elif input_image.shape[2] == 3:
+            output_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2BGRA)
+        else:
+            output_image = input_image.copy()
+            mask = cv2.min(mask, input_image[:, :, 3])
+        output_image[:, :, 3] = mask
+        return output_image
+
+    @staticmethod
+    def apply(input_image, model=None):
+        """Remove the background of a decoded image; returns BGRA"""
+        return BackgroundRemoval.composite(input_image, BackgroundRemoval.mask(input_image, model))
+
+# Handlers of the standalone server, see create_app()
 def remove_bg():
     if 'image' not in request.files:
         return jsonify({'error': 'No image uploaded'}), 400
@@ -68,8 +179,29 @@ def remove_bg():
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
-        app.logger.error(f"Processing error: {str(e)}")
+        current_app.logger.error(f"Processing error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def remove_bg_mask():
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    file = request.files['image']
+    try:
+        mask = BackgroundRemoval.mask(decode_image(file, cv2.IMREAD_UNCHANGED))
+        return send_file(BytesIO(encode_image(mask, '.png')), mimetype='image/png')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Processing error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def create_app():
+    """A Flask app serving only background removal; run.py serves these routes too"""
+    app = Flask(__name__)
+    app.add_url_rule('/remove-bg', view_func=remove_bg, methods=['POST'])
+    app.add_url_rule('/remove-bg/mask', view_func=remove_bg_mask, methods=['POST'])
+    return app
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
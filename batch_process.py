@@ -0,0 +1,328 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from result_cache import make_key
+
+# Files picked up from input directories
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.avif'}
+MANIFEST_NAME = '.batch_manifest.jsonl'
+
+
+def _glob_root(pattern):
+    """Leading directories of ``pattern`` before its first wildcard"""
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or '.'
+
+
+def collect_inputs(patterns):
+    """Expand files, directories (recursively) and glob patterns into
+    sorted (path, relative output name) pairs"""
+    found = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in files:
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        path = os.path.join(root, name)
+                        found[path] = os.path.relpath(path, pattern)
+        elif glob.has_magic(pattern):
+            root = _glob_root(pattern)
+            for path in glob.glob(pattern, recursive=True):
+                if os.path.isfile(path):
+                    found[path] = os.path.relpath(path, root)
+        elif os.path.isfile(pattern):
+            found[pattern] = os.path.basename(pattern)
+        else:
+            raise FileNotFoundError(f"No such file or directory: {pattern}")
+    return sorted(found.items(), key=lambda item: item[1])
+
+
+def batch_key(data, stages, output, quality):
+    """Manifest key of one file: its content hash plus every stage setting"""
+    params = {f'{index}.{name}.{key}': value
+              for index, (name, stage_params) in enumerate(stages)
+              for key, value in stage_params.items()}
+    params.update(output=output, quality=quality)
+    return make_key(data, '+'.join(name for name, _ in stages), params)
+
+
+class Manifest:
+    """Append-only JSON-lines record of finished files, so an interrupted
+    batch can be resumed. A truncated last line (from a crash) is ignored."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'error' not in record:
+                        self.done[record['key'], record['output']] = record
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, key, output_path):
+        # Identical files are done once per output path
+        return (key, output_path) in self.done and os.path.exists(output_path)
+
+    def add(self, record):
+        # One line per file, flushed at once so a crash loses nothing finished
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        if 'error' not in record:
+            self.done[record['key'], record['output']] = record
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """Single-line progress bar with throughput and ETA (on stderr)"""
+
+    def __init__(self, total, stream=sys.stderr, width=30, interval=0.2):
+        self.total = total
+        self.stream = stream
+        self.width = width
+        self.interval = interval
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.start = time.monotonic()
+        self._shown = 0.0
+
+    def update(self, skipped=False, failed=False, bytes_in=0, force=False):
+        self.done += 1
+        self.skipped += skipped
+        self.failed += failed
+        self.bytes_in += 0 if skipped else bytes_in
+        self.show(force)
+
+    def rates(self):
+        """(images per second, input MB per second) of the files processed so far"""
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (self.done - self.skipped) / elapsed, self.bytes_in / elapsed / 1e6
+
+    def show(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._shown < self.interval and self.done < self.total:
+            return
+        self._shown = now
+        filled = self.width * self.done // max(self.total, 1)
+        per_second, mb_per_second = self.rates()
+        remaining = self.total - self.done
+        eta = f"{remaining / per_second:.0f}s" if per_second > 0 else '?'
+        self.stream.write(f"\r[{'#' * filled}{'.' * (self.width - filled)}] {self.done}/{self.total} "
+                          f"{per_second:.1f} img/s {mb_per_second:.1f} MB/s eta {eta} "
+                          f"({self.skipped} skipped, {self.failed} failed) ")
+        self.stream.flush()
+
+
+def _init_worker(names, single_threaded):
+    # Import the effects once per worker process
+    import cv2
+    import tiling
+    from effect_pipeline import load_stages
+    load_stages(names)
+    if single_threaded:
+        # The processes already use every core; OpenCV's own threads, or a
+        # thread per core for the tiles of large images, would oversubscribe them
+        cv2.setNumThreads(1)
+        tiling.TILE_WORKERS = 1
+
+
+def _render_file(stages, output, quality, data, output_path):
+    """Decode, apply the stages, encode and write one file (in a worker process)"""
+    from effect_pipeline import Pipeline
+    start = time.perf_counter()
+    result = Pipeline(stages, output=output, quality=quality).render(data)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    # Written under a temporary name first, so a crash never leaves a partial output behind
+    temp_path = output_path + '.part'
+    with open(temp_path, 'wb') as f:
+        f.write(result)
+    os.replace(temp_path, output_path)
+    return len(result), time.perf_counter() - start
+
+
+def _load(path, stages, output, quality):
+    # In a prefetch thread: hashing releases the GIL like the read itself
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data, batch_key(data, stages, output, quality)
+
+
+def run_batch(inputs, output_dir, stages, output='.png', quality=None, workers=None, prefetch=None,
+              manifest_path=None, progress=True):
+    """Apply ``stages`` to every file of ``inputs`` (see collect_inputs), writing
+    results under ``output_dir`` with the same relative paths.
+
+    Files are read and hashed by ``prefetch`` threads ahead of a pool of
+    ``workers`` processes (default one per CPU; 0 renders in this process). Files whose content
+    and settings are already in the manifest, and whose output still
+    exists, are skipped. Returns a summary dict.
+    """
+    from effect_pipeline import Pipeline
+    # Validates the stage names and settings before anything runs
+    output = Pipeline(stages, output=output, quality=quality).output
+    if workers is None:
+        # A single worker process would only add pickling to one core's work
+        workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+    prefetch = prefetch or 2 * max(workers, 1)
+
+    jobs = []
+    targets = {}
+    for path, relative in inputs:
+        output_path = os.path.join(output_dir, os.path.splitext(relative)[0] + output)
+        if output_path in targets:
+            raise ValueError(f"{path} and {targets[output_path]} would both be written to {output_path}")
+        targets[output_path] = path
+        jobs.append((path, output_path))
+    manifest = Manifest(manifest_path or os.path.join(output_dir, MANIFEST_NAME))
+
+    bar = Progress(len(jobs)) if progress else None
+    summary = {'total': len(jobs), 'processed': 0, 'skipped': 0, 'failed': [], 'bytes_out': 0}
+    start = time.monotonic()
+
+    def finish(path, output_path, key, size, outcome):
+        if isinstance(outcome, Exception):
+            manifest.add({'key': key, 'input': path, 'output': output_path, 'error': str(outcome)})
+            summary['failed'].append((path, str(outcome)))
+        else:
+            bytes_out, seconds = outcome
+            manifest.add({'key': key, 'input': path, 'output': output_path, 'bytes': bytes_out,
+                          'ms': round(seconds * 1000, 1)})
+            summary['processed'] += 1
+            summary['bytes_out'] += bytes_out
+        if bar:
+            bar.update(failed=isinstance(outcome, Exception), bytes_in=size)
+
+    from edit_ops import EDIT_OPS
+    names = sorted({name for name, _ in stages} - {'compression'} - set(EDIT_OPS))
+    pool = None
+    if workers > 0:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(names, workers > 1))
+    try:
+        with ThreadPoolExecutor(max_workers=min(prefetch, 8), thread_name_prefix='batch-read') as readers:
+            pending = deque()
+            queued = iter(jobs)
+            running = {}
+
+            def top_up():
+                for path, output_path in queued:
+                    pending.append((path, output_path, readers.submit(_load, path, stages, output, quality)))
+                    if len(pending) >= prefetch:
+                        break
+
+            top_up()
+            while pending or running:
+                # Keep the pool fed while at most 2 files per worker wait in it
+                while pending and len(running) < 2 * max(workers, 1):
+                    path, output_path, read = pending.popleft()
+                    top_up()
+                    try:
+                        data, key = read.result()
+                    except OSError as e:
+                        finish(path, output_path, None, 0, e)
+                        continue
+                    if manifest.is_done(key, output_path):
+                        summary['skipped'] += 1
+                        if bar:
+                            bar.update(skipped=True)
+                        continue
+                    if pool is None:
+                        try:
+                            outcome = _render_file(stages, output, quality, data, output_path)
+                        except Exception as e:
+                            outcome = e
+                        finish(path, output_path, key, len(data), outcome)
+                        continue
+                    future = pool.submit(_render_file, stages, output, quality, data, output_path)
+                    running[future] = (path, output_path, key, len(data))
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path, output_path, key, size = running.pop(future)
+                        error = future.exception()
+                        finish(path, output_path, key, size, error if error else future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        manifest.close()
+        if bar:
+            bar.show(force=True)
+            bar.stream.write('\n')
+
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    summary['manifest'] = manifest.path
+    return summary
+
+
+def print_summary(summary, output_dir):
+    seconds = max(summary['seconds'], 1e-9)
+    print(f"[Success] {summary['processed']} images written to {output_dir} in {summary['seconds']:.1f}s "
+          f"({summary['processed'] / seconds:.1f} img/s), {summary['skipped']} already done")
+    for path, error in summary['failed']:
+        print(f"[Error] {path}: {error}")
+
+
+def add_batch_arguments(parser):
+    """Options shared by the batch mode of the effect CLIs"""
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: CPU count; 0 runs in this process).")
+    parser.add_argument("--prefetch", type=int, default=None,
+                        help="Files read ahead of the workers (default: 2 per worker).")
+    parser.add_argument("--manifest", default=None,
+                        help=f"Resume manifest (default: OUTPUT/{MANIFEST_NAME}).")
+    parser.add_argument("--no-progress", action="store_true", help="Do not show the progress bar.")
+
+
+def is_batch(inputs, output):
+    """Whether CLI arguments ask for batch mode: several inputs, a directory or a glob pattern"""
+    return (len(inputs) > 1 or os.path.isdir(output)
+            or any(os.path.isdir(path) or glob.has_magic(path) for path in inputs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply an effect pipeline to many images in parallel.")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns (quote them)")
+    parser.add_argument("output", help="Output directory (input directory structure is kept)")
+    parser.add_argument("--effects", required=True,
+                        help='Pipeline stages, e.g. "enhancer,cartoon:quality=fast,compression:quality=80"')
+    parser.add_argument("--format", default=".png", help="Output format (.png, .jpg, .webp, .avif).")
+    parser.add_argument("--quality", type=int, default=None, help="JPEG/WebP/AVIF quality.")
+    add_batch_arguments(parser)
+    args = parser.parse_args()
+
+    from effect_pipeline import parse_stages
+    try:
+        stages = parse_stages(args.effects)
+        inputs = collect_inputs(args.inputs)
+        summary = run_batch(inputs, args.output, stages, output=args.format, quality=args.quality,
+                            workers=args.workers, prefetch=args.prefetch, manifest_path=args.manifest,
+                            progress=not args.no_progress)
+    except (ValueError, FileNotFoundError) as e:
+        print(f"[Error] {e}")
+        sys.exit(1)
+    print_summary(summary, args.output)
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Speed versus quality of the Cartoon quality modes.
+
+Run from the repository root:
+
+    python -m benchmarks.cartoon_quality --megapixels 2 12
+    python -m benchmarks.cartoon_quality --images photo1.jpg photo2.jpg
+
+Every mode is timed on the same input and compared with the 'full' result
+(PSNR in dB and SSIM; 'full' itself is the reference).
+"""
+import argparse
+import time
+
+import cv2
+
+from benchmarks.image_quality import psnr, ssim
+from benchmarks.pencil_sketch import synthetic_image
+from img2Cartoon import QUALITY_MODES, Cartoon
+
+
+def run(image, repeat=1):
+    results = {}
+    reference = None
+    for quality in ["full"] + [q for q in QUALITY_MODES if q != "full"]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = Cartoon.apply(image, quality=quality)
+            best = min(best, time.perf_counter() - start)
+        if reference is None:
+            reference = output
+        results[quality] = {
+            "seconds": best,
+            "psnr": psnr(output, reference),
+            "ssim": ssim(output, reference),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Cartoon quality modes.")
+    parser.add_argument("--megapixels", type=float, nargs="*", default=[2])
+    parser.add_argument("--images", nargs="*", default=[], help="Photos to test in addition to synthetic input")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    inputs = [(f"synthetic {mp:g} MP", synthetic_image(mp)) for mp in args.megapixels]
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise SystemExit(f"Could not read {path}")
+        inputs.append((path, image))
+
+    print(f"{'input':<40} {'quality':<9} {'time':>8} {'speedup':>7} {'PSNR':>7} {'SSIM':>6}")
+    for name, image in inputs:
+        results = run(image, args.repeat)
+        full_time = results["full"]["seconds"]
+        for quality, r in results.items():
+            print(f"{name[-40:]:<40} {quality:<9} {r['seconds']:>7.3f}s {full_time / r['seconds']:>6.1f}x "
+                  f"{r['psnr']:>7.2f} {r['ssim']:>6.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Compare the LUT-based color steps against the original conversions.
+
+Run from the repository root:
+
+    python -m benchmarks.color_lut --megapixels 2 12
+    python -m benchmarks.color_lut --images photo.jpg
+
+For the enhancer and oil painting effects it reports the wall time of the
+original implementation and the current one, and how closely their outputs
+agree, plus the oil painting color stage on its own (LAB to vivid BGR).
+It also times color grading presets and chains of them as one lookup in a
+composed table against running their operations one after another.
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.image_quality import psnr
+from benchmarks.pencil_sketch import synthetic_image
+from color_lut import PRESETS, get_lut
+from oil_painting import OilPaintingEffect
+from photo_enhancer import PhotoEnhancer
+
+
+def legacy_enhancer(img):
+    """The original PhotoEnhancer steps, with split/merge and an HSV round trip"""
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    lab = cv2.merge((cv2.createCLAHE(clipLimit=0.9, tileGridSize=(8, 8)).apply(l), a, b))
+    contrast_img = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+    blur = cv2.GaussianBlur(contrast_img, (0, 0), sigmaX=3.1)
+    sharp = cv2.addWeighted(contrast_img, 1.7, blur, -0.7, 0)
+    h, s, v = cv2.split(cv2.cvtColor(sharp, cv2.COLOR_BGR2HSV))
+    s = np.clip(cv2.add(s, 23), 0, 255)
+    return cv2.cvtColor(cv2.merge([h, s, v]), cv2.COLOR_HSV2BGR)
+
+
+def legacy_oil(img):
+    """The original OilPaintingEffect steps: LAB and HSV round trips"""
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    l, a, b = cv2.split(lab)
+    lab = cv2.merge((cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8)).apply(l), a, b))
+    vibrant = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+    hsv = cv2.cvtColor(vibrant, cv2.COLOR_BGR2HSV)
+    hsv[:, :, 1] = cv2.add(hsv[:, :, 1], 25)
+    vibrant = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    blur = cv2.GaussianBlur(vibrant, (0, 0), 2.0)
+    sharpened = cv2.addWeighted(vibrant, 1.6, blur, -0.6, 0)
+    return cv2.medianBlur(sharpened, 7)
+
+
+def legacy_oil_color(lab):
+    """The original oil painting color stage after CLAHE"""
+    vibrant = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+    hsv = cv2.cvtColor(vibrant, cv2.COLOR_BGR2HSV)
+    hsv[:, :, 1] = cv2.add(hsv[:, :, 1], 25)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+def run_presets(chain, img):
+    for preset in chain.split("+"):
+        img = PRESETS[preset](img)
+    return img
+
+
+def best_time(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def agreement(new, old):
+    diff = np.abs(new.astype(np.int16) - old)
+    return {
+        "max_diff": int(diff.max()),
+        "identical": float((diff.max(axis=-1) == 0).mean()),
+        "psnr": psnr(new, old),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the color LUT engine.")
+    parser.add_argument("--megapixels", type=float, nargs="*", default=[2, 12])
+    parser.add_argument("--images", nargs="*", default=[], help="Photos to test in addition to synthetic input")
+    parser.add_argument("--chains", nargs="*", default=["vivid", "warm", "warm+vivid+contrast", "sepia+fade+contrast"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    inputs = [(f"synthetic {mp:g} MP", synthetic_image(mp)) for mp in args.megapixels]
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise SystemExit(f"Could not read {path}")
+        inputs.append((path, image))
+
+    # Tabulated once per process, like on the server
+    start = time.perf_counter()
+    get_lut("oil_painting")
+    print(f"oil_painting table built in {time.perf_counter() - start:.2f}s\n")
+
+    oil_lut = get_lut("oil_painting")
+    effects = [
+        ("enhancer", legacy_enhancer, lambda img: PhotoEnhancer.apply(img, tiled=False)),
+        ("oil_painting", legacy_oil, lambda img: OilPaintingEffect.apply(img, tiled=False)),
+        ("oil color", lambda img: legacy_oil_color(cv2.cvtColor(img, cv2.COLOR_BGR2LAB)),
+         lambda img: oil_lut.apply(cv2.cvtColor(img, cv2.COLOR_BGR2LAB))),
+    ]
+    print(f"{'input':<30} {'effect':<13} {'legacy':>8} {'current':>8} {'speedup':>7} "
+          f"{'max diff':>8} {'identical':>9} {'PSNR':>7}")
+    for name, image in inputs:
+        for effect, legacy, current in effects:
+            old, old_time = best_time(legacy, image, repeat=args.repeat)
+            new, new_time = best_time(current, image, repeat=args.repeat)
+            a = agreement(new, old)
+            print(f"{name[-30:]:<30} {effect:<13} {old_time:>7.3f}s {new_time:>7.3f}s {old_time / new_time:>6.2f}x "
+                  f"{a['max_diff']:>8d} {a['identical']:>9.4%} {a['psnr']:>7.2f}")
+
+    # On the last input, a photo when any are given
+    name, image = inputs[-1]
+    print(f"\n{'chain':<22} {'build':>7} {'direct':>8} {'lookup':>8} {'max diff':>8}  ({name})")
+    for chain in args.chains:
+        start = time.perf_counter()
+        lut = get_lut(chain)
+        build = time.perf_counter() - start
+        direct, direct_time = best_time(run_presets, chain, image, repeat=args.repeat)
+        looked_up, lookup_time = best_time(lut.apply, image, repeat=args.repeat)
+        print(f"{chain:<22} {build:>6.2f}s {direct_time:>7.3f}s {lookup_time:>7.3f}s "
+              f"{agreement(looked_up, direct)['max_diff']:>8d}")
+
+
+if __name__ == "__main__":
+    main()
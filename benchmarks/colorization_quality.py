@@ -0,0 +1,82 @@
+"""Speed versus quality of the Colorization quality modes.
+
+Run from the repository root:
+
+    python -m benchmarks.colorization_quality --megapixels 2 12
+    python -m benchmarks.colorization_quality --images photo1.jpg photo2.jpg
+
+Inputs are converted to grayscale first, like the black and white photos the
+effect is meant for. Every mode is timed on the same input and compared with
+the 'full' result (PSNR in dB and SSIM; 'full' itself is the reference).
+
+The 224x224 forward pass is the same in every mode. ``--without-net`` skips
+it and uses a neutral (colourless) prediction instead, which times and
+compares only the pre- and postprocessing and needs no model files.
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.image_quality import psnr, ssim
+from benchmarks.pencil_sketch import synthetic_image
+from colorization import NET_INPUT_SIZE, QUALITY_MODES, Colorization, forward_batch
+
+# The net predicts ab at a quarter of its input size
+AB_SIZE = (NET_INPUT_SIZE[1] // 4, NET_INPUT_SIZE[0] // 4)
+
+
+def colorize(image, quality, net=True):
+    colorizer = Colorization(None, quality=quality)
+    _, l_channel, l_net = colorizer._prepare(image)
+    ab_dec = forward_batch([l_net])[0] if net else np.zeros(AB_SIZE + (2,), np.float32)
+    return Colorization._postprocess(l_channel, ab_dec, quality, l_net)
+
+
+def run(image, repeat=1, net=True):
+    results = {}
+    reference = None
+    for quality in ["full"] + [q for q in QUALITY_MODES if q != "full"]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = colorize(image, quality, net)
+            best = min(best, time.perf_counter() - start)
+        if reference is None:
+            reference = output
+        results[quality] = {
+            "seconds": best,
+            "psnr": psnr(output, reference),
+            "ssim": ssim(output, reference),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Colorization quality modes.")
+    parser.add_argument("--megapixels", type=float, nargs="*", default=[2])
+    parser.add_argument("--images", nargs="*", default=[], help="Photos to test in addition to synthetic input")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--without-net", action="store_true", help="Skip the forward pass (no model files needed)")
+    args = parser.parse_args()
+
+    inputs = [(f"synthetic {mp:g} MP", synthetic_image(mp)) for mp in args.megapixels]
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise SystemExit(f"Could not read {path}")
+        inputs.append((path, image))
+
+    print(f"{'input':<40} {'quality':<9} {'time':>8} {'speedup':>7} {'PSNR':>7} {'SSIM':>6}")
+    for name, image in inputs:
+        gray = cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+        results = run(gray, args.repeat, net=not args.without_net)
+        full_time = results["full"]["seconds"]
+        for quality, r in results.items():
+            print(f"{name[-40:]:<40} {quality:<9} {r['seconds']:>7.3f}s {full_time / r['seconds']:>6.1f}x "
+                  f"{r['psnr']:>7.2f} {r['ssim']:>6.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compare fused crop/rotate/resize edits with applying the steps one by one.
+
+Run from the repository root:
+
+    python -m benchmarks.edit_ops --megapixels 12 24
+    python -m benchmarks.edit_ops --images photo.jpg --edits "rotate:angle=90,resize:width=1024"
+
+Each input is encoded as a JPEG (quality 95) and, for every edit chain,
+decoded and edited two ways: the steps one after another on the full
+decode, each making its own image, and as one EditPlan (a decode reduced
+by the plan's scale, then one slice/transpose/resize or warpAffine pass).
+The report shows wall time, peak traced allocations and PSNR against the
+step-by-step result.
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from benchmarks.image_quality import psnr
+from benchmarks.pencil_sketch import synthetic_image
+from edit_ops import STEPS, EditPlan, parse_ops, warp
+from image_io import decode_image
+
+EDITS = [
+    "crop:x=200;y=150;width=2400;height=1800",
+    "rotate:angle=90,crop:x=100;y=100;width=1600;height=2000",
+    "flip,rotate:angle=270,resize:width=1200",
+    "crop:x=400;y=300;width=3000;height=2000,resize:width=800",
+    "rotate:angle=7,crop:x=300;y=300;width=2800;height=2000,resize:width=1600",
+]
+
+
+def step_by_step(data, ops):
+    """Every step applied on its own, as a client or naive server chain would"""
+    img = decode_image(data)
+    for name, params in ops:
+        size = (img.shape[1], img.shape[0])
+        img = warp(img, *STEPS[name](size, **params))
+    return img
+
+
+def measure(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fused edits against step-by-step ones.")
+    parser.add_argument("--megapixels", type=float, nargs="*", default=[12])
+    parser.add_argument("--images", nargs="*", default=[], help="Photos to test in addition to synthetic input")
+    parser.add_argument("--edits", nargs="*", default=EDITS)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    inputs = [(f"synthetic {mp:g} MP", synthetic_image(mp)) for mp in args.megapixels]
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise SystemExit(f"Could not read {path}")
+        inputs.append((path, image))
+
+    print(f"{'input':<20} {'edits':<52} {'steps':>8} {'fused':>8} {'speedup':>7} "
+          f"{'steps MB':>8} {'fused MB':>8} {'PSNR':>7}")
+    for name, image in inputs:
+        data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+        for spec in args.edits:
+            ops = parse_ops(spec)
+            plan = EditPlan(ops)
+            try:
+                expected, steps_time, steps_peak = measure(lambda: step_by_step(data, ops), args.repeat)
+            except ValueError as e:
+                print(f"{name[-20:]:<20} {spec[:52]:<52} skipped: {e}")
+                continue
+            result, fused_time, fused_peak = measure(lambda: plan.decode(data), args.repeat)
+            print(f"{name[-20:]:<20} {spec[:52]:<52} {steps_time:>7.3f}s {fused_time:>7.3f}s "
+                  f"{steps_time / fused_time:>6.2f}x {steps_peak / 1e6:>8.1f} {fused_peak / 1e6:>8.1f} "
+                  f"{psnr(result, expected) if result.shape == expected.shape else float('nan'):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Benchmark every effect across image sizes and compare against a baseline.
+
+Run from the repository root:
+
+    python -m benchmarks.effects --output results.json
+    python -m benchmarks.effects --sizes 0.3 2 --effects sketch cartoon
+    python -m benchmarks.effects --output new.json --baseline results.json --threshold 0.15
+
+Each (effect, size) case runs in a fresh process on a synthetic image. The
+decode, effect and encode stages are measured separately for wall time, CPU
+time (all threads), peak RSS and peak traced allocations (tracemalloc, in an
+extra run). Effects whose model weights are not on disk are skipped, so the
+suite runs offline on a CPU-only box.
+
+With ``--baseline`` the run is compared with a previous results file; the
+exit status is 1 if any stage got slower (wall time) or bigger (peak RSS)
+by more than ``--threshold``.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+from benchmarks.pencil_sketch import synthetic_image
+
+SIZES = [0.3, 2, 12, 48]
+EFFECTS = ["sketch", "cartoon", "oil_painting", "enhancer", "compression", "colorization", "background_removal"]
+
+# Differences below these are noise, whatever the ratio
+MIN_WALL_DIFF_S = 0.02
+MIN_RSS_DIFF_MB = 8
+
+
+def _rembg_weights():
+    home = os.environ.get("U2NET_HOME", os.path.join(os.path.expanduser("~"), ".u2net"))
+    return os.path.join(home, "u2net.onnx")
+
+
+def unavailable_reason(effect):
+    """Why ``effect`` cannot run here, or None if it can"""
+    if effect == "colorization":
+        from colorization import MODEL_DIR
+        missing = [name for name in ("colorization_deploy_v2.prototxt", "colorization_release_v2.caffemodel",
+                                     "pts_in_hull.npy") if not (MODEL_DIR / name).exists()]
+        if missing:
+            return f"model files missing from {MODEL_DIR}: {', '.join(missing)}"
+    if effect == "background_removal":
+        if importlib.util.find_spec("rembg") is None:
+            return "rembg is not installed"
+        if not os.path.exists(_rembg_weights()):
+            return f"rembg weights not found at {_rembg_weights()} (they are downloaded on first use)"
+    return None
+
+
+def load_effect(effect):
+    """Import an effect and return ``fn(img)``"""
+    if effect == "sketch":
+        from img2Sketch import PencilSketch
+        return PencilSketch()
+    if effect == "cartoon":
+        from img2Cartoon import Cartoon
+        return Cartoon.apply
+    if effect == "oil_painting":
+        from oil_painting import OilPaintingEffect
+        return OilPaintingEffect.apply
+    if effect == "enhancer":
+        from photo_enhancer import PhotoEnhancer
+        return PhotoEnhancer.apply
+    if effect == "compression":
+        from image_compression import ImageCompression
+        return ImageCompression.encode
+    if effect == "colorization":
+        from colorization import Colorization
+        return Colorization(None).apply
+    if effect == "background_removal":
+        from background_removal import BackgroundRemoval
+        return BackgroundRemoval.apply
+    raise ValueError(f"Unknown effect '{effect}'")
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux); False if unsupported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def _peak_rss_mb(resettable):
+    if resettable:
+        return _rss_mb("VmHWM")
+    # Lifetime peak of the process; still meaningful since each case has its own process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(fn, repeat=1, trace=True):
+    """Run ``fn`` and return (result, metrics)"""
+    resettable = _reset_peak_rss()
+    try:
+        rss_before = _rss_mb("VmRSS")
+    except (OSError, KeyError):
+        rss_before = None
+
+    wall = cpu = float("inf")
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = fn()
+        wall = min(wall, time.perf_counter() - wall_start)
+        cpu = min(cpu, time.process_time() - cpu_start)
+    metrics = {
+        "wall_s": round(wall, 5),
+        "cpu_s": round(cpu, 5),
+        "peak_rss_mb": round(_peak_rss_mb(resettable), 1),
+    }
+    if rss_before is not None:
+        metrics["peak_rss_growth_mb"] = round(metrics["peak_rss_mb"] - rss_before, 1)
+
+    if trace:
+        del result
+        tracemalloc.start()
+        result = fn()
+        metrics["alloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+        tracemalloc.stop()
+    return result, metrics
+
+
+def run_case(effect, megapixels, repeat=1, trace=True):
+    """Benchmark one effect at one size; meant to run in its own process"""
+    from image_io import decode_image, encode_image
+
+    image = synthetic_image(megapixels)
+    height, width = image.shape[:2]
+    data = encode_image(image, ".jpg", quality=90)
+    del image
+
+    # Imports and model loading, warmed up on a small image
+    start = time.perf_counter()
+    fn = load_effect(effect)
+    fn(synthetic_image(0.01))
+    stages = {"load": {"wall_s": round(time.perf_counter() - start, 5)}}
+
+    img, stages["decode"] = measure(lambda: decode_image(data), repeat, trace)
+    result, stages["effect"] = measure(lambda: fn(img), repeat, trace)
+    if isinstance(result, np.ndarray):
+        _, stages["encode"] = measure(lambda: encode_image(result, ".png"), repeat, trace)
+
+    return {
+        "effect": effect,
+        "megapixels": megapixels,
+        "width": width,
+        "height": height,
+        "stages": stages,
+    }
+
+
+def environment():
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Stages that regressed by more than ``threshold`` (a fraction) versus ``baseline``"""
+    old_cases = {(case["effect"], case["megapixels"]): case for case in baseline.get("results", [])}
+    regressions = []
+    for case in results["results"]:
+        old_case = old_cases.get((case["effect"], case["megapixels"]))
+        if old_case is None:
+            continue
+        for stage, metrics in case["stages"].items():
+            old = old_case["stages"].get(stage)
+            if not old:
+                continue
+            for metric, floor in (("wall_s", MIN_WALL_DIFF_S), ("peak_rss_mb", MIN_RSS_DIFF_MB)):
+                if metric not in metrics or metric not in old or old[metric] <= 0:
+                    continue
+                ratio = metrics[metric] / old[metric]
+                if ratio > 1 + threshold and metrics[metric] - old[metric] > floor:
+                    regressions.append({
+                        "effect": case["effect"], "megapixels": case["megapixels"], "stage": stage,
+                        "metric": metric, "baseline": old[metric], "current": metrics[metric],
+                        "ratio": round(ratio, 3),
+                    })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every effect across image sizes.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=SIZES, help="Megapixels")
+    parser.add_argument("--effects", nargs="+", default=EFFECTS, choices=EFFECTS)
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per stage (best is kept)")
+    parser.add_argument("--no-alloc", action="store_true", help="Skip the tracemalloc run")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed slowdown, e.g. 0.15 for 15%%")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "results": [], "skipped": []}
+    # A fresh process per case keeps peak RSS and warm caches from leaking between cases
+    context = get_context("spawn")
+
+    print(f"{'effect':<19} {'MP':>5} {'stage':<7} {'wall':>9} {'cpu':>9} {'peak RSS':>9} {'allocs':>9}")
+    for effect in args.effects:
+        reason = unavailable_reason(effect)
+        if reason:
+            results["skipped"].append({"effect": effect, "reason": reason})
+            print(f"{effect:<19} skipped: {reason}")
+            continue
+        for megapixels in args.sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                case = pool.submit(run_case, effect, megapixels, args.repeat, not args.no_alloc).result()
+            results["results"].append(case)
+            for stage, m in case["stages"].items():
+                if stage == "load":
+                    continue
+                alloc = f"{m['alloc_peak_mb']:>7.0f}MB" if "alloc_peak_mb" in m else f"{'-':>9}"
+                print(f"{effect:<19} {megapixels:>5g} {stage:<7} {m['wall_s']:>8.3f}s {m['cpu_s']:>8.3f}s "
+                      f"{m['peak_rss_mb']:>7.0f}MB {alloc}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['effect']} {r['megapixels']:g} MP {r['stage']} {r['metric']}: "
+                  f"{r['baseline']} -> {r['current']} ({r['ratio']:.2f}x)")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Compare passing images to a worker process through shared-memory slots with pickling them.
+
+Run from the repository root:
+
+    python -m benchmarks.frame_transport --megapixels 2 12 48
+
+For each size, a process pool worker gets a BGR frame, inverts it and sends
+the result back, once with the frames pickled (as ProcessPoolExecutor does
+by default) and once with both in SlotRing slots, so only their SlotRefs
+are pickled. Round trips are timed after a warm-up, so slots are already
+sized and mapped. The parent copies the result out of its slot before
+releasing it, like the job queue does. The work itself is timed in-process
+too, to show what the transport adds. The ``encoded`` rows do the same with
+what the job queue actually sends: the upload as a JPEG (quality 95) one
+way and a PNG-sized result the other.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from benchmarks.pencil_sketch import synthetic_image
+from frame_transport import SlotRing, attach
+
+# The encoded result each worker sends back, made once per size
+_results = {}
+
+
+def _invert(frame):
+    return cv2.bitwise_not(frame)
+
+
+def _invert_slots(source, out):
+    cv2.bitwise_not(attach(source), dst=attach(out))
+    return out
+
+
+def _encoded_result(size):
+    if size not in _results:
+        _results[size] = np.random.default_rng(0).integers(0, 256, size, np.uint8).tobytes()
+    return _results[size]
+
+
+def _echo(data, size):
+    return _encoded_result(size)
+
+
+def _echo_slots(source, out):
+    result = _encoded_result(out.shape[0])
+    attach(out)[:] = np.frombuffer(result, np.uint8)
+    return out
+
+
+def pickled(pool, fn, payload, *args):
+    return pool.submit(fn, payload, *args).result()
+
+
+def slotted(pool, ring, fn, array, out_shape):
+    source = ring.put(array)
+    out = ring.acquire(int(np.prod(out_shape)))
+    try:
+        ref = pool.submit(fn, source.ref(array.shape, array.dtype), out.ref(out_shape)).result()
+        return out.view(ref.shape, ref.dtype).copy()
+    finally:
+        source.release()
+        out.release()
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shared-memory slots against pickling.")
+    parser.add_argument("--megapixels", type=float, nargs="*", default=[2, 12, 48])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    pool.submit(int).result()
+    ring = SlotRing(max_bytes=4 << 30, slots=4)
+    try:
+        print(f"{'input':<22} {'MB':>7} {'work':>8} {'pickle':>8} {'slots':>8} {'speedup':>7}  "
+              f"{'pickle +':>8} {'slots +':>8}")
+        for mp in args.megapixels:
+            frame = synthetic_image(mp)
+            expected, work = best_time(lambda: _invert(frame), args.repeat)
+            result, pickle_time = best_time(lambda: pickled(pool, _invert, frame), args.repeat)
+            assert np.array_equal(result, expected)
+            result, slot_time = best_time(lambda: slotted(pool, ring, _invert_slots, frame, frame.shape), args.repeat)
+            assert np.array_equal(result, expected)
+            print(f"{f'frame {mp:g} MP':<22} {frame.nbytes / 1e6:>7.1f} {work:>7.3f}s {pickle_time:>7.3f}s "
+                  f"{slot_time:>7.3f}s {pickle_time / slot_time:>6.2f}x  {pickle_time - work:>7.3f}s "
+                  f"{slot_time - work:>7.3f}s")
+
+            upload = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+            size = len(cv2.imencode(".png", frame)[1])
+            _, pickle_time = best_time(lambda: pickled(pool, _echo, upload, size), args.repeat)
+            encoded = np.frombuffer(upload, np.uint8)
+            _, slot_time = best_time(lambda: slotted(pool, ring, _echo_slots, encoded, (size,)), args.repeat)
+            print(f"{f'encoded {mp:g} MP':<22} {(len(upload) + size) / 1e6:>7.1f} {'':>8} {pickle_time:>7.3f}s "
+                  f"{slot_time:>7.3f}s {pickle_time / slot_time:>6.2f}x  {pickle_time:>7.3f}s {slot_time:>7.3f}s")
+    finally:
+        pool.shutdown()
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Full-reference image quality measures used by the benchmarks."""
+import cv2
+import numpy as np
+
+
+def psnr(image, reference):
+    """Peak signal-to-noise ratio in dB (inf for identical images)"""
+    mse = np.mean((image.astype(np.float64) - reference) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(image, reference):
+    """Mean structural similarity (Wang et al. 2004, 11x11 Gaussian window, sigma 1.5)
+
+    Color images are compared per channel and averaged.
+    """
+    x = image.astype(np.float64)
+    y = reference.astype(np.float64)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def window(img):
+        return cv2.GaussianBlur(img, (11, 11), 1.5)
+
+    mu_x, mu_y = window(x), window(y)
+    var_x = window(x * x) - mu_x * mu_x
+    var_y = window(y * y) - mu_y * mu_y
+    cov = window(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
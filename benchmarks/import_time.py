@@ -0,0 +1,127 @@
+"""Cold-start cost of the web app, the CLI tools and each effect.
+
+Run from the repository root:
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules run img2Sketch --top 8 --output imports.json
+
+Every target is imported in a fresh interpreter under ``python -X importtime``
+(best of ``--repeat`` runs). The report shows the import time, the peak RSS
+afterwards and the slowest imports the target made itself. An effect is
+measured as its first use in a process that has already imported
+``effect_pipeline`` (``load_stages([...])``), which is what its first
+request pays; its RSS is the growth over that process.
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+MODULES = ["run", "effect_pipeline", "img2Sketch", "sketch_stream", "job_queue"]
+EFFECTS = ["sketch", "cartoon", "enhancer", "oil_painting", "colorization", "background_removal"]
+
+# "import time: self [us] | cumulative | imported package", nesting shown by indentation
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+MODULE_CODE = """
+import resource
+{imports}
+print('result', 0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+EFFECT_CODE = """
+import resource, time
+import effect_pipeline
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+effect_pipeline.load_stages([{effect!r}])
+print('result', time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+"""
+
+
+def _run(code):
+    """([(depth, seconds, module)] in -X importtime order, seconds, RSS kB) of running ``code``"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            # One space at the top level, two more per nesting level
+            entries.append((len(match.group(3)) // 2 + 1, int(match.group(2)) / 1e6, match.group(4)))
+    _, seconds, rss_kb = proc.stdout.split()[-3:]
+    return entries, float(seconds), int(rss_kb)
+
+
+def _children(entries, index):
+    """Imports made directly by ``entries[index]`` (they are listed before it)"""
+    depth = entries[index][0]
+    children = []
+    for child_depth, seconds, module in reversed(entries[:index]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            children.append((seconds, module))
+    return children
+
+
+def measure_module(module):
+    entries, _, rss_kb = _run(MODULE_CODE.format(imports=f"import {module}"))
+    index = next(i for i, (depth, _, name) in enumerate(entries) if depth == 1 and name == module)
+    return entries[index][1], rss_kb, _children(entries, index)
+
+
+def measure_effect(effect):
+    entries, seconds, rss_kb = _run(EFFECT_CODE.format(effect=effect))
+    # Everything imported after effect_pipeline was imported by load_stages()
+    start = next(i for i, (depth, _, name) in enumerate(entries) if depth == 1 and name == "effect_pipeline")
+    imported = []
+    for index in range(start + 1, len(entries)):
+        if entries[index][0] == 1:
+            imported.append(entries[index][1:])
+            imported.extend(_children(entries, index))
+    return seconds, rss_kb, imported
+
+
+def best_of(measure, target, repeat):
+    return min((measure(target) for _ in range(repeat)), key=lambda result: result[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report import times (python -X importtime).")
+    parser.add_argument("--modules", nargs="*", default=MODULES)
+    parser.add_argument("--effects", nargs="*", default=EFFECTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports to list per target")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    targets = [(module, measure_module, module) for module in args.modules]
+    targets += [(f"effect:{effect}", measure_effect, effect) for effect in args.effects]
+    results = {}
+    print(f"{'target':<26} {'import':>8} {'RSS':>8}  slowest imports")
+    for name, measure, target in targets:
+        try:
+            seconds, rss_kb, imports = best_of(measure, target, args.repeat)
+        except RuntimeError as e:
+            print(f"{name:<26} {'failed':>8} {'':>8}  {e}")
+            results[name] = {"error": str(e)}
+            continue
+        slowest = sorted(imports, reverse=True)[:args.top]
+        results[name] = {
+            "seconds": round(seconds, 4),
+            "rss_mb": round(rss_kb / 1024, 1),
+            "slowest": [{"module": module, "seconds": round(s, 4)} for s, module in slowest],
+        }
+        rss = f"{'+' if name.startswith('effect:') else ''}{rss_kb / 1024:.0f}MB"
+        listed = ", ".join(f"{module} {s * 1000:.0f}ms" for s, module in slowest)
+        print(f"{name:<26} {seconds * 1000:>6.0f}ms {rss:>8}  {listed}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
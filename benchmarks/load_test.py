@@ -0,0 +1,211 @@
+"""Latency percentiles and throughput of the web app under concurrent load.
+
+Run from the repository root, against a running server:
+
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --endpoint /pencil_sketch --concurrency 8
+
+or let it start one (``python serve.py`` with the given environment) on a
+free port and stop it afterwards:
+
+    python -m benchmarks.load_test --start --env WEB_THREADS=8 --concurrency 16 --duration 30
+
+Each client thread keeps one HTTP/1.1 connection open and POSTs the image
+as fast as it gets responses. With ``--unique`` every request sends
+different bytes (a random trailer after the image data, which decoders
+ignore), so the result cache never answers; without it the cache answers
+nearly every request. The report gives requests per second, p50/p90/p99
+latency and the status codes seen.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+def multipart(fields, field, filename, data):
+    """(body, content type) of a multipart/form-data request"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+    parts += [data, f'\r\n--{boundary}--\r\n'.encode()]
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(env, timeout=60):
+    """Run ``python serve.py`` on a free port; returns (process, base URL) once it answers"""
+    port = free_port()
+    environ = dict(os.environ, BIND=f'127.0.0.1:{port}', **env)
+    process = subprocess.Popen([sys.executable, 'serve.py'], env=environ,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"serve.py exited with status {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/cache/stats')
+            connection.getresponse().read()
+            return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("serve.py did not start in time")
+
+
+class Client(threading.Thread):
+    """Sends requests back to back on one connection until ``stop`` is set or ``budget`` runs out"""
+
+    def __init__(self, url, endpoint, make_request, stop, budget):
+        super().__init__(daemon=True)
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.path = parts.path.rstrip('/') + endpoint
+        self.make_request = make_request
+        self.stop = stop
+        self.budget = budget
+        self.results = []
+
+    def run(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=300)
+        while not self.stop.is_set() and self.budget.take():
+            body, content_type = self.make_request()
+            start = time.perf_counter()
+            try:
+                connection.request('POST', self.path, body, {'Content-Type': content_type})
+                response = connection.getresponse()
+                size = len(response.read())
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=300)
+                size, status = 0, 'error'
+            self.results.append((time.perf_counter() - start, status, size))
+        connection.close()
+
+
+class Budget:
+    """Request counter shared by the clients (None: unlimited)"""
+
+    def __init__(self, total):
+        self.remaining = total
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.remaining is None:
+            return True
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def run_load(url, endpoint, make_request, concurrency, duration=None, requests=None, warmup=0):
+    if warmup:
+        run_load(url, endpoint, make_request, concurrency, requests=warmup)
+    stop = threading.Event()
+    budget = Budget(requests)
+    clients = [Client(url, endpoint, make_request, stop, budget) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    if duration:
+        time.sleep(duration)
+        stop.set()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    results = [result for client in clients for result in client.results]
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    latencies = np.array([seconds for seconds, _, _ in results]) * 1000
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = sum(1 for _, status, _ in results if status == 200)
+    return {
+        'requests': len(results),
+        'seconds': round(elapsed, 2),
+        'rps': round(ok / elapsed, 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+        'p90_ms': round(float(np.percentile(latencies, 90)), 1),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+        'max_ms': round(float(latencies.max()), 1),
+        'mb_out_per_s': round(sum(size for _, _, size in results) / elapsed / 1e6, 2),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test an endpoint of the web app.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--start", action="store_true", help="Start serve.py on a free port instead of using --url")
+    parser.add_argument("--env", nargs="*", default=[], help="Environment for --start, e.g. WEB_THREADS=8")
+    parser.add_argument("--endpoint", default="/pencil_sketch")
+    parser.add_argument("--image", default="static/images/image.jpg")
+    parser.add_argument("--field", default="image", help="Form field of the upload")
+    parser.add_argument("--form", nargs="*", default=[], help="Extra form fields, e.g. quality=fast")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[8])
+    parser.add_argument("--duration", type=float, default=None, help="Seconds per concurrency level")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per level (without --duration)")
+    parser.add_argument("--warmup", type=int, default=10, help="Requests sent before measuring")
+    parser.add_argument("--unique", action="store_true", help="Send different bytes every time (no cache hits)")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        data = f.read()
+    fields = dict(item.split('=', 1) for item in args.form)
+    filename = os.path.basename(args.image)
+    if args.unique:
+        make_request = lambda: multipart(fields, args.field, filename, data + os.urandom(16))
+    else:
+        request = multipart(fields, args.field, filename, data)
+        make_request = lambda: request
+
+    process = None
+    url = args.url
+    if args.start:
+        process, url = start_server(dict(item.split('=', 1) for item in args.env))
+    results = {}
+    try:
+        print(f"{'concurrency':>11} {'requests':>8} {'rps':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  statuses")
+        for concurrency in args.concurrency:
+            measured, elapsed = run_load(url, args.endpoint, make_request, concurrency,
+                                         args.duration, None if args.duration else args.requests, args.warmup)
+            summary = results[concurrency] = summarize(measured, elapsed)
+            print(f"{concurrency:>11} {summary['requests']:>8} {summary['rps']:>8.1f} {summary['p50_ms']:>6.0f}ms "
+                  f"{summary['p90_ms']:>6.0f}ms {summary['p99_ms']:>6.0f}ms {summary['max_ms']:>6.0f}ms  "
+                  f"{summary['statuses']}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'endpoint': args.endpoint, 'unique': args.unique, 'env': args.env, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
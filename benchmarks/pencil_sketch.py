@@ -0,0 +1,120 @@
+"""Compare the optimized PencilSketch against the original float64 implementation.
+
+Run from the repository root:
+
+    python -m benchmarks.pencil_sketch --megapixels 2 12 24
+
+For each size it reports wall time, peak NumPy allocations (tracemalloc) and
+how closely the outputs agree. The grayscale step is allowed to differ by at
+most 1 level (see ``img2Sketch.PencilSketch``); given the same grayscale the
+rest of the pipeline must match bit for bit.
+"""
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import cv2
+import numpy as np
+
+from img2Sketch import GRAY_TRANSFORM, PencilSketch
+
+GRAY_TOLERANCE = 1
+
+
+def legacy_grayscale(frame):
+    return np.array(np.dot(frame[..., :3], [0.299, 0.587, 0.114]), dtype=np.uint8)
+
+
+def legacy_from_gray(grayscale, blur_sigma=5, ksize=(0, 0), sharpen_value=None):
+    """The original PencilSketch.__call__ after its grayscale step"""
+    grayscale = np.stack((grayscale,) * 3, axis=-1)
+    inverted_img = 255 - grayscale
+    blur_img = cv2.GaussianBlur(inverted_img, ksize=ksize, sigmaX=blur_sigma)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        result = grayscale * 255.0 / (255.0 - blur_img)
+        result[result > 255] = 255
+        result[grayscale == 255] = 255
+        final_img = result.astype("uint8")
+
+    if sharpen_value is not None:
+        kernel = np.array([[0, -1, 0], [-1, sharpen_value, -1], [0, -1, 0]])
+        final_img = 255 - cv2.filter2D(src=255 - final_img, ddepth=-1, kernel=kernel)
+    return final_img
+
+
+def legacy_sketch(frame, **params):
+    return legacy_from_gray(legacy_grayscale(frame), **params)
+
+
+def synthetic_image(megapixels, seed=0):
+    """Smooth color regions with fine noise, roughly like a photo"""
+    rng = np.random.default_rng(seed)
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    base = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    image = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(-12, 13, image.shape, dtype=np.int16)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def measure(fn, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def compare(frame, params):
+    sketcher = PencilSketch(**params)
+    sketcher(frame)  # warm the workspace for this shape
+
+    old, old_time, old_peak = measure(legacy_sketch, frame, **params)
+    new, new_time, new_peak = measure(sketcher, frame)
+
+    old_gray = legacy_grayscale(frame)
+    gray = cv2.transform(frame[..., :3], GRAY_TRANSFORM)
+    gray_diff = int(np.abs(gray.astype(np.int16) - old_gray).max())
+    same_gray_match = np.array_equal(legacy_from_gray(gray, **params), sketcher(frame))
+
+    return {
+        "legacy_s": old_time,
+        "optimized_s": new_time,
+        "speedup": old_time / new_time,
+        "legacy_peak_mb": old_peak / 1e6,
+        "optimized_peak_mb": new_peak / 1e6,
+        "identical_pixels": float((old == new).mean()),
+        "gray_max_diff": gray_diff,
+        "exact_given_gray": same_gray_match,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pencil sketch engine.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[2, 12, 24])
+    parser.add_argument("--blur_sigma", type=int, default=5)
+    parser.add_argument("--sharpen_value", type=int, default=None)
+    args = parser.parse_args()
+
+    params = {"blur_sigma": args.blur_sigma, "sharpen_value": args.sharpen_value}
+    print(f"{'MP':>5} {'legacy':>9} {'optimized':>9} {'speedup':>7} "
+          f"{'legacy MB':>9} {'opt MB':>7} {'identical':>9} {'gray diff':>9} {'exact':>5}")
+    for megapixels in args.megapixels:
+        r = compare(synthetic_image(megapixels), params)
+        print(f"{megapixels:>5g} {r['legacy_s']:>8.3f}s {r['optimized_s']:>8.3f}s {r['speedup']:>6.1f}x "
+              f"{r['legacy_peak_mb']:>9.0f} {r['optimized_peak_mb']:>7.0f} {r['identical_pixels']:>9.4%} "
+              f"{r['gray_max_diff']:>9d} {str(r['exact_given_gray']):>5}")
+        if r["gray_max_diff"] > GRAY_TOLERANCE or not r["exact_given_gray"]:
+            raise SystemExit("Optimized output is outside the stated tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# Tables kept open per process (64 MB each, shared with other processes when saved to COLOR_LUT_DIR)
+LUT_CACHE_SIZE = int(os.environ.get('COLOR_LUT_CACHE', 1))
+# Built tables are saved here and memory-mapped, so every process (web,
+# job and batch workers) shares one copy instead of building its own ('': don't save)
+LUT_DIR = os.environ.get('COLOR_LUT_DIR', os.path.join(tempfile.gettempdir(), 'color_luts'))
+# Registered tables an "a+b" chain may combine
+MAX_CHAIN = int(os.environ.get('COLOR_LUT_MAX_CHAIN', 4))
+COLORS = 1 << 24
+# Clears the 4th byte of a BGRA pixel read as one little-endian uint32
+_RGB_MASK = np.uint32(0x00FFFFFF)
+
+
+def _pack(img):
+    """A 3-channel uint8 image as one uint32 per pixel: c0 | c1 << 8 | c2 << 16"""
+    packed = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA).view(np.uint32)[..., 0]
+    np.bitwise_and(packed, _RGB_MASK, out=packed)
+    return packed
+
+
+class ColorLUT:
+    """An exact per-pixel color transform of 8-bit 3-channel images, applied
+    as a single table lookup.
+
+    The table holds the result for each of the 2**24 input colors, so a chain
+    of per-pixel steps (color space round trips, saturation, curves, grading)
+    costs one gather per pixel and matches running the chain. Channels are
+    taken in array order, so a table can map e.g. LAB input to BGR output.
+    """
+
+    def __init__(self, table):
+        if table.dtype != np.uint32 or table.shape != (COLORS,):
+            raise ValueError("A ColorLUT table has one uint32 per 24-bit color")
+        self.table = table
+
+    @classmethod
+    def from_function(cls, fn):
+        """Tabulate ``fn(img) -> img``, a per-pixel operation on 3-channel uint8 images"""
+        # Every color once, as a 4096x4096 image
+        colors = np.arange(COLORS, dtype=np.uint32).view(np.uint8).reshape(4096, 4096, 4)
+        result = fn(np.ascontiguousarray(colors[:, :, :3]))
+        if result.shape != (4096, 4096, 3) or result.dtype != np.uint8:
+            raise ValueError("A ColorLUT function must return a 3-channel uint8 image of the input's size")
+        return cls(_pack(result).reshape(-1))
+
+    def then(self, other):
+        """The transform of ``self`` followed by ``other``, as one table"""
+        return ColorLUT(np.take(other.table, self.table))
+
+    def apply(self, img):
+        """Transform a 3-channel uint8 image (BGRA keeps its alpha, grayscale becomes BGR)"""
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        alpha = img[:, :, 3] if img.shape[2] == 4 else None
+        if alpha is not None:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        result = np.take(self.table, _pack(img)).view(np.uint8).reshape(img.shape[:2] + (4,))
+        if alpha is not None:
+            result[:, :, 3] = alpha
+            return result
+        return cv2.cvtColor(result, cv2.COLOR_BGRA2BGR)
+
+    __call__ = apply
+
+
+_builders = {}
+_preload = []
+_fingerprints = {}
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def register_lut(name, fn, preload=False):
+    """Make the per-pixel operation ``fn(img) -> img`` available as get_lut(name);
+    ``preload`` tables are built by preload_luts(), e.g. before forking workers"""
+    _builders[name] = fn
+    _fingerprints.pop(name, None)
+    if preload and name not in _preload:
+        _preload.append(name)
+
+
+def _fingerprint(name):
+    # What the function does to a fixed sample of colors, so a saved table
+    # is not reused after the function changes
+    if name not in _fingerprints:
+        sample = np.random.default_rng(0).integers(0, 256, (256, 256, 3), np.uint8)
+        _fingerprints[name] = hashlib.blake2b(_builders[name](sample).tobytes(), digest_size=8).hexdigest()
+    return _fingerprints[name]
+
+
+def _stored(name, fingerprint, build):
+    """The table saved for ``fingerprint``, memory-mapped; built and saved first if missing"""
+    if not LUT_DIR:
+        return build()
+    path = os.path.join(LUT_DIR, f'{name}-{fingerprint}.npy')
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    table = build()
+    try:
+        os.makedirs(LUT_DIR, exist_ok=True)
+        # Written then renamed, so other processes never map a partial table
+        fd, temp_path = tempfile.mkstemp(dir=LUT_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, table)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return np.load(path, mmap_mode='r')
+    except OSError:
+        # E.g. a read-only directory: this process keeps its own copy
+        return table
+
+
+def get_lut(name):
+    """The ColorLUT registered as ``name``, tabulated on first use (about 0.5 s)
+    or mapped from LUT_DIR when any process has built it before.
+
+    ``"a+b"`` chains up to MAX_CHAIN registered tables, applying ``a``
+    first. Only registered tables are saved: a chain is composed from them
+    in memory (about 0.1 s per table), as there is no end to the chains
+    clients can ask for.
+    """
+    with _tables_lock:
+        lut = _tables.get(name)
+        if lut is not None:
+            _tables.move_to_end(name)
+            return lut
+    parts = name.split('+')
+    if len(parts) > MAX_CHAIN:
+        raise ValueError(f"Color LUT chains are limited to {MAX_CHAIN} tables")
+    for part in parts:
+        if part not in _builders:
+            raise ValueError(f"Unknown color LUT '{part}'")
+
+    if len(parts) == 1:
+        lut = ColorLUT(_stored(name, _fingerprint(name), lambda: ColorLUT.from_function(_builders[name]).table))
+    else:
+        lut = get_lut(parts[0])
+        for part in parts[1:]:
+            lut = lut.then(get_lut(part))
+    with _tables_lock:
+        lut = _tables.setdefault(name, lut)
+        while len(_tables) > max(1, LUT_CACHE_SIZE):
+            _tables.popitem(last=False)
+    return lut
+
+
+def preload_luts():
+    """Build (or map) the tables registered with ``preload`` now, e.g. in a
+    pre-fork server's master, so workers neither build nor copy them"""
+    for name in _preload:
+        get_lut(name)
+
+
+def _curves(b, g, r):
+    """Per-channel tone curves as one BGR operation"""
+    table = np.stack([b, g, r], axis=-1).reshape(256, 1, 3)
+    table = np.clip(np.round(table), 0, 255).astype(np.uint8)
+    return lambda img: cv2.LUT(img, table)
+
+
+def _saturation(amount):
+    def fn(img):
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        cv2.add(hsv, (0, amount, 0, 0), dst=hsv)
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    return fn
+
+
+def _sepia(img):
+    # Rows give B, G, R from B, G, R
+    kernel = np.array([[0.131, 0.534, 0.272], [0.168, 0.686, 0.349], [0.189, 0.769, 0.393]])
+    return cv2.transform(img, kernel)
+
+
+def _mono(img):
+    return cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+
+
+def _s_curve(levels, width=48.0):
+    # Logistic curve rescaled so 0 and 255 stay put
+    curve = 1 / (1 + np.exp(-(levels - 127.5) / width))
+    return (curve - curve[0]) / (curve[-1] - curve[0]) * 255
+
+
+_levels = np.arange(256, dtype=np.float64)
+# Color grading presets for the 'color_grade' stage; combine them with '+', e.g. "warm+vivid"
+PRESETS = {
+    'vivid': _saturation(30),
+    'muted': lambda img: cv2.addWeighted(img, 0.7, _mono(img), 0.3, 0),
+    'warm': _curves(_levels * 0.92, _levels, _levels * 1.08 + 4),
+    'cool': _curves(_levels * 1.08 + 4, _levels, _levels * 0.92),
+    'fade': _curves(*[_levels * 0.85 + 28] * 3),
+    'contrast': _curves(*[_s_curve(_levels)] * 3),
+    'sepia': _sepia,
+    'mono': _mono,
+}
+for _name, _fn in PRESETS.items():
+    register_lut(_name, _fn)
+
+
+def grade(img, preset='vivid'):
+    """Apply a color grading preset, or an ``"a+b"`` chain of them (the pipeline stage).
+
+    A chain is applied as one lookup in its composed table, so it costs the
+    same per pixel however many presets it has; a single preset's own
+    operations are cheaper than the lookup and run directly.
+    """
+    parts = preset.split('+')
+    if len(parts) > MAX_CHAIN:
+        raise ValueError(f"Color grading chains are limited to {MAX_CHAIN} presets")
+    for part in parts:
+        if part not in PRESETS:
+            raise ValueError(f"Unknown color grading preset '{part}'")
+    if len(parts) == 1:
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if img.shape[2] == 4:
+            result = PRESETS[preset](cv2.cvtColor(img, cv2.COLOR_BGRA2BGR))
+            return cv2.merge([*cv2.split(result), img[:, :, 3]])
+        return PRESETS[preset](img)
+    return get_lut(preset).apply(img)
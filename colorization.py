@@ -1,29 +1,203 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import cv2
 import numpy as np
 from pathlib import Path
+from model_registry import registry
+from guided_filter import guided_upsample
+from image_io import decode_image
+from metrics import timed
+
+MODEL_DIR = Path('./models')
+
+
+def _load_colorization_net():
+    """Read the Caffe colorization net and patch in the cluster centers"""
+    net = cv2.dnn.readNetFromCaffe(
+        str(MODEL_DIR/'colorization_deploy_v2.prototxt'),
+        str(MODEL_DIR/'colorization_release_v2.caffemodel')
+    )
+
+    # Configure colorization layers
+    pts = np.load(MODEL_DIR/'pts_in_hull.npy')
+    class8 = net.getLayerId('class8_ab')
+    conv8 = net.getLayerId('conv8_313_rh')
+    pts = pts.transpose().reshape(2, 313, 1, 1)
+    net.getLayer(class8).blobs = [pts.astype(np.float32)]
+    net.getLayer(conv8).blobs = [np.full([1, 313], 2.606, dtype=np.float32)]
+    return net
+
+
+# One pool per process; a net is only read from disk the first time it is needed
+registry.register(
+    'colorization',
+    _load_colorization_net,
+    pool_size=int(os.environ.get('COLORIZATION_POOL_SIZE', 2)),
+)
+
+# Images per forward() call for batch colorization
+DEFAULT_BATCH_SIZE = int(os.environ.get('COLORIZATION_BATCH_SIZE', 8))
+# How long the microbatcher holds a request waiting for company
+DEFAULT_MAX_WAIT_MS = float(os.environ.get('COLORIZATION_MAX_WAIT_MS', 10))
+
+NET_INPUT_SIZE = (224, 224)
+
+# Pre/postprocessing per quality: (search window of the L-only denoising at
+# full resolution, or 0 to denoise only the net's 224x224 input; scale of the
+# detailEnhance pass, or None to skip it). 'full' denoises all channels with
+# a 21px search window and runs detailEnhance at full resolution. The reduced
+# tiers upsample the predicted ab guided by the full-resolution L channel.
+# Measured against 'full' with benchmarks/colorization_quality.py, see the README.
+QUALITY_MODES = {
+    'full': None,
+    'balanced': (7, 0.5),
+    'fast': (0, 0.25),
+}
+DEFAULT_QUALITY = 'full'
+# Guided ab upsampling: how strong an L edge (squared L units, 0-100 scale)
+# must be before colours may change across it
+AB_GUIDE_EPS = 4.0
+
+
+def forward_batch(l_channels, batch_size=DEFAULT_BATCH_SIZE):
+    """Run the colorization net on several L channels.
+
+    The resized L channels are stacked into one NCHW blob so each group of
+    ``batch_size`` images costs a single ``forward()``. Returns the predicted
+    ab channels (net resolution, HxWx2) in input order.
+    """
+    batch_size = max(1, int(batch_size))
+    results = []
+    for start in range(0, len(l_channels), batch_size):
+        chunk = []
+        for l_channel in l_channels[start:start + batch_size]:
+            l_rs = cv2.resize(l_channel, NET_INPUT_SIZE)
+            l_rs -= 50
+            chunk.append(l_rs)
+
+        with registry.acquire('colorization') as net, timed('colorization', 'forward'):
+            net.setInput(cv2.dnn.blobFromImages(chunk))
+            ab_batch = net.forward()
+
+        results.extend(ab_batch[i].transpose((1, 2, 0)) for i in range(len(chunk)))
+    return results
+
+
+class ColorizationBatcher:
+    """Group concurrent single-image requests into shared forward passes.
+
+    Callers hand in an L channel and block until its ab prediction is ready.
+    A background thread collects up to ``batch_size`` pending requests,
+    waiting at most ``max_wait_ms`` after the first one arrives, and runs
+    them through :func:`forward_batch` together. There is one such thread
+    per net in the pool (COLORIZATION_POOL_SIZE), so every net is used.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, workers=None):
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+        self.workers = workers or registry.get('colorization').size
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.batches = 0
+        self.images = 0
+
+    def _ensure_worker(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name=f'colorization-batcher-{len(self._threads)}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, l_channel):
+        """Queue one L channel; returns a Future resolving to its ab channels"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((l_channel, future))
+        return future
+
+    def forward(self, l_channel, timeout=None):
+        return self.submit(l_channel).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            batch = [(l, f) for l, f in batch if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                ab_list = forward_batch([l for l, _ in batch], self.batch_size)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.batches += 1
+                self.images += len(batch)
+            for (_, future), ab_dec in zip(batch, ab_list):
+                future.set_result(ab_dec)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'batches': self.batches,
+            'images': self.images,
+            'mean_batch_size': round(self.images / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """Process-wide microbatcher shared by the web endpoints"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = ColorizationBatcher()
+        return _batcher
+
+
+def colorize(img, quality=DEFAULT_QUALITY):
+    """Colorize a decoded BGR image through the shared microbatcher"""
+    return Colorization(None, batcher=get_batcher(), quality=quality).apply(img)
+
 
 class Colorization:
-    def __init__(self, fileobject):
+    def __init__(self, fileobject, batcher=None, quality=DEFAULT_QUALITY):
+        if quality not in QUALITY_MODES:
+            raise ValueError(f"Unknown colorization quality '{quality}'")
         self.fileobject = fileobject
+        self.batcher = batcher
+        self.quality = quality
+        self.l_net = None
         self._load_models()
         
     def _load_models(self):
-        """Load colorization and denoising models"""
-        model_dir = Path('./models')
-        
-        # Colorization model
-        self.color_net = cv2.dnn.readNetFromCaffe(
-            str(model_dir/'colorization_deploy_v2.prototxt'),
-            str(model_dir/'colorization_release_v2.caffemodel')
-        )
-        
-        # Configure colorization layers
-        pts = np.load(model_dir/'pts_in_hull.npy')
-        class8 = self.color_net.getLayerId('class8_ab')
-        conv8 = self.color_net.getLayerId('conv8_313_rh')
-        pts = pts.transpose().reshape(2, 313, 1, 1)
-        self.color_net.getLayer(class8).blobs = [pts.astype(np.float32)]
-        self.color_net.getLayer(conv8).blobs = [np.full([1, 313], 2.606, dtype=np.float32)]
+        """Attach the shared colorization nets and denoising settings"""
+        # Colorization model (loaded lazily and reused across requests)
+        self.color_nets = registry.get('colorization')
         
         # Denoising model (using OpenCV's fastNlMeansDenoisingColored)
         self.denoise_params = {
@@ -33,24 +207,18 @@ class Colorization:
             'searchWindowSize': 21
         }
 
-    def _preprocess_image(self):
-        """Read and preprocess with noise reduction"""
-        self.fileobject.seek(0)
-        file_bytes = np.asarray(bytearray(self.fileobject.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            raise ValueError("Could not decode image")
-            
-        # Step 1: Initial denoising
-        denoised = cv2.fastNlMeansDenoisingColored(
-            img, 
-            None,
-            self.denoise_params['h'],
-            self.denoise_params['hColor'],
-            self.denoise_params['templateWindowSize'],
-            self.denoise_params['searchWindowSize']
-        )
+    def _enhance(self, img, denoised=None):
+        """Denoise and contrast-enhance; returns (enhanced BGR, float L channel)"""
+        # Step 1: Initial denoising (unless already done)
+        if denoised is None:
+            denoised = cv2.fastNlMeansDenoisingColored(
+                img, 
+                None,
+                self.denoise_params['h'],
+                self.denoise_params['hColor'],
+                self.denoise_params['templateWindowSize'],
+                self.denoise_params['searchWindowSize']
+            )
         
         # Step 2: Contrast enhancement (CLAHE)
         lab = cv2.cvtColor(denoised, cv2.COLOR_BGR2LAB)
@@ -63,32 +231,135 @@ class Colorization:
         # Convert to float32 for colorization
         img_rgb = (enhanced[:, :, [2, 1, 0]] / 255.0).astype(np.float32)
         img_lab = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2Lab)
-        self.l_channel = img_lab[:, :, 0]
-        
+        return enhanced, img_lab[:, :, 0]
+
+    def _denoise_luma(self, img, search_window):
+        """Step 1 with only the lightness denoised, in the same (linear) Lab
+        space fastNlMeansDenoisingColored works in"""
+        lab = cv2.cvtColor(img, cv2.COLOR_LBGR2Lab)
+        lab[:, :, 0] = cv2.fastNlMeansDenoising(lab[:, :, 0], None, self.denoise_params['h'],
+                                                self.denoise_params['templateWindowSize'], search_window)
+        return cv2.cvtColor(lab, cv2.COLOR_Lab2LBGR)
+
+    def _enhance_fast(self, img):
+        """Contrast-enhance L only and denoise just the net's input; returns
+        (full-resolution L, net-sized L)"""
+        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+        l = clahe.apply(lab[:, :, 0])
+
+        # Denoising 224x224 pixels costs next to nothing
+        l_net = cv2.resize(l, NET_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+        l_net = cv2.fastNlMeansDenoising(l_net, None, self.denoise_params['h'],
+                                         self.denoise_params['templateWindowSize'],
+                                         self.denoise_params['searchWindowSize'])
+        # 8-bit Lab stores L scaled to 0-255
+        return l.astype(np.float32) * (100.0 / 255.0), l_net.astype(np.float32) * (100.0 / 255.0)
+
+    def _prepare(self, img):
+        """(enhanced BGR or None, full-resolution L, L for the net) at this quality"""
+        mode = QUALITY_MODES[self.quality]
+        if mode is None:
+            enhanced, l_channel = self._enhance(img)
+            return enhanced, l_channel, l_channel
+        search_window = mode[0]
+        if not search_window:
+            return (None,) + self._enhance_fast(img)
+        enhanced, l_channel = self._enhance(img, self._denoise_luma(img, search_window))
+        return enhanced, l_channel, cv2.resize(l_channel, NET_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+
+    def _preprocess_image(self):
+        """Read and preprocess with noise reduction"""
+        img = decode_image(self.fileobject)
+        enhanced, self.l_channel, self.l_net = self._prepare(img)
         return enhanced
 
-    def _colorize_image(self, enhanced_img):
-        """Perform enhanced colorization"""
-        # Resize and prepare input
-        l_rs = cv2.resize(self.l_channel, (224, 224))
-        l_rs -= 50
-        
-        # Colorization
-        self.color_net.setInput(cv2.dnn.blobFromImage(l_rs))
-        ab_dec = self.color_net.forward()[0, :, :, :].transpose((1, 2, 0))
-        ab_dec_us = cv2.resize(ab_dec, (self.l_channel.shape[1], self.l_channel.shape[0]))
+    @staticmethod
+    def _postprocess(l_channel, ab_dec, quality=DEFAULT_QUALITY, l_net=None):
+        """Upsample predicted ab to the L channel's size and build the final image"""
+        mode = QUALITY_MODES[quality]
+        if mode is None:
+            ab_dec_us = cv2.resize(ab_dec, (l_channel.shape[1], l_channel.shape[0]))
+        else:
+            # Fit ab to the net-sized L, then apply the fit to the full L so
+            # colours stop at the edges of the full-resolution image
+            if l_net is None:
+                l_net = cv2.resize(l_channel, NET_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+            l_low = cv2.resize(l_net, (ab_dec.shape[1], ab_dec.shape[0]), interpolation=cv2.INTER_AREA)
+            ab_dec_us = guided_upsample(l_channel, l_low, ab_dec, radius=2, eps=AB_GUIDE_EPS, value_range=None)
         
         # Combine with original luminance
-        lab_out = np.concatenate((self.l_channel[:, :, np.newaxis], ab_dec_us), axis=2)
+        lab_out = np.concatenate((l_channel[:, :, np.newaxis], ab_dec_us), axis=2)
         bgr_out = cv2.cvtColor(lab_out.astype(np.float32), cv2.COLOR_Lab2BGR)
         
         # Post-processing: Blend with denoised image
         colorized = np.clip(bgr_out * 255, 0, 255).astype(np.uint8)
         
         # Edge-preserving smoothing
-        final = cv2.detailEnhance(colorized, sigma_s=10, sigma_r=0.15)
-        
-        return final
+        if mode is None:
+            return cv2.detailEnhance(colorized, sigma_s=10, sigma_r=0.15)
+        scale = mode[1]
+        if scale is None:
+            return colorized
+        # Reduced: enhance a downscaled copy and bring it back guided by the full image
+        size = (max(1, round(colorized.shape[1] * scale)), max(1, round(colorized.shape[0] * scale)))
+        small = cv2.resize(colorized, size, interpolation=cv2.INTER_AREA)
+        detailed = cv2.detailEnhance(small, sigma_s=10 * scale, sigma_r=0.15)
+        return guided_upsample(colorized, small, detailed, radius=1, eps=100.0)
+
+    @staticmethod
+    def _check(colorized):
+        # Final quality check
+        if colorized.mean() < 10 or colorized.mean() > 245:
+            raise RuntimeError("Colorization failed - extreme pixel values detected")
+
+    def _colorize_image(self, enhanced_img):
+        """Perform enhanced colorization"""
+        l_net = self.l_channel if self.l_net is None else self.l_net
+        if self.batcher is not None:
+            ab_dec = self.batcher.forward(l_net)
+        else:
+            ab_dec = forward_batch([l_net])[0]
+        with timed('colorization', 'postprocess', self.l_channel):
+            return self._postprocess(self.l_channel, ab_dec, self.quality, l_net)
+
+    def apply(self, img):
+        """Colorize a decoded BGR image at this instance's quality and return the result"""
+        with timed('colorization', 'enhance', img):
+            enhanced_img, self.l_channel, self.l_net = self._prepare(img)
+        colorized = self._colorize_image(enhanced_img)
+        self._check(colorized)
+        return colorized
+
+    @classmethod
+    def convert_many(cls, fileobjects, batch_size=DEFAULT_BATCH_SIZE, quality=DEFAULT_QUALITY):
+        """Colorize many uploads, one forward() per ``batch_size`` images.
+
+        Returns the colorized BGR images in input order. Images are
+        preprocessed one batch at a time so only ``batch_size`` full-size
+        intermediates are alive at once.
+        """
+        colorizer = cls(None, quality=quality)
+        batch_size = max(1, int(batch_size))
+        results = []
+        for start in range(0, len(fileobjects), batch_size):
+            l_channels = []
+            l_nets = []
+            for fileobject in fileobjects[start:start + batch_size]:
+                _, l_channel, l_net = colorizer._prepare(decode_image(fileobject))
+                l_channels.append(l_channel)
+                l_nets.append(l_net)
+
+            for offset, (l_channel, l_net, ab_dec) in enumerate(
+                zip(l_channels, l_nets, forward_batch(l_nets, batch_size))
+            ):
+                colorized = cls._postprocess(l_channel, ab_dec, quality, l_net)
+                try:
+                    cls._check(colorized)
+                except RuntimeError as e:
+                    raise RuntimeError(f"Image {start + offset}: {e}") from None
+                results.append(colorized)
+        return results
 
     def convert(self, filename):
         """Enhanced colorization pipeline"""
@@ -99,9 +370,7 @@ class Colorization:
             # Colorize
             colorized = self._colorize_image(enhanced_img)
             
-            # Final quality check
-            if colorized.mean() < 10 or colorized.mean() > 245:
-                raise RuntimeError("Colorization failed - extreme pixel values detected")
+            self._check(colorized)
                 
             # Save result
             if not cv2.imwrite(filename, colorized):
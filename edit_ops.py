@@ -0,0 +1,244 @@
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+from image_io import REDUCED_FLAGS, InvalidImage, decode_image, guess_mimetype, image_size, read_bytes
+
+# Geometric steps that pipelines compose into one transform instead of running them one by one
+EDIT_OPS = {
+    'crop': {'x', 'y', 'width', 'height'},
+    'rotate': {'angle', 'expand'},
+    'flip': {'axis'},
+    'resize': {'width', 'height', 'scale'},
+}
+FLIP_AXES = {'horizontal': (True, False), 'vertical': (False, True), 'both': (True, True)}
+# Largest side an edit may produce
+MAX_EDIT_SIDE = int(os.environ.get('EDIT_MAX_SIDE', 16384))
+_EPS = 1e-9
+
+
+def _translate(x, y):
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+
+def _scale(sx, sy):
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
+
+# Each step maps pixel edge coordinates ([0, width] x [0, height]) of its
+# input to those of its output; returns (3x3 matrix, output size)
+
+def _crop(size, x=0, y=0, width=None, height=None):
+    w, h = size
+    x0, y0 = max(0, round(x)), max(0, round(y))
+    x1 = min(w, round(x + width) if width is not None else w)
+    y1 = min(h, round(y + height) if height is not None else h)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("The crop box is outside the image")
+    return _translate(-x0, -y0), (x1 - x0, y1 - y0)
+
+
+def _rotate(size, angle=0, expand=1):
+    """Clockwise by ``angle`` degrees about the center; ``expand`` grows the
+    canvas to hold the whole image, otherwise the corners are cut off"""
+    w, h = size
+    angle = angle % 360
+    if angle % 90 == 0:
+        # Exact, so quarter turns stay pure transposes
+        cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(angle) // 90]
+    else:
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    # Clockwise on screen, where y points down
+    rotation = np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]], dtype=np.float64)
+    if expand:
+        new_size = (math.ceil(abs(w * cos) + abs(h * sin) - 1e-6), math.ceil(abs(w * sin) + abs(h * cos) - 1e-6))
+    else:
+        new_size = (w, h)
+    return _translate(new_size[0] / 2, new_size[1] / 2) @ rotation @ _translate(-w / 2, -h / 2), new_size
+
+
+def _flip(size, axis='horizontal'):
+    w, h = size
+    flip_x, flip_y = FLIP_AXES[axis]
+    return _translate(w if flip_x else 0, h if flip_y else 0) @ _scale(-1 if flip_x else 1, -1 if flip_y else 1), size
+
+
+def _resize(size, width=None, height=None, scale=None):
+    """To ``width`` x ``height``; given one of them (or ``scale``) the aspect ratio is kept"""
+    w, h = size
+    if scale is not None:
+        width, height = w * scale, h * scale
+    elif width is None:
+        width = w * height / h
+    elif height is None:
+        height = h * width / w
+    new_size = (max(1, round(width)), max(1, round(height)))
+    return _scale(new_size[0] / w, new_size[1] / h), new_size
+
+
+STEPS = {'crop': _crop, 'rotate': _rotate, 'flip': _flip, 'resize': _resize}
+
+
+def _orient(img, linear):
+    """Apply the flip, quarter turn or transpose whose signs ``linear`` has, in one pass"""
+    if abs(linear[0, 1]) < _EPS:
+        flip_x, flip_y = linear[0, 0] < 0, linear[1, 1] < 0
+        if flip_x or flip_y:
+            return cv2.flip(img, -1 if flip_x and flip_y else 1 if flip_x else 0)
+        return np.ascontiguousarray(img)
+    # Output x follows source y and output y follows source x
+    signs = (linear[0, 1] > 0, linear[1, 0] > 0)
+    if signs == (True, True):
+        return cv2.transpose(img)
+    if signs == (False, True):
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if signs == (True, False):
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return cv2.flip(cv2.transpose(img), -1)
+
+
+def warp(img, matrix, size):
+    """Map ``img`` to a ``size`` (width, height) image through ``matrix`` (pixel edge
+    coordinates, see EditPlan.transform).
+
+    Crops, flips, quarter turns and axis-aligned scaling are a slice of the
+    source, at most one resize (on the smaller side of it) and one
+    flip/rotate/transpose; anything else is a single warpAffine pass.
+    """
+    width, height = size
+    linear = matrix[:2, :2]
+    if max(abs(linear[0, 1]), abs(linear[1, 0])) < _EPS or max(abs(linear[0, 0]), abs(linear[1, 1])) < _EPS:
+        # The source rectangle the output covers
+        inverse = np.linalg.inv(matrix)
+        corners = inverse @ np.array([[0, width], [0, height], [1, 1]], dtype=np.float64)
+        x0, x1 = sorted(corners[0])
+        y0, y1 = sorted(corners[1])
+        box = np.round([x0, y0, x1, y1])
+        if np.allclose(box, [x0, y0, x1, y1], atol=1e-6) and box[0] >= 0 and box[1] >= 0 \
+                and box[2] <= img.shape[1] and box[3] <= img.shape[0]:
+            x0, y0, x1, y1 = box.astype(int)
+            region = img[y0:y1, x0:x1]
+            swapped = abs(linear[0, 0]) < _EPS
+            target = (height, width) if swapped else (width, height)
+            if target != (x1 - x0, y1 - y0):
+                shrink = target[0] <= x1 - x0 and target[1] <= y1 - y0
+                region = cv2.resize(region, target, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+            return _orient(region, linear)
+    # OpenCV puts pixel centers at integer coordinates
+    centers = _translate(-0.5, -0.5) @ matrix @ _translate(0.5, 0.5)
+    return cv2.warpAffine(img, centers[:2], (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+
+class EditPlan:
+    """Crop, rotate, flip and resize steps, composed into one transform.
+
+    The steps are ``(name, params)`` pairs as in a pipeline spec; they are
+    turned into a single matrix once the source size is known, and applied
+    with warp(), so no intermediate full-size image is made per step.
+    """
+
+    def __init__(self, ops):
+        self.ops = []
+        for item in ops:
+            name, params = (item, {}) if isinstance(item, str) else item
+            if name not in EDIT_OPS:
+                raise ValueError(f"Unknown edit '{name}'")
+            unknown = set(params) - EDIT_OPS[name]
+            if unknown:
+                raise ValueError(f"Unknown {name} settings: {', '.join(sorted(unknown))}")
+            for key, value in params.items():
+                if key != 'axis' and not isinstance(value, (int, float)):
+                    raise ValueError(f"The {name} setting '{key}' must be a number")
+            if name == 'flip' and params.get('axis', 'horizontal') not in FLIP_AXES:
+                raise ValueError(f"Flip axis must be one of {', '.join(FLIP_AXES)}")
+            if name == 'resize' and not params:
+                raise ValueError("Resize needs a width, height or scale")
+            if name in ('crop', 'resize') and any(params.get(key, 1) <= 0 for key in ('width', 'height', 'scale')):
+                raise ValueError(f"The {name} size must be positive")
+            self.ops.append((name, dict(params)))
+
+    def transform(self, size, max_side=None):
+        """(3x3 matrix from source to output pixel edge coordinates, output
+        (width, height)) for a ``size`` (width, height) source; with
+        ``max_side`` the output is scaled down to fit within it"""
+        matrix = np.eye(3)
+        for name, params in self.ops:
+            step, size = STEPS[name](size, **params)
+            matrix = step @ matrix
+        if max_side and max(size) > max_side:
+            step, size = _resize(size, scale=max_side / max(size))
+            matrix = step @ matrix
+        if max(size) > MAX_EDIT_SIDE:
+            raise ValueError(f"Edited images are limited to {MAX_EDIT_SIDE} pixels a side")
+        return matrix, size
+
+    def apply(self, img, max_side=None):
+        """The edited copy of a decoded image"""
+        return warp(img, *self.transform((img.shape[1], img.shape[0]), max_side))
+
+    def decode(self, source, flags=cv2.IMREAD_COLOR, max_side=None):
+        """Decode an upload (bytes or file object) straight to the edited image.
+
+        The plan is worked out from the header's size first, so a JPEG that
+        ends up at half its size or less is decoded at 1/2, 1/4 or 1/8 scale.
+        """
+        data = read_bytes(source)
+        if flags == cv2.IMREAD_UNCHANGED and guess_mimetype(data) == 'image/jpeg':
+            # No alpha to keep, and this way the EXIF orientation is applied
+            flags = cv2.IMREAD_COLOR
+        try:
+            size = image_size(data, flags)
+        except InvalidImage:
+            # A format the header reader does not know
+            return self.apply(decode_image(data, flags), max_side)
+        matrix, out_size = self.transform(size, max_side)
+        if flags in REDUCED_FLAGS and guess_mimetype(data) == 'image/jpeg':
+            # Largest factor any source axis is scaled by
+            largest = np.linalg.svd(matrix[:2, :2], compute_uv=False)[0]
+            for factor in (8, 4, 2):
+                if largest * factor <= 1:
+                    flags = REDUCED_FLAGS[flags][factor]
+                    # Pixel i of the reduced image covers pixels i*factor..(i+1)*factor-1
+                    matrix = matrix @ _scale(factor, factor)
+                    break
+        return warp(decode_image(data, flags), matrix, out_size)
+
+
+def group_edits(stages):
+    """``stages`` with every run of consecutive edit steps replaced by one EditPlan"""
+    grouped = []
+    for item in stages:
+        name = item if isinstance(item, str) else item[0]
+        if name not in EDIT_OPS:
+            grouped.append(item)
+        elif grouped and isinstance(grouped[-1], EditPlan):
+            grouped[-1] = EditPlan(grouped[-1].ops + [item])
+        else:
+            grouped.append(EditPlan([item]))
+    return grouped
+
+
+def parse_ops(spec):
+    """Edit steps as (name, params) pairs, from a JSON list like
+    ``[{"op": "rotate", "angle": 90}, {"op": "crop", "x": 10, ...}]`` or the
+    pipeline syntax, ``"rotate:angle=90,crop:x=10;y=20;width=300;height=200"``"""
+    from effect_pipeline import parse_stages
+    spec = (spec or '').strip()
+    if spec.startswith('['):
+        try:
+            items = json.loads(spec)
+        except ValueError:
+            raise ValueError("Edits must be a JSON list")
+        ops = []
+        for item in items:
+            if not isinstance(item, dict) or 'op' not in item:
+                raise ValueError('Each edit needs an "op"')
+            params = dict(item)
+            ops.append((params.pop('op'), params))
+    else:
+        ops = parse_stages(spec)
+    # Validates every step
+    return EditPlan(ops).ops
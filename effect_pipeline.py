@@ -0,0 +1,226 @@
+import importlib
+
+import cv2
+import numpy as np
+
+from edit_ops import EditPlan, group_edits
+from metrics import timed
+from image_io import MIMETYPES, decode_image, decode_reduced, encode_image, to_8bit
+from image_compression import FORMATS as COMPRESSION_FORMATS, OPTIMIZE_OPTIONS, ImageCompression
+
+
+def _resolve(path):
+    """Import ``'module:attribute.path'`` and return the object it names"""
+    module_name, _, attribute = path.partition(':')
+    obj = importlib.import_module(module_name)
+    for name in attribute.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+class Stage:
+    """An effect step that takes a decoded image and returns a new one.
+
+    Stages see BGR images. A stage registered with ``alpha=True`` also
+    accepts BGRA/grayscale input; for the others the pipeline strips the
+    alpha channel before the stage and puts it back afterwards.
+
+    ``fn`` may be a ``'module:attribute'`` path instead of a callable; the
+    module (and whatever it imports, e.g. an ML runtime) is then loaded on
+    the stage's first use.
+    """
+
+    def __init__(self, name, fn, alpha=False):
+        self.name = name
+        self._fn = fn
+        self.alpha = alpha
+
+    @property
+    def fn(self):
+        if isinstance(self._fn, str):
+            self._fn = _resolve(self._fn)
+        return self._fn
+
+    @property
+    def loaded(self):
+        return not isinstance(self._fn, str)
+
+    def __call__(self, img, **params):
+        if self.alpha or img.ndim == 2 or img.shape[2] == 3:
+            return self.fn(img, **params)
+        alpha = img[:, :, 3]
+        result = self.fn(np.ascontiguousarray(img[:, :, :3]), **params)
+        if result.ndim == 3 and result.shape[2] == 3 and result.shape[:2] == alpha.shape:
+            result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
+            result[:, :, 3] = alpha
+        return result
+
+
+STAGES = {}
+
+
+def register_stage(name, fn, alpha=False):
+    """Make ``fn(img, **params) -> img`` available to pipelines as ``name``.
+
+    ``fn`` is a callable or a ``'module:attribute'`` path to import lazily.
+    """
+    STAGES[name] = Stage(name, fn, alpha)
+    return STAGES[name]
+
+
+def load_stages(names=None):
+    """Import the effects behind ``names`` (every stage by default) now,
+    e.g. before forking workers; returns the names loaded"""
+    names = list(STAGES) if names is None else names
+    for name in names:
+        if name not in STAGES:
+            raise ValueError(f"Unknown effect '{name}'")
+        STAGES[name].fn
+    return names
+
+
+# Effect modules are imported on first use, so a process that only sketches
+# never imports the colorization module or rembg's ONNX runtime
+register_stage('sketch', 'img2Sketch:PencilSketch.apply')
+register_stage('cartoon', 'img2Cartoon:Cartoon.apply')
+register_stage('enhancer', 'photo_enhancer:PhotoEnhancer.apply')
+register_stage('oil_painting', 'oil_painting:OilPaintingEffect.apply')
+register_stage('color_grade', 'color_lut:grade', alpha=True)
+register_stage('colorization', 'colorization:colorize')
+register_stage('background_removal', 'background_removal:BackgroundRemoval.apply', alpha=True)
+
+# Not an array stage: selects JPEG output, so it has to come last
+COMPRESSION = 'compression'
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_stages(spec):
+    """Parse ``"enhancer,oil_painting,compression:quality=70"`` into (name, params) pairs.
+
+    Parameters follow the stage name after ``:`` and are separated by ``;``,
+    e.g. ``"sketch:blur_sigma=3;sharpen_value=5"``.
+    """
+    stages = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, param_spec = item.partition(':')
+        params = {}
+        for pair in filter(None, param_spec.split(';')):
+            key, sep, value = pair.partition('=')
+            if not sep:
+                raise ValueError(f"Bad parameter '{pair}' for stage '{name}'")
+            params[key.strip()] = _parse_value(value.strip())
+        stages.append((name.strip(), params))
+    return stages
+
+
+class Pipeline:
+    """Decode once, run a chain of stages on the ndarray, encode once.
+
+    ``stages`` is a list of stage names or ``(name, params)`` pairs. A final
+    ``compression`` stage switches the output to JPEG at its ``quality``; with
+    ``max_bytes``, ``target_ssim``, ``format`` or the other
+    ImageCompression.optimize settings it searches for the quality instead.
+
+    Consecutive ``crop``, ``rotate``, ``flip`` and ``resize`` steps are
+    applied together as one EditPlan; leading ones are applied as the
+    image is decoded (see EditPlan.decode).
+    """
+
+    def __init__(self, stages, output='.png', quality=None):
+        if output not in MIMETYPES:
+            raise ValueError(f"Unsupported output format '{output}'")
+        self.output = output
+        self.quality = quality
+        self.stages = []
+        self.edits = None
+        self.compression = None
+        stages = group_edits(stages)
+        for index, item in enumerate(stages):
+            if isinstance(item, EditPlan):
+                if index == 0:
+                    self.edits = item
+                else:
+                    self.stages.append((Stage('edit', item.apply, alpha=True), {}))
+                continue
+            name, params = (item, {}) if isinstance(item, str) else item
+            if name == COMPRESSION:
+                if index != len(stages) - 1:
+                    raise ValueError("'compression' must be the last stage")
+                self.output = '.jpg'
+                self.quality = params.get('quality', 60)
+                if set(params) - OPTIMIZE_OPTIONS:
+                    raise ValueError(f"Unknown compression settings: {', '.join(sorted(set(params) - OPTIMIZE_OPTIONS))}")
+                if set(params) - {'quality'}:
+                    fmt = params.get('format', 'jpeg')
+                    if fmt not in COMPRESSION_FORMATS:
+                        raise ValueError(f"Unsupported compression format '{fmt}'")
+                    self.output = COMPRESSION_FORMATS[fmt][0]
+                    self.compression = dict(params)
+                continue
+            if name not in STAGES:
+                raise ValueError(f"Unknown effect '{name}'")
+            self.stages.append((STAGES[name], dict(params)))
+
+    @property
+    def name(self):
+        """Effect label for metrics: the stage's name, or 'pipeline' for a chain"""
+        if len(self.stages) == 1 and self.edits is None:
+            return self.stages[0][0].name
+        if not self.stages:
+            return 'edit' if self.edits is not None else COMPRESSION
+        return 'pipeline'
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.output]
+
+    @property
+    def decode_flags(self):
+        # Keep transparency only when the first stage can use it (edits keep it too)
+        if self.stages[0][0].alpha if self.stages else self.edits is not None:
+            return cv2.IMREAD_UNCHANGED
+        return cv2.IMREAD_COLOR
+
+    def run(self, img):
+        for stage, params in self.stages:
+            with timed(stage.name, 'total', img):
+                img = stage(img, **params)
+        return img
+
+    def _encode(self, img):
+        with timed(self.name, 'encode', img):
+            if self.compression is not None:
+                return ImageCompression.optimize(img, **self.compression)[0]
+            return encode_image(img, self.output, self.quality)
+
+    def _decode(self, source, max_side=None):
+        # Leading edits are part of decoding, so their time is counted there
+        with timed(self.name, 'decode') as timer:
+            if self.edits is not None:
+                img = self.edits.decode(source, self.decode_flags, max_side)
+            elif max_side:
+                img = decode_reduced(source, max_side, self.decode_flags)
+            else:
+                img = decode_image(source, self.decode_flags)
+            # 16-bit PNG/TIFF are kept by IMREAD_UNCHANGED; the stages work on 8 bits
+            img = timer.img = to_8bit(img)
+        return img
+
+    def render(self, source):
+        """Decode ``source`` (bytes or file object), apply every stage, return encoded bytes"""
+        return self._encode(self.run(self._decode(source)))
+
+    def preview(self, source, max_side):
+        """Like render(), on a copy decoded at no more than ``max_side`` pixels on the long side"""
+        return self._encode(self.run(self._decode(source, max_side)))
@@ -0,0 +1,173 @@
+import atexit
+import os
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+# Shared memory the job queue may keep for images passed to and from its workers (0: pickle them)
+FRAME_RING_BYTES = int(float(os.environ.get('FRAME_RING_MB', 512)) * 1024 * 1024)
+FRAME_RING_SLOTS = int(os.environ.get('FRAME_RING_SLOTS', 8))
+# Smaller buffers are as cheap to pickle as to copy into a slot
+FRAME_MIN_BYTES = int(os.environ.get('FRAME_MIN_KB', 256)) * 1024
+# Slots grow in steps of this size, so similar images reuse them
+_STEP = 1 << 20
+
+
+class SlotRef(NamedTuple):
+    """All that crosses the pipe for an image in a slot"""
+    slot: int
+    name: str
+    shape: tuple
+    dtype: str
+
+
+class Slot:
+    """One shared-memory segment of a SlotRing, replaced by a bigger one when needed"""
+
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        self.shm = None
+        self.refs = 0
+
+    @property
+    def capacity(self):
+        return self.shm.size if self.shm is not None else 0
+
+    def _resize(self, size):
+        self._unlink()
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    def _unlink(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def ref(self, shape, dtype=np.uint8):
+        return SlotRef(self.index, self.shm.name, tuple(shape), np.dtype(dtype).str)
+
+    def view(self, shape, dtype=np.uint8):
+        """ndarray over the start of the slot (valid until the slot is released)"""
+        return np.ndarray(shape, dtype, buffer=self.shm.buf)
+
+    def retain(self):
+        with self.ring._lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        self.ring._release(self)
+
+
+class SlotRing:
+    """Reusable shared-memory slots for handing images to worker processes.
+
+    The image is copied into a slot once and only its SlotRef (slot, segment
+    name, shape, dtype) is pickled; the worker maps the segment and reads it
+    in place. Slots are created and unlinked by this process alone. A slot
+    is handed out with one reference and goes back to the ring when the last
+    one is released, so holders release in a ``finally`` or future callback
+    and a worker that dies mid-job cannot leak it. Free slots are reused
+    oldest first; a slot too small for the next image is replaced by a
+    bigger segment while the total stays within ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=FRAME_RING_BYTES, slots=FRAME_RING_SLOTS):
+        self.max_bytes = max_bytes
+        self._slots = [Slot(self, i) for i in range(slots)]
+        self._free = deque(self._slots)
+        self._lock = threading.Lock()
+        self.handed = 0
+        self.grown = 0
+        self.fallbacks = 0
+        atexit.register(self.close)
+
+    @property
+    def allocated(self):
+        return sum(slot.capacity for slot in self._slots)
+
+    def acquire(self, nbytes):
+        """A free slot of at least ``nbytes``, or None when every slot is in use
+        or growing one would exceed ``max_bytes`` (the caller then pickles)"""
+        with self._lock:
+            fits = [slot for slot in self._free if slot.capacity >= nbytes]
+            if fits:
+                slot = min(fits, key=lambda slot: slot.capacity)
+            elif self._free:
+                # Grow the slot that has been free longest
+                slot = self._free[0]
+                size = -(-nbytes // _STEP) * _STEP
+                if self.allocated - slot.capacity + size > self.max_bytes:
+                    self.fallbacks += 1
+                    return None
+                slot._resize(size)
+                self.grown += 1
+            else:
+                self.fallbacks += 1
+                return None
+            self._free.remove(slot)
+            slot.refs = 1
+            self.handed += 1
+            return slot
+
+    def put(self, data):
+        """A slot holding a copy of ``data`` (an ndarray or bytes-like), or None"""
+        array = data if isinstance(data, np.ndarray) else np.frombuffer(data, np.uint8)
+        slot = self.acquire(array.nbytes)
+        if slot is not None:
+            slot.view(array.shape, array.dtype)[...] = array
+        return slot
+
+    def _release(self, slot):
+        with self._lock:
+            slot.refs -= 1
+            if slot.refs == 0 and slot not in self._free:
+                self._free.append(slot)
+            elif slot.refs < 0:
+                slot.refs = 0
+                raise RuntimeError(f"Slot {slot.index} released more often than acquired")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': len(self._slots),
+                'in_use': len(self._slots) - len(self._free),
+                'allocated_mb': round(self.allocated / 1024 / 1024, 1),
+                'max_mb': round(self.max_bytes / 1024 / 1024, 1),
+                'handed': self.handed,
+                'grown': self.grown,
+                'fallbacks': self.fallbacks,
+            }
+
+    def close(self):
+        """Unlink every segment; slots still in use are unlinked too (their
+        memory stays mapped in processes that have it open)"""
+        with self._lock:
+            for slot in self._slots:
+                slot._unlink()
+            self._free = deque(self._slots)
+        atexit.unregister(self.close)
+
+
+# Segments mapped by this worker process, by slot index. Kept open between
+# jobs so a reused slot is not mapped (and page-faulted in) again.
+_attached = {}
+
+
+def attach(ref):
+    """ndarray over the slot ``ref`` points to, in a worker process"""
+    shm = _attached.get(ref.slot)
+    if shm is None or shm.name != ref.name:
+        if shm is not None:
+            # The ring replaced this slot with a bigger segment
+            try:
+                shm.close()
+            except BufferError:
+                # A view of it is still alive; the mapping goes with it
+                pass
+        shm = _attached[ref.slot] = shared_memory.SharedMemory(ref.name)
+    return np.ndarray(ref.shape, ref.dtype, buffer=shm.buf)
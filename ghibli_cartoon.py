@@ -1,18 +1,267 @@
-from diffusers import DiffusionPipeline
-import torch
+import hashlib
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+import numpy as np
 from PIL import Image
+from metrics import timed
+from model_registry import registry
+from result_cache import ResultCache, make_key
+
+# FLUX.1-dev diffusion pipeline with a Ghibli-style LoRA from Hugging Face
+MODEL_ID = os.environ.get('GHIBLI_MODEL', 'black-forest-labs/FLUX.1-dev')
+LORA_ID = os.environ.get('GHIBLI_LORA', 'strangerzonehf/Ghibli-Flux-Cartoon-LoRA')
+# 'stub' draws placeholder images instead of running the model, e.g. offline
+PIPELINE = os.environ.get('GHIBLI_PIPELINE', 'flux')
+PROMPT_PREFIX = "Ghibli Art – "
+
+DEFAULT_STEPS = 30
+DEFAULT_GUIDANCE = 3.5
+DEFAULT_SIZE = (832, 1280)
+# Largest request accepted: one pipeline serves every prompt, so a huge one would hold up the rest
+MAX_STEPS = int(os.environ.get('GHIBLI_MAX_STEPS', 50))
+MAX_SIDE = int(os.environ.get('GHIBLI_MAX_SIDE', 2048))
+# Prompts per pipeline call, and how long the scheduler holds a prompt
+# waiting for others with the same settings
+DEFAULT_BATCH_SIZE = int(os.environ.get('GHIBLI_BATCH_SIZE', 2))
+DEFAULT_MAX_WAIT_MS = float(os.environ.get('GHIBLI_MAX_WAIT_MS', 50))
+
+
+class StubPipeline:
+    """Stands in for the diffusion pipeline without torch or model weights.
+
+    Takes the same call arguments and returns one deterministic image per
+    prompt and seed; ``step_seconds`` makes each denoising step take time,
+    so batching behaves as it would with the real model.
+    """
+
+    device = 'cpu'
+
+    def __init__(self, step_seconds=0.0):
+        self.step_seconds = step_seconds
+        self.calls = 0
+
+    def __call__(self, prompt, num_inference_steps=DEFAULT_STEPS, guidance_scale=DEFAULT_GUIDANCE,
+                 width=DEFAULT_SIZE[0], height=DEFAULT_SIZE[1], generator=None):
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        seeds = generator if isinstance(generator, list) else [generator] * len(prompts)
+        self.calls += 1
+        time.sleep(self.step_seconds * num_inference_steps)
+
+        images = []
+        for text, seed in zip(prompts, seeds):
+            digest = hashlib.blake2b(f'{text}\0{seed}'.encode(), digest_size=6).digest()
+            start, end = np.frombuffer(digest[:3], np.uint8), np.frombuffer(digest[3:], np.uint8)
+            # Vertical gradient between two colours picked by the prompt and seed
+            t = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+            column = (start * (1 - t) + end * t).astype(np.uint8)
+            images.append(Image.fromarray(np.ascontiguousarray(np.broadcast_to(column, (height, width, 3)))))
+        return _PipelineOutput(images)
+
+
+class _PipelineOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+def _load_pipeline():
+    """Load the diffusion pipeline and LoRA (minutes on first use)"""
+    if PIPELINE == 'stub':
+        return StubPipeline(float(os.environ.get('GHIBLI_STUB_STEP_MS', 0)) / 1000)
+    # Heavy imports only when the model is really needed
+    import torch
+    from diffusers import DiffusionPipeline
+
+    # Use CUDA if available for faster inference
+    pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.float16)
+    pipe = pipe.to("cuda" if torch.cuda.is_available() else "cpu")
+    pipe.load_lora_weights(LORA_ID)
+    return pipe
+
+
+# Nothing is loaded until the first prompt, or PRELOAD_MODELS=ghibli / warmup()
+registry.register('ghibli', _load_pipeline, pool_size=1)
+
+
+def warmup():
+    """Load the pipeline now instead of on the first request"""
+    registry.preload(['ghibli'])
+
+
+def _generators(pipe, seeds):
+    if isinstance(pipe, StubPipeline):
+        return list(seeds)
+    import torch
+    return [torch.Generator(device=pipe.device).manual_seed(seed) for seed in seeds]
+
+
+def run_pipeline(prompts, seeds, steps=DEFAULT_STEPS, guidance=DEFAULT_GUIDANCE, size=DEFAULT_SIZE):
+    """Generate one PIL image per prompt in a single pipeline call"""
+    width, height = size
+    with registry.acquire('ghibli') as pipe, timed('ghibli', 'generate', (height, width)):
+        result = pipe([PROMPT_PREFIX + prompt for prompt in prompts], num_inference_steps=steps,
+                      guidance_scale=guidance, width=width, height=height,
+                      generator=_generators(pipe, seeds))
+    return result.images
+
+
+class GhibliBatcher:
+    """Group queued prompts into shared pipeline calls.
+
+    Callers submit a prompt with its settings and get a Future for the PNG
+    bytes. A background thread collects up to ``batch_size`` pending
+    prompts, waiting at most ``max_wait_ms`` after the first one arrives;
+    prompts with the same steps, guidance and size go through the pipeline
+    together.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.images = 0
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ghibli-batcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, prompt, seed, steps=DEFAULT_STEPS, guidance=DEFAULT_GUIDANCE, size=DEFAULT_SIZE):
+        """Queue one prompt; returns a Future resolving to PNG bytes"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put(((steps, guidance, tuple(size)), prompt, seed, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for settings, prompt, seed, future in self._collect():
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(settings, []).append((prompt, seed, future))
+            for (steps, guidance, size), items in groups.items():
+                try:
+                    images = run_pipeline([p for p, _, _ in items], [s for _, s, _ in items],
+                                          steps, guidance, size)
+                    results = [_png(image) for image in images]
+                except Exception as e:
+                    for _, _, future in items:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.images += len(items)
+                for (_, _, future), data in zip(items, results):
+                    future.set_result(data)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'images': self.images,
+            'mean_batch_size': round(self.images / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+def _png(image):
+    output = BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+# Generated images by prompt and settings
+cache = ResultCache(
+    memory_bytes=int(os.environ.get('GHIBLI_CACHE_MB', 256)) * 1024 * 1024,
+    disk_dir=os.environ.get('GHIBLI_CACHE_DIR') or None,
+)
+
+_batcher = None
+_batcher_lock = threading.Lock()
+# Futures of prompts being generated, so identical requests share one
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def get_batcher():
+    """Process-wide scheduler shared by every caller"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = GhibliBatcher()
+        return _batcher
+
+
+def generate(prompt, seed=None, steps=DEFAULT_STEPS, guidance=DEFAULT_GUIDANCE, size=DEFAULT_SIZE,
+             timeout=None):
+    """Generate (or fetch from the cache) a Ghibli-style image; returns (PNG bytes, info).
+
+    Results are cached by prompt, seed, steps, guidance and size. Without a
+    ``seed`` a random one is drawn; it is reported in ``info`` so the image
+    can be requested again.
+    """
+    prompt = prompt.strip()
+    if not prompt:
+        raise ValueError("Prompt is required")
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    if not 1 <= steps <= MAX_STEPS:
+        raise ValueError(f"Steps must be between 1 and {MAX_STEPS}, got {steps}")
+    width, height = size
+    # The pipeline works on 16px multiples
+    if width % 16 or height % 16 or width <= 0 or height <= 0:
+        raise ValueError(f"Image size must be a positive multiple of 16, got {width}x{height}")
+    if width > MAX_SIDE or height > MAX_SIDE:
+        raise ValueError(f"Image sides are limited to {MAX_SIDE} pixels, got {width}x{height}")
+
+    params = {'seed': seed, 'steps': steps, 'guidance': guidance, 'width': width, 'height': height}
+    key = make_key(prompt.encode(), 'ghibli', params)
+
+    def compute():
+        with _in_flight_lock:
+            future = _in_flight.get(key)
+            if future is None:
+                future = _in_flight[key] = get_batcher().submit(prompt, seed, steps, guidance, size)
+                future.add_done_callback(lambda _: _in_flight.pop(key, None))
+        return future.result(timeout=timeout)
+
+    data, _, hit = cache.get_or_compute(key, compute, 'image/png')
+    return data, dict(params, key=key, cached=hit)
+
+
+def stats():
+    return {
+        'model': registry.get('ghibli').stats(),
+        'batcher': get_batcher().stats(),
+        'cache': cache.stats(),
+    }
 
-# Load FLUX.1-dev diffusion pipeline with Ghibli-style LoRA from Hugging Face
-# Use CUDA if available for faster inference
-pipe = DiffusionPipeline.from_pretrained(
-    "black-forest-labs/FLUX.1-dev", torch_dtype=torch.float16
-).to("cuda" if torch.cuda.is_available() else "cpu")
-pipe.load_lora_weights("strangerzonehf/Ghibli-Flux-Cartoon-LoRA")
 
 # Function to generate Ghibli-style image from a text prompt
-# Save the result to a given path using PIL
-def generate_ghibli_image(prompt: str, output_path: str = "static/generated/ghibli_result.png"):
-    full_prompt = "Ghibli Art – " + prompt
-    result = pipe(full_prompt, num_inference_steps=30, guidance_scale=3.5, width=832, height=1280).images[0]
-    result.save(output_path)
+# Save the result to a given path (by default one per prompt and settings)
+def generate_ghibli_image(prompt: str, output_path: str = None, **settings):
+    data, info = generate(prompt, **settings)
+    if output_path is None:
+        output_path = os.path.join("static", "generated", f"ghibli_{info['key']}.png")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "wb") as f:
+        f.write(data)
     return output_path
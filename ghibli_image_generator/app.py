@@ -1,5 +1,7 @@
+import os
 from flask import Flask
-from src.routes import main_routes
+from src.routes import routes as main_routes
+from ghibli_cartoon import warmup
 
 app = Flask(__name__)
 
@@ -9,5 +11,9 @@ app.config['UPLOAD_FOLDER'] = 'static/images'
 # Registering the routes
 app.register_blueprint(main_routes)
 
+# Load the diffusion pipeline at startup instead of on the first prompt
+if os.environ.get('GHIBLI_WARMUP'):
+    warmup()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,13 +1,23 @@
-from flask import jsonify
-import random
+import os
+import sys
 
-def generate_ghibli_image(prompt):
-    # Simulate image generation based on the prompt
-    # In a real application, this function would call a machine learning model
-    image_id = random.randint(1, 1000)  # Simulating an image ID
-    image_url = f"/static/images/ghibli_image_{image_id}.png"  # Simulated image URL
-    return image_url
+# The generator (lazy pipeline, result cache, batching) lives in the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from ghibli_cartoon import generate  # noqa: E402
+
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'generated')
+
+def generate_ghibli_image(prompt, **settings):
+    # Each prompt and settings combination gets its own file, named by its cache key
+    data, info = generate(process_prompt(prompt), **settings)
+    filename = f"ghibli_{info['key']}.png"
+    path = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(path):
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return f"/static/generated/{filename}", info
 
 def process_prompt(prompt):
     # Here you can add any processing logic for the prompt if needed
-    return prompt.strip()  # Example: stripping whitespace from the prompt
\ No newline at end of file
+    return prompt.strip()  # Example: stripping whitespace from the prompt
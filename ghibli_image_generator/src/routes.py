@@ -1,21 +1,36 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, render_template
 from src.model import generate_ghibli_image
-import os
 
 routes = Blueprint('routes', __name__)
 
+@routes.route('/')
+def index():
+    return render_template('index.html')
+
 @routes.route('/generate-image', methods=['POST'])
 def generate_image():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     prompt = data.get('prompt')
 
-    if not prompt:
+    if not prompt or not prompt.strip():
         return jsonify({'error': 'Prompt is required'}), 400
 
-    # Call the model to generate the image
-    image_path = generate_ghibli_image(prompt)
+    # Optional settings; results are cached by prompt and all of these
+    try:
+        settings = {name: int(data[name]) for name in ('seed', 'steps') if data.get(name) is not None}
+        if data.get('guidance') is not None:
+            settings['guidance'] = float(data['guidance'])
+        if data.get('width') is not None or data.get('height') is not None:
+            settings['size'] = (int(data.get('width', 832)), int(data.get('height', 1280)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'seed, steps, guidance, width and height must be numbers'}), 400
 
-    if not os.path.exists(image_path):
-        return jsonify({'error': 'Image generation failed'}), 500
+    # Call the model to generate the image; concurrent prompts share pipeline calls
+    try:
+        image_url, info = generate_ghibli_image(prompt, **settings)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Image generation failed: {e}'}), 500
 
-    return send_file(image_path, mimetype='image/png')
\ No newline at end of file
+    return jsonify(dict(info, image_url=image_url))
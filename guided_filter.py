@@ -0,0 +1,81 @@
+import cv2
+import numpy as np
+
+from tiling import TileOp, run_tiled
+
+
+def guided_coefficients(guide, src, radius, eps):
+    """Per-pixel linear model ``src ~ a * guide + b`` of the guided filter.
+
+    Both images are float32 with matching shapes; each channel of ``src`` is
+    guided by the same channel of ``guide``. ``eps`` is in squared intensity
+    units and sets how strong an edge must be to be kept.
+    """
+    size = (2 * radius + 1, 2 * radius + 1)
+    mean_i = cv2.boxFilter(guide, -1, size)
+    mean_p = cv2.boxFilter(src, -1, size)
+    cov_ip = cv2.boxFilter(guide * src, -1, size) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, size) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    # Average the models of every window a pixel belongs to
+    return cv2.boxFilter(a, -1, size), cv2.boxFilter(b, -1, size)
+
+
+class GuidedUpsampleOp(TileOp):
+    """Apply low-resolution guided filter coefficients to a full-resolution guide.
+
+    Each tile bilinearly upsamples its part of ``a`` and ``b`` (the mapping is
+    computed from absolute coordinates, so tiles line up exactly) and
+    evaluates ``a * guide + b``, clipped to ``value_range`` unless it is None.
+    A single-channel guide can drive a model with several channels.
+    """
+
+    bytes_per_pixel = 60
+
+    def __init__(self, a, b, value_range=(0, 255)):
+        self.a = a
+        self.b = b
+        self.value_range = value_range
+        self.channels = a.shape[2] if a.ndim == 3 else 1
+
+    def __call__(self, tile, window, shape):
+        y0, y1, x0, x1 = window
+        scale_y = self.a.shape[0] / shape[0]
+        scale_x = self.a.shape[1] / shape[1]
+        # Destination pixel (x, y) samples the low-res grid at ((x + 0.5) * s - 0.5)
+        matrix = np.array([
+            [scale_x, 0, (x0 + 0.5) * scale_x - 0.5],
+            [0, scale_y, (y0 + 0.5) * scale_y - 0.5],
+        ], dtype=np.float64)
+        size = (x1 - x0, y1 - y0)
+        flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+        a = cv2.warpAffine(self.a, matrix, size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+        b = cv2.warpAffine(self.b, matrix, size, flags=flags, borderMode=cv2.BORDER_REPLICATE)
+        if tile.ndim == 2 and self.channels > 1:
+            tile = cv2.merge([tile] * self.channels)
+        result = cv2.multiply(tile, a, dtype=cv2.CV_32F)
+        cv2.add(result, b, dst=result)
+        if self.value_range is None:
+            return result.astype(tile.dtype, copy=False)
+        return np.clip(result, *self.value_range, out=result).astype(tile.dtype)
+
+    def out_channels(self, img):
+        return self.channels
+
+
+def guided_upsample(guide, guide_low, src_low, radius=2, eps=100.0, workers=None, value_range=(0, 255)):
+    """Bring ``src_low`` (computed from ``guide_low``) back to ``guide``'s size.
+
+    This is the fast guided filter: the model is fitted at low resolution and
+    applied to the full-resolution guide, so edges come from the original
+    image while flat areas keep the low-resolution result. The result has
+    ``guide``'s dtype and ``src_low``'s channels.
+    """
+    guide_low = guide_low.astype(np.float32)
+    src_low = src_low.astype(np.float32)
+    if guide_low.ndim == 2 and src_low.ndim == 3:
+        # One guide channel for every source channel
+        guide_low = cv2.merge([guide_low] * src_low.shape[2])
+    a, b = guided_coefficients(guide_low, src_low, radius, eps)
+    return run_tiled(guide, GuidedUpsampleOp(a, b, value_range), workers=workers)
@@ -1,5 +1,70 @@
 from PIL import Image
 import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from image_io import AVIF_QUALITY, encode_image
+
+# Lossy output formats: extension and mimetype
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'avif': ('.avif', 'image/avif'),
+}
+# JPEG chroma subsampling; WebP and AVIF always use 4:2:0
+SUBSAMPLING = {
+    '444': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+    '422': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+    '420': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+}
+# Settings ImageCompression.optimize accepts, e.g. from a pipeline stage
+OPTIMIZE_OPTIONS = {'format', 'quality', 'max_bytes', 'target_ssim', 'max_side', 'progressive', 'subsampling'}
+QUALITY_RANGE = (10, 95)
+# The SSIM of candidates is measured on a copy of at most this many pixels
+SSIM_MAX_PIXELS = 4_000_000
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def available_formats():
+    """Formats this OpenCV build can write (AVIF needs libavif)"""
+    return [name for name, (ext, _) in FORMATS.items() if cv2.haveImageWriter('x' + ext)]
+
+
+def _luma(img):
+    if img.ndim == 2:
+        gray = img
+    else:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+    return _fit(gray, SSIM_MAX_PIXELS).astype(np.float32)
+
+
+def _fit(img, max_pixels):
+    pixels = img.shape[0] * img.shape[1]
+    if pixels <= max_pixels:
+        return img
+    scale = (max_pixels / pixels) ** 0.5
+    size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def ssim_luma(x, y):
+    """Mean SSIM of two float32 luma images (11x11 Gaussian window, sigma 1.5)"""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def window(img):
+        return cv2.GaussianBlur(img, (11, 11), 1.5)
+
+    mu_x, mu_y = window(x), window(y)
+    var_x = window(x * x) - mu_x * mu_x
+    var_y = window(y * y) - mu_y * mu_y
+    cov = window(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
 
 class ImageCompression:
     def __init__(self, image_file):
@@ -8,3 +73,177 @@ class ImageCompression:
     def compress(self, output_path, quality=60):
         rgb_image = self.image.convert('RGB')  # JPG doesn't support transparency
         rgb_image.save(output_path, "JPEG", quality=quality, optimize=True)
+
+    @staticmethod
+    def encode(img, quality=60):
+        """Compress an already decoded BGR image to optimized JPEG bytes"""
+        return encode_image(img, '.jpg', quality=quality)
+
+    @staticmethod
+    def encode_as(img, format='jpeg', quality=60, progressive=False, subsampling=None):
+        """Encode a decoded image as ``format`` at ``quality`` (1-100)"""
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported format '{format}'")
+        ext = FORMATS[format][0]
+        if format == 'jpeg':
+            if img.ndim == 3 and img.shape[2] == 4:
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(quality), cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+                      cv2.IMWRITE_JPEG_PROGRESSIVE, int(bool(progressive))]
+            if subsampling is not None:
+                if str(subsampling) not in SUBSAMPLING:
+                    raise ValueError(f"Unsupported chroma subsampling '{subsampling}'")
+                params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, SUBSAMPLING[str(subsampling)]]
+        elif format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+        else:
+            params = [AVIF_QUALITY, int(quality)]
+        success, buffer = cv2.imencode(ext, img, params)
+        if not success:
+            raise ValueError(f"Could not encode image as {format}")
+        return buffer.tobytes()
+
+    @staticmethod
+    def optimize(img, format='jpeg', quality=None, max_bytes=None, target_ssim=None, max_side=None,
+                 progressive=False, subsampling=None, workers=DEFAULT_WORKERS, max_rounds=8):
+        """Encode ``img`` as small as its target allows; returns (bytes, report).
+
+        With ``max_bytes`` the highest quality that fits the budget is used;
+        with ``target_ssim`` the lowest quality whose luma SSIM against the
+        (resized) input reaches the target; otherwise ``quality`` (default 60).
+        Qualities are searched with a k-ary search, encoding ``workers``
+        candidates per round in parallel. ``format='auto'`` tries every
+        available format and keeps the smallest result that meets the target
+        (for a byte budget, the one with the best SSIM). ``max_side`` first
+        resizes the image to fit.
+        """
+        start = time.perf_counter()
+        if max_side and max(img.shape[:2]) > max_side:
+            scale = max_side / max(img.shape[:2])
+            size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+        formats = available_formats() if format == 'auto' else [format]
+        for name in formats:
+            if name not in FORMATS:
+                raise ValueError(f"Unsupported format '{name}'")
+            if not cv2.haveImageWriter('x' + FORMATS[name][0]):
+                raise ValueError(f"This OpenCV build cannot write {name}")
+
+        reference = _luma(img) if target_ssim is not None or len(formats) > 1 else None
+        search = _QualitySearch(img, reference, progressive, subsampling, workers)
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='compress') as pool:
+            for name in formats:
+                if max_bytes is not None:
+                    best = search.run(pool, name, lambda c: len(c.data) <= max_bytes, highest=True,
+                                      max_rounds=max_rounds)
+                elif target_ssim is not None:
+                    best = search.run(pool, name, lambda c: search.ssim(c) >= target_ssim, highest=False,
+                                      max_rounds=max_rounds)
+                else:
+                    best = search.candidate(name, 60 if quality is None else quality)
+                if reference is not None:
+                    search.ssim(best)
+                results.append(best)
+
+        if max_bytes is not None:
+            # Meeting the budget first, then the best looking
+            chosen = max(results, key=lambda c: (len(c.data) <= max_bytes, c.score or 0, -len(c.data)))
+            met = len(chosen.data) <= max_bytes
+        elif target_ssim is not None:
+            chosen = min(results, key=lambda c: (c.score < target_ssim, len(c.data)))
+            met = chosen.score >= target_ssim
+        else:
+            chosen = min(results, key=lambda c: len(c.data))
+            met = True
+
+        report = {
+            'format': chosen.format,
+            'mimetype': FORMATS[chosen.format][1],
+            'quality': chosen.quality,
+            'bytes': len(chosen.data),
+            'width': img.shape[1],
+            'height': img.shape[0],
+            'progressive': bool(progressive) if chosen.format == 'jpeg' else None,
+            'subsampling': (str(subsampling) if subsampling else 'default') if chosen.format == 'jpeg' else '420',
+            'ssim': None if chosen.score is None else round(chosen.score, 5),
+            'target': {'max_bytes': max_bytes, 'ssim': target_ssim},
+            'met': met,
+            'candidates': search.encodes,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+        }
+        return chosen.data, report
+
+
+class _Candidate:
+    __slots__ = ('format', 'quality', 'data', 'score')
+
+    def __init__(self, format, quality, data):
+        self.format = format
+        self.quality = quality
+        self.data = data
+        self.score = None
+
+
+class _QualitySearch:
+    """Encodes (and scores) candidates for ImageCompression.optimize, once each"""
+
+    def __init__(self, img, reference, progressive, subsampling, workers):
+        self.img = img
+        self.reference = reference
+        self.progressive = progressive
+        self.subsampling = subsampling
+        self.workers = max(1, workers)
+        self.encodes = 0
+        self._lock = threading.Lock()
+
+    def candidate(self, format, quality):
+        data = ImageCompression.encode_as(self.img, format, quality, self.progressive, self.subsampling)
+        with self._lock:
+            self.encodes += 1
+        return _Candidate(format, quality, data)
+
+    def ssim(self, candidate):
+        if candidate.score is None:
+            decoded = cv2.imdecode(np.frombuffer(candidate.data, np.uint8), cv2.IMREAD_GRAYSCALE)
+            candidate.score = ssim_luma(_luma(decoded), self.reference)
+        return candidate.score
+
+    def run(self, pool, format, ok, highest, max_rounds=8):
+        """Best candidate where ``ok`` holds: the highest quality if ``highest``
+        (``ok`` holds below some quality), else the lowest (it holds above)"""
+        low, high = QUALITY_RANGE
+        best = None
+        fallback = None
+        for _ in range(max_rounds):
+            if low > high:
+                break
+            # Evenly spaced probes inside the open interval
+            qualities = sorted({low + (high - low) * (i + 1) // (self.workers + 1) for i in range(self.workers)})
+
+            def probe(quality):
+                candidate = self.candidate(format, quality)
+                return candidate, ok(candidate)
+
+            probes = list(pool.map(probe, qualities))
+            passing = [c for c, good in probes if good]
+            failing = [c for c, good in probes if not good]
+            if highest:
+                if passing:
+                    best = max(passing, key=lambda c: c.quality)
+                    low = best.quality + 1
+                above = [c for c in failing if best is None or c.quality > best.quality]
+                if above:
+                    high = min(c.quality for c in above) - 1
+                    fallback = min([fallback] + above if fallback else above, key=lambda c: c.quality)
+            else:
+                if passing:
+                    best = min(passing, key=lambda c: c.quality)
+                    high = best.quality - 1
+                below = [c for c in failing if best is None or c.quality < best.quality]
+                if below:
+                    low = max(c.quality for c in below) + 1
+                    fallback = max([fallback] + below if fallback else below, key=lambda c: c.quality)
+        # Nothing met the target: the closest candidate tried
+        return best or fallback
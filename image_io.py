@@ -0,0 +1,175 @@
+import os
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Output formats understood by encode_image, by extension
+MIMETYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
+
+
+# Leading bytes of common image formats, for serving uploads back unchanged
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+]
+
+
+def guess_mimetype(data):
+    """Mimetype of encoded image bytes from their signature"""
+    data = bytes(data[:12])
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+# Missing from OpenCV builds that predate AVIF support
+AVIF_QUALITY = getattr(cv2, 'IMWRITE_AVIF_QUALITY', 512)
+
+
+# Images with more pixels than this are refused from their header, before decoding
+MAX_IMAGE_PIXELS = int(float(os.environ.get('MAX_IMAGE_MP', 100)) * 1000 * 1000)
+# PIL only reads headers here, and check_image_size does its own check
+Image.MAX_IMAGE_PIXELS = None
+
+
+class InvalidImage(ValueError):
+    """The upload could not be decoded as an image"""
+
+
+class ImageTooLarge(InvalidImage):
+    """The image has more pixels than MAX_IMAGE_PIXELS"""
+
+
+def read_bytes(source):
+    """Bytes of an upload: accepts bytes-like objects or file objects.
+
+    An upload held in memory (a BytesIO, or a Werkzeug FileStorage around
+    one) hands over its buffer without a copy.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    stream = getattr(source, 'stream', source)
+    if isinstance(stream, BytesIO):
+        return stream.getvalue()
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source.read()
+
+
+def check_image_size(source):
+    """Raise ImageTooLarge for images over MAX_IMAGE_PIXELS, reading only the header"""
+    try:
+        width, height = image_size(source, cv2.IMREAD_UNCHANGED)
+    except InvalidImage:
+        # A format PIL cannot read; OpenCV's own limit (OPENCV_IO_MAX_IMAGE_PIXELS) still applies
+        return
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"Images are limited to {MAX_IMAGE_PIXELS / 1e6:g} megapixels")
+
+
+def decode_image(source, flags=cv2.IMREAD_COLOR):
+    """Decode an upload (bytes or file object) into an ndarray, once"""
+    data = read_bytes(source)
+    check_image_size(data)
+    buffer = np.frombuffer(data, np.uint8)
+    img = cv2.imdecode(buffer, flags) if buffer.size else None
+    if img is None:
+        raise InvalidImage("Could not decode image")
+    return img
+
+
+# JPEG can be decoded straight to 1/2, 1/4 or 1/8 scale (libjpeg DCT scaling)
+REDUCED_FLAGS = {
+    cv2.IMREAD_COLOR: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+    cv2.IMREAD_GRAYSCALE: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+}
+
+
+def image_size(source, flags=cv2.IMREAD_COLOR):
+    """(width, height) read from the image header, without decoding the pixels.
+
+    Matches what decode_image returns with ``flags``: the EXIF orientation
+    is applied unless they are IMREAD_UNCHANGED or include
+    IMREAD_IGNORE_ORIENTATION.
+    """
+    try:
+        with Image.open(BytesIO(read_bytes(source))) as img:
+            width, height = img.size
+            # Only when the header has it: for some formats getexif() decodes the whole image
+            orientation = img.getexif().get(0x0112, 1) if 'exif' in img.info else 1
+    except Exception:
+        raise InvalidImage("Could not decode image")
+    # Orientations 5-8 turn the image by 90 degrees
+    if orientation in (5, 6, 7, 8) and flags != cv2.IMREAD_UNCHANGED and not flags & cv2.IMREAD_IGNORE_ORIENTATION:
+        return height, width
+    return width, height
+
+
+def decode_reduced(source, max_side, flags=cv2.IMREAD_COLOR):
+    """Decode an upload at no more than ``max_side`` pixels on its long side.
+
+    JPEGs skip most of the work by decoding at the largest 1/2, 1/4 or 1/8
+    scale that is still at least ``max_side``; every format is then resized
+    down with INTER_AREA.
+    """
+    data = read_bytes(source)
+    if flags in REDUCED_FLAGS and guess_mimetype(data) == 'image/jpeg':
+        long_side = max(image_size(data))
+        for factor in (8, 4, 2):
+            if long_side >= max_side * factor:
+                flags = REDUCED_FLAGS[flags][factor]
+                break
+    img = decode_image(data, flags)
+    height, width = img.shape[:2]
+    if max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def to_8bit(img):
+    """8-bit version of a decoded image; 16-bit PNG/TIFF keep their high byte"""
+    if img.dtype == np.uint16:
+        return (img >> 8).astype(np.uint8)
+    return img
+
+
+def encode_image(img, ext='.png', quality=None):
+    """Encode an ndarray to bytes; ``quality`` applies to JPEG, WebP and AVIF"""
+    ext = ext.lower() if ext.startswith('.') else '.' + ext.lower()
+    if ext not in MIMETYPES:
+        raise ValueError(f"Unsupported output format '{ext}'")
+
+    params = []
+    if ext in ('.jpg', '.jpeg'):
+        # JPEG has no alpha channel
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        if quality is not None:
+            params += [cv2.IMWRITE_JPEG_QUALITY, int(quality), cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    elif ext == '.webp' and quality is not None:
+        params += [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    elif ext == '.avif' and quality is not None:
+        params += [AVIF_QUALITY, int(quality)]
+
+    success, buffer = cv2.imencode(ext, img, params)
+    if not success:
+        raise ValueError("Could not encode image")
+    return buffer.tobytes()
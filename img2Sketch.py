@@ -3,10 +3,100 @@ import cv2
 import typing
 import os
 import argparse
+import threading
+from collections import OrderedDict
+
+from tiling import FnOp, gaussian_radius, run_tiled, should_tile
+
+
+# Luma weights for channels 0, 1, 2, as in the original np.dot. The -0.4999
+# offset turns OpenCV's round-to-nearest into truncation, so the result equals
+# int(0.299*c0 + 0.587*c1 + 0.114*c2) exactly for every 8-bit color.
+GRAY_TRANSFORM = np.array([[0.299, 0.587, 0.114, -0.4999]])
+
+# Pixels per strip when indexing the dodge lookup table
+STRIP_PIXELS = 1 << 16
+
+
+def _build_dodge_lut() -> np.ndarray:
+    """Color dodge for every (front, back) pair, indexed by ``front << 8 | back``."""
+    front = np.arange(256, dtype=np.float64)[:, None]
+    back = np.arange(256, dtype=np.float64)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = back * 255.0 / (255.0 - front)
+    result[result > 255] = 255
+    result[:, 255] = 255
+    # 0 / 0 (black pixel under a fully dark blur) stays black
+    result = np.nan_to_num(result, nan=0.0)
+    return result.astype("uint8").ravel()
+
+
+DODGE_LUT = _build_dodge_lut()
+
+
+class SketchWorkspace:
+    """Single-channel scratch buffers reused across frames of the same shape.
+
+    Only the most recent ``max_shapes`` shapes are kept, so a worker that sees
+    a stream of equally sized frames allocates nothing after the first one.
+    """
+
+    def __init__(self, max_shapes: int = 2) -> None:
+        self.max_shapes = max_shapes
+        self._buffers = OrderedDict()
+
+    def get(self, shape: typing.Tuple[int, int]) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return ``(gray, work, index)`` buffers for a frame of ``shape``."""
+        shape = tuple(shape)
+        buffers = self._buffers.pop(shape, None)
+        if buffers is None:
+            rows = max(1, STRIP_PIXELS // max(1, shape[1]))
+            buffers = (
+                np.empty(shape, np.uint8),
+                np.empty(shape, np.uint8),
+                np.empty((rows, shape[1]), np.uint16),
+            )
+            while len(self._buffers) >= self.max_shapes:
+                self._buffers.popitem(last=False)
+        self._buffers[shape] = buffers
+        return buffers
+
+
+_thread_workspace = threading.local()
+
+
+def _default_workspace() -> SketchWorkspace:
+    # One workspace per thread, so concurrent requests never share buffers
+    workspace = getattr(_thread_workspace, "workspace", None)
+    if workspace is None:
+        workspace = _thread_workspace.workspace = SketchWorkspace()
+    return workspace
+
+
+def _dodge_into(front: np.ndarray, back: np.ndarray, out: np.ndarray, index: np.ndarray) -> None:
+    """Look up the dodge of uint8 ``front``/``back`` strip by strip into ``out``.
+
+    ``out`` may be ``front`` itself: each strip's index is built before the
+    strip is overwritten.
+    """
+    rows = index.shape[0]
+    for y in range(0, front.shape[0], rows):
+        idx = index[: min(rows, front.shape[0] - y)]
+        np.left_shift(front[y:y + rows], 8, out=idx, dtype=np.uint16)
+        np.bitwise_or(idx, back[y:y + rows], out=idx)
+        np.take(DODGE_LUT, idx, out=out[y:y + rows])
 
 
 class PencilSketch:
-    """Apply pencil sketch effect to an image"""
+    """Apply pencil sketch effect to an image
+
+    The sketch is computed on a single channel end to end using reusable
+    buffers, and only expanded to three channels for the returned image.
+    Compared with the original float64 implementation the grayscale step may
+    differ by 1 level on pixels whose weighted sum is an exact integer (where
+    the old float64 result depended on BLAS rounding); everything after it is
+    identical for the same grayscale input. See ``benchmarks/pencil_sketch.py``.
+    """
 
     def __init__(
         self,
@@ -14,6 +104,7 @@ class PencilSketch:
         ksize: typing.Tuple[int, int] = (0, 0),
         sharpen_value: int = None,
         kernel: np.ndarray = None,
+        workspace: SketchWorkspace = None,
     ) -> None:
         """
         Args:
@@ -21,6 +112,7 @@ class PencilSketch:
             ksize (tuple): Kernel size for Gaussian blur.
             sharpen_value (int): Sharpening strength (optional).
             kernel (np.ndarray): Custom sharpening kernel (optional).
+            workspace (SketchWorkspace): Buffers to reuse (defaults to one per thread).
         """
         self.blur_sigma = blur_sigma
         self.ksize = ksize
@@ -30,6 +122,7 @@ class PencilSketch:
             if kernel is None and sharpen_value is not None
             else kernel
         )
+        self.workspace = workspace
 
     def dodge(self, front: np.ndarray, back: np.ndarray) -> np.ndarray:
         """
@@ -38,10 +131,8 @@ class PencilSketch:
             front: Blurred inverted image.
             back: Grayscale image.
         """
-        result = back * 255.0 / (255.0 - front)
-        result[result > 255] = 255
-        result[back == 255] = 255
-        return result.astype("uint8")
+        index = (front.astype(np.uint16) << 8) | back
+        return DODGE_LUT[index]
 
     def sharpen(self, image: np.ndarray) -> np.ndarray:
         """Sharpen the image using a kernel, if sharpen_value is set."""
@@ -50,36 +141,203 @@ class PencilSketch:
             return 255 - cv2.filter2D(src=inverted, ddepth=-1, kernel=self.kernel)
         return image
 
-    def __call__(self, frame: np.ndarray) -> np.ndarray:
-        """Apply the full pencil sketch effect to the given image (frame)."""
+    def sketch_gray(self, frame: np.ndarray) -> np.ndarray:
+        """Compute the single-channel sketch of ``frame``.
+
+        The returned array is a workspace buffer: it is overwritten by the next
+        call with a frame of the same shape, so copy it if you need to keep it.
+        """
+        workspace = self.workspace or _default_workspace()
+        gray, work, index = workspace.get(frame.shape[:2])
+
         # Convert to grayscale
-        grayscale = np.array(np.dot(frame[..., :3], [0.299, 0.587, 0.114]), dtype=np.uint8)
-        grayscale = np.stack((grayscale,) * 3, axis=-1)
+        if frame.ndim == 2:
+            np.copyto(gray, frame)
+        else:
+            cv2.transform(frame[..., :3], GRAY_TRANSFORM, dst=gray)
 
-        # Invert and blur
-        inverted_img = 255 - grayscale
-        blur_img = cv2.GaussianBlur(inverted_img, ksize=self.ksize, sigmaX=self.blur_sigma)
+        # Invert and blur (in place)
+        cv2.bitwise_not(gray, dst=work)
+        cv2.GaussianBlur(work, ksize=self.ksize, sigmaX=self.blur_sigma, dst=work)
 
-        # Blend (dodge)
-        final_img = self.dodge(blur_img, grayscale)
+        # Blend (dodge), written over the blurred buffer
+        _dodge_into(work, gray, work, index)
 
-        # Optional sharpening
-        sharpened_image = self.sharpen(final_img)
+        # Optional sharpening; the grayscale buffer is free to reuse now
+        if self.sharpen_value is not None and isinstance(self.sharpen_value, int):
+            cv2.bitwise_not(work, dst=work)
+            cv2.filter2D(src=work, ddepth=-1, kernel=self.kernel, dst=gray)
+            cv2.bitwise_not(gray, dst=gray)
+            return gray
+        return work
+
+    @property
+    def halo(self) -> int:
+        """Pixels of context each output pixel depends on (blur plus sharpen kernel)."""
+        sharpening = self.sharpen_value is not None and isinstance(self.sharpen_value, int)
+        sharpen = max(np.shape(self.kernel)) // 2 if sharpening else 0
+        return gaussian_radius(self.blur_sigma, self.ksize) + sharpen
+
+    def sketch_tiled(self, frame: np.ndarray) -> np.ndarray:
+        """Single-channel sketch of ``frame`` computed in parallel, memory-bounded tiles."""
+        # Each tile's result is copied out before its worker thread reuses the buffer
+        op = FnOp(self.sketch_gray, self.halo, bytes_per_pixel=8, channels=1)
+        return run_tiled(frame, op)
+
+    def __call__(self, frame: np.ndarray, tiled: bool = None) -> np.ndarray:
+        """Apply the full pencil sketch effect to the given image (frame)."""
+        sketch = self.sketch_tiled(frame) if should_tile(frame, tiled) else self.sketch_gray(frame)
+        # Expand to three channels only for the output image
+        return cv2.cvtColor(sketch, cv2.COLOR_GRAY2BGR)
+
+    @staticmethod
+    def apply(img: np.ndarray, blur_sigma: int = 5, sharpen_value: int = None,
+              ksize: typing.Tuple[int, int] = (0, 0), tiled: bool = None) -> np.ndarray:
+        """Sketch a decoded BGR image with the given settings (the pipeline stage)."""
+        return PencilSketch(blur_sigma=blur_sigma, ksize=ksize, sharpen_value=sharpen_value)(img, tiled=tiled)
+
+
+class SketchIntermediates:
+    """The intermediate images of one frame's sketch, kept for re-rendering it
+    with other settings.
+
+    The grayscale and inverted images are computed once. Blur levels and
+    their dodged sketches are computed on first use and kept, so a new
+    sharpen value only re-sharpens (a 3x3 filter, not kept), and a new blur
+    sigma skips the grayscale step.
+
+    A level is named by its blur ``chain``: ``(5,)`` blurs the inverted
+    image directly, as PencilSketch does, and ``(2, 5)`` blurs level
+    ``(2,)`` by sqrt(5**2 - 2**2) (Gaussian blurs compose). Building a sweep
+    of sigmas that way is cheaper, but a chained level may differ from the
+    direct one by a gray level, so the two are kept apart. A sketch of a
+    one-sigma chain always equals PencilSketch's untiled result. With
+    ``max_levels``, only that many of the most recently used blur levels and
+    sketches are kept; the rest are computed again when asked for. The
+    object is safe to use from several threads.
+    """
+
+    def __init__(self, frame: np.ndarray, max_levels: int = None) -> None:
+        gray = np.empty(frame.shape[:2], np.uint8)
+        if frame.ndim == 2:
+            np.copyto(gray, frame)
+        else:
+            cv2.transform(frame[..., :3], GRAY_TRANSFORM, dst=gray)
+        self.gray = gray
+        self.inverted = cv2.bitwise_not(gray)
+        self.max_levels = max_levels
+        self._levels = OrderedDict()
+        self._sketches = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self) -> typing.Tuple[int, int]:
+        return self.gray.shape
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            cached = list(self._levels.values()) + list(self._sketches.values())
+        return self.gray.nbytes + self.inverted.nbytes + sum(a.nbytes for a in cached)
 
-        return sharpened_image
+    def _keep(self, store: OrderedDict, key, compute) -> np.ndarray:
+        with self._lock:
+            result = store.get(key)
+            if result is not None:
+                store.move_to_end(key)
+        if result is None:
+            # Computed outside the lock; two threads asking at once just both compute it
+            result = compute()
+            with self._lock:
+                result = store.setdefault(key, result)
+                store.move_to_end(key)
+                while self.max_levels is not None and len(store) > self.max_levels:
+                    store.popitem(last=False)
+        return result
+
+    def shrink(self, max_bytes: int) -> int:
+        """Drop kept sketches, then blur levels, least recently used first,
+        until at most ``max_bytes`` are held; returns the bytes still held."""
+        nbytes = self.nbytes
+        with self._lock:
+            for store in (self._sketches, self._levels):
+                while nbytes > max_bytes and store:
+                    nbytes -= store.popitem(last=False)[1].nbytes
+        return nbytes
+
+    def blurred(self, chain: typing.Tuple[float, ...]) -> np.ndarray:
+        """Blurred inverted image for a chain of increasing sigmas."""
+        chain = tuple(chain)
+        if any(b <= a for a, b in zip(chain, chain[1:])):
+            raise ValueError(f"Blur chain must increase: {chain}")
+
+        def compute():
+            if len(chain) == 1:
+                return cv2.GaussianBlur(self.inverted, ksize=(0, 0), sigmaX=chain[0])
+            sigma = (chain[-1] ** 2 - chain[-2] ** 2) ** 0.5
+            return cv2.GaussianBlur(self.blurred(chain[:-1]), ksize=(0, 0), sigmaX=sigma)
+
+        return self._keep(self._levels, chain, compute)
+
+    def sketch(self, chain: typing.Tuple[float, ...], sharpen_value: int = None,
+               front: np.ndarray = None) -> np.ndarray:
+        """Single-channel sketch for a blur chain (see blurred) and sharpen value.
+
+        ``front`` is the chain's blur level if the caller holds it already,
+        so a level dropped in the meantime is not blurred again. The
+        unsharpened sketch is a kept buffer: copy it before changing it.
+        """
+        chain = tuple(chain)
+        if sharpen_value is not None:
+            return PencilSketch(sharpen_value=sharpen_value).sharpen(self.sketch(chain, front=front))
+
+        def compute():
+            nonlocal front
+            if front is None:
+                front = self.blurred(chain)
+            out = np.empty_like(front)
+            rows = max(1, STRIP_PIXELS // max(1, front.shape[1]))
+            _dodge_into(front, self.gray, out, np.empty((rows, front.shape[1]), np.uint16))
+            return out
+
+        return self._keep(self._sketches, chain, compute)
+
+    def render(self, blur_sigma: float = 5, sharpen_value: int = None) -> np.ndarray:
+        """Three-channel sketch, equal to ``PencilSketch(blur_sigma, sharpen_value=...)(frame, tiled=False)``."""
+        return cv2.cvtColor(self.sketch((blur_sigma,), sharpen_value), cv2.COLOR_GRAY2BGR)
 
 
 def main():
+    import batch_process
+
     parser = argparse.ArgumentParser(description="Convert an image to a pencil sketch.")
-    parser.add_argument("input", help="Path to input image file (e.g., input.jpg)")
+    parser.add_argument("input", nargs="+",
+                        help="Path to input image file (e.g., input.jpg), or several files, directories "
+                             "or glob patterns (e.g., 'photos/**/*.jpg') to sketch into an output directory")
     parser.add_argument("output", help="Path to save output sketch image (e.g., output/sketch.png)")
     parser.add_argument("--blur_sigma", type=int, default=5, help="Sigma value for Gaussian blur.")
     parser.add_argument("--ksize", type=int, nargs=2, default=[0, 0], help="Kernel size for Gaussian blur.")
     parser.add_argument("--sharpen_value", type=int, default=None, help="Sharpening strength (optional).")
+    parser.add_argument("--format", default=".png", help="Output format in batch mode (.png, .jpg, .webp).")
+    batch_process.add_batch_arguments(parser)
     args = parser.parse_args()
 
+    if batch_process.is_batch(args.input, args.output):
+        stage = ('sketch', {'blur_sigma': args.blur_sigma, 'ksize': tuple(args.ksize),
+                            'sharpen_value': args.sharpen_value})
+        try:
+            summary = batch_process.run_batch(
+                batch_process.collect_inputs(args.input), args.output, [stage], output=args.format,
+                workers=args.workers, prefetch=args.prefetch, manifest_path=args.manifest,
+                progress=not args.no_progress)
+        except (ValueError, FileNotFoundError) as e:
+            print(f"[Error] {e}")
+            return
+        batch_process.print_summary(summary, args.output)
+        return
+
     # Read image
-    image = cv2.imread(args.input)
+    image = cv2.imread(args.input[0])
     if image is None:
         print("[Error] Could not read image. Please check the path.")
         return
@@ -0,0 +1,375 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import metrics
+from frame_transport import FRAME_MIN_BYTES, FRAME_RING_BYTES, SlotRef, SlotRing, attach
+from image_io import InvalidImage, image_size
+
+# Effects that hold a big model or run for seconds; at most this many run at once
+DEFAULT_LIMITS = {'colorization': 1, 'background_removal': 1}
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue already holds max_depth jobs"""
+
+
+def _init_worker(preload, pids=None):
+    # Report this process to the queue, which kills it if a job gets stuck
+    if pids is not None:
+        pids.put(os.getpid())
+    # Import the effects (and optionally load their models) once per worker
+    # process instead of once per job
+    from effect_pipeline import load_stages
+    from model_registry import registry
+    load_stages()
+    if preload:
+        registry.preload(None if preload == 'all' else preload.split(','))
+
+
+def _run_job(stages, output, quality, data, out=None):
+    from effect_pipeline import Pipeline
+    pipeline = Pipeline(stages, output=output, quality=quality)
+    if isinstance(data, SlotRef):
+        # Decoded straight from shared memory
+        data = memoryview(attach(data))
+    # Stage timings are sent back so the server's /metrics includes them
+    with metrics.registry.capture() as observations:
+        result = pipeline.render(data)
+    if out is not None and len(result) <= out.shape[0]:
+        attach(out)[:len(result)] = np.frombuffer(result, np.uint8)
+        result = out._replace(shape=(len(result),))
+    return result, pipeline.mimetype, observations
+
+
+def _result_bound(data):
+    # Room for the encoded result: an uncompressed 4-channel image plus headers
+    try:
+        width, height = image_size(data)
+    except InvalidImage:
+        return None
+    return width * height * 4 + 65536
+
+
+class Job:
+    """One submitted effect run and its state"""
+
+    def __init__(self, stages, output, quality, data, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.stages = stages
+        self.effects = {name for name, _ in stages}
+        self.output = output
+        self.quality = quality
+        self.data = data
+        # Shared-memory slots held while a worker has the job; the last one takes the result
+        self.slots = []
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.mimetype = None
+        self.future = None
+        self.executor = None
+        self.on_done = on_done
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # Bumped on every status change, so watchers can wait for the next one
+        self.version = 0
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled', 'timeout')
+
+    def to_dict(self):
+        info = {
+            'id': self.id,
+            'status': self.status,
+            'stages': [name for name, _ in self.stages],
+            'submitted': self.submitted,
+            'queue_wait_s': round((self.started or time.time()) - self.submitted, 3),
+        }
+        if self.started:
+            info['run_s'] = round((self.finished or time.time()) - self.started, 3)
+        if self.error:
+            info['error'] = self.error
+        return info
+
+
+class JobQueue:
+    """Run heavy effects on a process pool behind a bounded job queue.
+
+    Jobs wait in submission order until a worker is free and their effects
+    are under the per-effect concurrency limits. Finished results are kept
+    for ``result_ttl`` seconds. A job that exceeds ``timeout`` (or is
+    cancelled while running) is reported as such right away. A process pool
+    cannot interrupt a running task, so new jobs go to a fresh pool, and the
+    old pool's processes are killed once its other jobs have finished.
+
+    Uploads and results over FRAME_MIN_BYTES go through a SlotRing of up to
+    ``ring_bytes`` of shared memory instead of being pickled; the slots are
+    released when the worker's future completes, whether the job succeeded,
+    failed or its worker died.
+    """
+
+    def __init__(self, workers=None, max_depth=64, limits=None, timeout=120.0,
+                 result_ttl=600.0, preload=None, start_method='spawn', ring_bytes=FRAME_RING_BYTES):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_depth = max_depth
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.preload = preload
+        self.start_method = start_method
+        # Queue each pool's workers report their pid on, by pool
+        self._pids = {}
+        self._executor = self._new_executor()
+        # Pools replaced because of a stuck job: (executor, its pid queue)
+        self._retired = []
+        self.ring = SlotRing(ring_bytes) if ring_bytes else None
+        self._jobs = {}
+        self._pending = deque()
+        self._running = set()
+        self._cond = threading.Condition()
+        self._watchdog = threading.Thread(target=self._watch, name='job-watchdog', daemon=True)
+        self._watchdog.start()
+        self.completed = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    def _new_executor(self):
+        context = multiprocessing.get_context(self.start_method)
+        pids = context.SimpleQueue()
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.preload, pids),
+        )
+        self._pids[executor] = pids
+        return executor
+
+    def _transport(self, job):
+        # (data, result slot ref) for the worker: slot refs when the ring has room, else the bytes
+        if self.ring is None or len(job.data) < FRAME_MIN_BYTES:
+            return job.data, None
+        source = self.ring.put(job.data)
+        if source is None:
+            return job.data, None
+        job.slots.append(source)
+        bound = _result_bound(job.data)
+        out = self.ring.acquire(bound) if bound else None
+        if out is None:
+            return source.ref((len(job.data),)), None
+        job.slots.append(out)
+        return source.ref((len(job.data),)), out.ref((out.capacity,))
+
+    def _release_slots(self, job):
+        for slot in job.slots:
+            slot.release()
+        job.slots = []
+
+    def _submit(self, job):
+        # Returns the job's future, or None after failing the job if no worker could take it
+        try:
+            args = (job.stages, job.output, job.quality) + self._transport(job)
+            try:
+                job.executor = self._executor
+                return self._executor.submit(_run_job, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._pids.pop(self._executor).close()
+                self._executor = self._new_executor()
+                self.restarts += 1
+                job.executor = self._executor
+                return self._executor.submit(_run_job, *args)
+        except Exception as e:
+            self._release_slots(job)
+            self._running.discard(job)
+            job.data = None
+            job.finished = time.time()
+            job.error = f'Could not start the job: {e}'
+            self._changed(job, 'failed')
+            return None
+
+    def _retire(self, executor):
+        """Send new jobs to a fresh pool; ``executor``'s processes are killed
+        by the watchdog once none of its jobs is still wanted"""
+        if executor is not self._executor:
+            return
+        self._retired.append((executor, self._pids.pop(executor)))
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+        self.restarts += 1
+
+    def _reap(self):
+        # Called with the lock held
+        for executor, pids in list(self._retired):
+            if all(job.done for job in self._running if job.executor is executor):
+                # Only abandoned jobs are left; their futures fail and release their slots
+                reported = set()
+                while not pids.empty():
+                    reported.add(pids.get())
+                pids.close()
+                # Only live children of this process, so an exited worker's reused pid is safe
+                for process in multiprocessing.active_children():
+                    if process.pid in reported:
+                        process.kill()
+                self._retired.remove((executor, pids))
+
+    def _changed(self, job, status):
+        job.status = status
+        job.version += 1
+        self._cond.notify_all()
+
+    def _effects_running(self, effect):
+        return sum(1 for job in self._running if effect in job.effects)
+
+    def _can_start(self, job):
+        if len(self._running) >= self.workers:
+            return False
+        return all(self._effects_running(effect) < self.limits[effect]
+                   for effect in job.effects if effect in self.limits)
+
+    def _dispatch(self):
+        # Called with the lock held; starts every pending job that fits
+        for job in list(self._pending):
+            # A nested dispatch (from a job that finished instantly) may have started it
+            if job not in self._pending or not self._can_start(job):
+                continue
+            self._pending.remove(job)
+            self._running.add(job)
+            job.started = time.time()
+            metrics.JOB_WAIT_SECONDS.observe(job.started - job.submitted)
+            self._changed(job, 'running')
+            job.future = self._submit(job)
+            if job.future is not None:
+                job.future.add_done_callback(lambda future, job=job: self._finish(job, future))
+
+    def _collect(self, job, future):
+        """The future's (result, mimetype, observations), copied out of its slot;
+        releases the job's slots, which the worker no longer uses"""
+        try:
+            result, mimetype, observations = future.result()
+            if isinstance(result, SlotRef):
+                result = job.slots[-1].view(result.shape, result.dtype).tobytes()
+            return result, mimetype, observations
+        finally:
+            self._release_slots(job)
+
+    def _finish(self, job, future):
+        # Copied out before taking the lock, and even for a job that timed out or was cancelled
+        try:
+            outcome = self._collect(job, future)
+        except Exception as e:
+            outcome = e
+        with self._cond:
+            self._running.discard(job)
+            job.data = None
+            if not job.done:
+                job.finished = time.time()
+                if isinstance(outcome, Exception):
+                    job.error = str(outcome)
+                    self._changed(job, 'failed')
+                else:
+                    job.result, job.mimetype, observations = outcome
+                    metrics.registry.replay(observations)
+                    self._changed(job, 'done')
+                self.completed += 1
+                metrics.JOB_RUN_SECONDS.observe(job.finished - job.started, status=job.status)
+            self._dispatch()
+        if job.on_done is not None and job.status == 'done':
+            job.on_done(job)
+
+    def _watch(self):
+        while True:
+            time.sleep(1.0)
+            try:
+                self._check()
+            except Exception as e:
+                # Timeouts, reaping and expiry must go on after an unexpected error
+                print(f"[Error] Job watchdog: {e!r}")
+
+    def _check(self):
+        now = time.time()
+        with self._cond:
+            for job in list(self._running):
+                if not job.done and now - job.started > self.timeout:
+                    job.finished = now
+                    job.error = f'Timed out after {self.timeout:g}s'
+                    self._changed(job, 'timeout')
+                    metrics.JOB_RUN_SECONDS.observe(now - job.started, status='timeout')
+                    self._retire(job.executor)
+            self._reap()
+            for job_id, job in list(self._jobs.items()):
+                if job.done and job.finished and now - job.finished > self.result_ttl:
+                    del self._jobs[job_id]
+
+    def submit(self, data, stages, output='.png', quality=None, on_done=None):
+        """Queue a pipeline run over ``data``; returns the Job.
+
+        ``on_done(job)`` is called from a pool thread once the job succeeds.
+        """
+        job = Job(stages, output, quality, data, on_done)
+        with self._cond:
+            if len(self._pending) + len(self._running) >= self.max_depth:
+                self.rejected += 1
+                raise QueueFull(f'Job queue is full ({self.max_depth} jobs)')
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._dispatch()
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if it already finished"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return False
+            if job in self._pending:
+                self._pending.remove(job)
+                job.data = None
+            elif job.future is not None and not job.future.cancel():
+                # Already running in a worker, which cannot be interrupted
+                self._retire(job.executor)
+            job.finished = time.time()
+            self._changed(job, 'cancelled')
+            return True
+
+    def wait(self, job_id, version=-1, timeout=None):
+        """Block until the job's status changes past ``version`` (or it is done)"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._cond.wait_for(lambda: job.version > version or job.done, timeout=timeout)
+            return job
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'queued': len(self._pending),
+                'running': len(self._running),
+                'max_depth': self.max_depth,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'pool_restarts': self.restarts,
+                'limits': self.limits,
+                'shared_memory': self.ring.stats() if self.ring is not None else None,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        if self.ring is not None:
+            self.ring.close()
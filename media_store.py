@@ -0,0 +1,247 @@
+import mimetypes
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Stored media is evicted down to this share of its quotas, so a busy store
+# does not evict on every upload
+LOW_WATER = 0.9
+INDEX_NAME = 'index.sqlite3'
+
+
+class MediaStore:
+    """Uploads and results on disk, addressed by content key and kept within quotas.
+
+    Files live in ``<root>/<key[:2]>/<key><ext>`` so no directory grows
+    large. A SQLite index holds each entry's size and last access time;
+    a background thread evicts entries not accessed for ``ttl`` seconds and,
+    least recently used first, whatever exceeds ``max_bytes`` or
+    ``max_files``, without walking the tree. The index is shared safely by
+    every process using the same root.
+    """
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024, max_files=0, ttl=7 * 24 * 3600,
+                 sweep_interval=300.0, touch_interval=60.0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # Access times are written back in batches; reads only need them for eviction
+        self.touch_interval = touch_interval
+        os.makedirs(self.root, exist_ok=True)
+        self._index_path = os.path.join(self.root, INDEX_NAME)
+        # The index connection of the process that opened it (see _db)
+        self._conn = None
+        self._pid = None
+        self._inherited = None
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._last_flush = time.time()
+        self._wake = threading.Event()
+        self._thread = None
+
+        self.evictions = {'ttl': 0, 'size': 0}
+        self.evicted_bytes = 0
+        self.sweeps = 0
+        self.last_sweep = None
+        self.last_sweep_seconds = None
+        self.bytes = self.files = 0
+
+    @property
+    def _db(self):
+        # Opened on first use in each process, not when the store is created:
+        # run.py creates it at import, which a pre-fork server does in the
+        # master, and a SQLite connection must not be used across fork()
+        if self._pid != os.getpid():
+            self._connect()
+        return self._conn
+
+    def _connect(self):
+        fresh = not os.path.exists(self._index_path)
+        # One inherited from the parent is left alone: closing it here could disturb the parent's
+        self._inherited = self._conn
+        db = sqlite3.connect(self._index_path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, name TEXT NOT NULL, '
+                   'size INTEGER NOT NULL, mimetype TEXT NOT NULL, accessed REAL NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        if fresh:
+            db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', self._scan())
+        self.files, self.bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        self._conn, self._pid = db, os.getpid()
+
+    def _ensure_sweeper(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='media-sweeper', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                # Busy index (another process sweeping); try again next round
+                pass
+
+    def _totals(self):
+        with self._lock:
+            files, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return size, files
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def _scan(self):
+        rows = []
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                if name.endswith('.tmp'):
+                    # Left behind by an interrupted write
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                rows.append((os.path.splitext(name)[0], name, stat.st_size, mimetype, stat.st_mtime))
+        return rows
+
+    def rescan(self):
+        """Rebuild the index from the files on disk, e.g. after the index was lost"""
+        rows = self._scan()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def put(self, key, data, mimetype):
+        """Store ``data`` under ``key`` (a no-op if it is already stored); returns its path"""
+        self._ensure_sweeper()
+        name = key + (mimetypes.guess_extension(mimetype) or '')
+        path = self._path(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so readers never see a partial file and a
+            # failed write leaves nothing behind
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        with self._lock:
+            stored = self._db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+            self._db.execute(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET accessed = excluded.accessed',
+                (key, name, len(data), mimetype, time.time()))
+            self._touched.pop(key, None)
+            if stored is None:
+                self.bytes += len(data)
+                self.files += 1
+        if self._over_quota():
+            self._wake.set()
+        return path
+
+    def get(self, key):
+        """``(path, mimetype)`` of a stored entry, or None; counts as an access"""
+        with self._lock:
+            row = self._db.execute('SELECT name, mimetype FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._touched[key] = time.time()
+        if row is None:
+            return None
+        path = self._path(row[0])
+        if not os.path.exists(path):
+            self._forget([key])
+            return None
+        self._maybe_flush()
+        return path, row[1]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.touch_interval:
+            self._flush_touches()
+
+    def _flush_touches(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._last_flush = time.time()
+            self._db.executemany('UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?',
+                                 [(accessed, key) for key, accessed in touched.items()])
+
+    def _forget(self, keys):
+        with self._lock:
+            self._db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+
+    def _over_quota(self, share=1.0):
+        return (self.bytes > self.max_bytes * share
+                or (self.max_files and self.files > self.max_files * share))
+
+    def _evict(self, rows, reason):
+        for key, name, size in rows:
+            with self._lock:
+                # Skip entries another process has already evicted
+                deleted = self._db.execute('DELETE FROM entries WHERE key = ?', (key,)).rowcount
+            if not deleted:
+                continue
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            self.evictions[reason] += 1
+            self.evicted_bytes += size
+            self.bytes -= size
+            self.files -= 1
+
+    def sweep(self, now=None):
+        """Evict expired entries, then least recently used ones until within quota"""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        self._flush_touches()
+        if self.ttl:
+            with self._lock:
+                expired = self._db.execute('SELECT key, name, size FROM entries WHERE accessed < ?',
+                                           (now - self.ttl,)).fetchall()
+            self._evict(expired, 'ttl')
+
+        # Other processes share the index, so start from its real totals
+        self.bytes, self.files = self._totals()
+        if self._over_quota():
+            with self._lock:
+                oldest = self._db.execute('SELECT key, name, size FROM entries ORDER BY accessed').fetchall()
+            for row in oldest:
+                if not self._over_quota(LOW_WATER):
+                    break
+                self._evict([row], 'size')
+
+        self.sweeps += 1
+        self.last_sweep = now
+        self.last_sweep_seconds = round(time.perf_counter() - start, 4)
+
+    def stats(self):
+        # From the shared index, so they include other processes' writes
+        self.bytes, self.files = self._totals()
+        return {
+            'root': self.root,
+            'files': self.files,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'max_files': self.max_files,
+            'ttl_seconds': self.ttl,
+            'evictions': dict(self.evictions),
+            'evicted_bytes': self.evicted_bytes,
+            'sweeps': self.sweeps,
+            'last_sweep': self.last_sweep,
+            'last_sweep_seconds': self.last_sweep_seconds,
+        }
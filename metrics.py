@@ -0,0 +1,241 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Image size buckets, by megapixels
+SIZE_BUCKETS = ((1, '0-1MP'), (4, '1-4MP'), (16, '4-16MP'), (64, '16-64MP'))
+
+
+def size_bucket(img):
+    """Size label of an image (or its shape); 'unknown' for None"""
+    if img is None:
+        return 'unknown'
+    shape = getattr(img, 'shape', img)
+    megapixels = shape[0] * shape[1] / 1e6
+    for limit, label in SIZE_BUCKETS:
+        if megapixels < limit:
+            return label
+    return f'{SIZE_BUCKETS[-1][0]}MP+'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of series, one per combination of label values"""
+
+    type = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for the text format"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+        self.registry.captured(self.name, labels, amount)
+
+    def samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in self._series.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        with self._lock:
+            return [('', key, None, value) for key, value in self._series.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), then the sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+        self.registry.captured(self.name, labels, value)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        samples = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                samples.append(('_bucket', key, [('le', _format_value(bound))], cumulative))
+            samples.append(('_sum', key, None, series[-1]))
+            samples.append(('_count', key, None, cumulative))
+        return samples
+
+
+class Registry:
+    """Process-wide metrics, rendered in the Prometheus text format.
+
+    ``collector()`` callables add values that are cheaper to read at scrape
+    time (queue depths, cache sizes); they return (name, help, type,
+    [(labels dict, value)]) tuples.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._capture = None
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    @contextmanager
+    def capture(self):
+        """Also record counter and histogram updates in a list, e.g. to ship
+        them from a worker process to the server with ``replay()``"""
+        observations = []
+        self._capture = observations
+        try:
+            yield observations
+        finally:
+            self._capture = None
+
+    def captured(self, name, labels, value):
+        capture = self._capture
+        if capture is not None:
+            capture.append((name, labels, value))
+
+    def replay(self, observations):
+        for name, labels, value in observations:
+            metric = self._metrics.get(name)
+            if isinstance(metric, Histogram):
+                metric.observe(value, **labels)
+            elif isinstance(metric, Counter):
+                metric.inc(value, **labels)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, key, extra, value in samples:
+                lines.append(f'{metric.name}{suffix}{_format_labels(metric.labels, key, extra)} {_format_value(value)}')
+        for fn in self._collectors:
+            for name, help, kind, series in fn():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in series:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    'image_stage_seconds', 'Time spent in each processing step', ('effect', 'stage', 'size'))
+STAGE_ERRORS = registry.counter(
+    'image_stage_errors_total', 'Processing steps that raised', ('effect', 'stage'))
+REQUEST_SECONDS = registry.histogram(
+    'http_request_seconds', 'Time to build each HTTP response', ('endpoint', 'method', 'status'))
+REQUESTS_IN_FLIGHT = registry.gauge(
+    'http_requests_in_flight', 'HTTP requests being handled')
+JOB_WAIT_SECONDS = registry.histogram(
+    'job_queue_wait_seconds', 'Time jobs spend queued before a worker picks them up')
+JOB_RUN_SECONDS = registry.histogram(
+    'job_run_seconds', 'Time jobs spend running in a worker', ('status',))
+
+
+class _Timer:
+    __slots__ = ('effect', 'stage', 'img', 'start')
+
+    def __init__(self, effect, stage, img):
+        self.effect = effect
+        self.stage = stage
+        self.img = img
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            STAGE_ERRORS.inc(effect=self.effect, stage=self.stage)
+        STAGE_SECONDS.observe(time.perf_counter() - self.start,
+                              effect=self.effect, stage=self.stage, size=size_bucket(self.img))
+
+
+def timed(effect, stage, img=None):
+    """Time a ``with`` block as one ``stage`` of ``effect``.
+
+    The size label comes from ``img``; a block that produces the image
+    (e.g. decoding) can set it on the returned timer instead.
+    """
+    return _Timer(effect, stage, img)
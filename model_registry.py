@@ -0,0 +1,130 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ModelPool:
+    """A small pool of identical model instances, handed out one thread at a time.
+
+    OpenCV DNN nets keep their input blob on the net object, so two threads
+    calling ``setInput``/``forward`` on the same net race each other. The pool
+    loads instances lazily (up to ``size``) and lends each one to a single
+    caller at a time.
+    """
+
+    def __init__(self, name, loader, size=1):
+        self.name = name
+        self.loader = loader
+        self.size = max(1, int(size))
+        self._idle = []
+        self._instances = 0
+        self._cond = threading.Condition()
+        self.load_seconds = []
+        self.uses = 0
+
+    def _load_instance(self):
+        start = time.perf_counter()
+        model = self.loader()
+        self.load_seconds.append(time.perf_counter() - start)
+        return model
+
+    def warm(self, count=1):
+        """Load instances up front until at least ``count`` exist."""
+        count = min(max(1, count), self.size)
+        while True:
+            with self._cond:
+                if self._instances >= count:
+                    return
+                self._instances += 1
+            try:
+                model = self._load_instance()
+            except Exception:
+                with self._cond:
+                    self._instances -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(model)
+                self._cond.notify()
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """Borrow a model instance for the duration of the ``with`` block."""
+        model = None
+        with self._cond:
+            if not self._idle and self._instances < self.size:
+                # Reserve a slot and load outside the lock so other threads
+                # can keep using the instances that already exist.
+                self._instances += 1
+                load_new = True
+            else:
+                load_new = False
+                if not self._cond.wait_for(lambda: self._idle, timeout=timeout):
+                    raise TimeoutError(f"No '{self.name}' model available after {timeout}s")
+                model = self._idle.pop()
+            self.uses += 1
+
+        if load_new:
+            try:
+                model = self._load_instance()
+            except Exception:
+                with self._cond:
+                    self._instances -= 1
+                    self.uses -= 1
+                    self._cond.notify()
+                raise
+
+        try:
+            yield model
+        finally:
+            with self._cond:
+                self._idle.append(model)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            loads = len(self.load_seconds)
+            return {
+                'loaded': loads > 0,
+                'instances': self._instances,
+                'pool_size': self.size,
+                'load_seconds': round(sum(self.load_seconds), 4),
+                'uses': self.uses,
+                'reuses': max(0, self.uses - loads),
+            }
+
+
+class ModelRegistry:
+    """Process-wide registry of lazily loaded, reusable models."""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader, pool_size=1):
+        """Register a loader; nothing is loaded until the model is first used."""
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = ModelPool(name, loader, pool_size)
+            return self._pools[name]
+
+    def get(self, name):
+        try:
+            return self._pools[name]
+        except KeyError:
+            raise KeyError(f"Unknown model '{name}'") from None
+
+    def acquire(self, name, timeout=None):
+        return self.get(name).acquire(timeout=timeout)
+
+    def preload(self, names=None):
+        """Load one instance of each named model (all registered ones by default)."""
+        for name in names or list(self._pools):
+            self.get(name).warm()
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+# Shared by every effect in the process
+registry = ModelRegistry()
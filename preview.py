@@ -0,0 +1,60 @@
+import math
+import os
+import threading
+
+# Long side of previews, and the smallest the latency target may shrink it to
+PREVIEW_MAX_SIDE = int(os.environ.get('PREVIEW_MAX_SIDE', 1280))
+PREVIEW_MIN_SIDE = int(os.environ.get('PREVIEW_MIN_SIDE', 480))
+# Time a preview should take to render
+PREVIEW_TARGET_MS = float(os.environ.get('PREVIEW_TARGET_MS', 250))
+SIDE_STEP = 64
+
+
+class PreviewSizer:
+    """Pick preview sizes that render within a latency target.
+
+    Keeps a running estimate of the seconds per pixel of each stage chain
+    and shrinks the previews of slow chains until the estimate fits
+    ``target_ms``, never below ``min_side``.
+    """
+
+    def __init__(self, target_ms=PREVIEW_TARGET_MS, max_side=PREVIEW_MAX_SIDE,
+                 min_side=PREVIEW_MIN_SIDE, smoothing=0.3):
+        self.target = target_ms / 1000
+        self.max_side = max_side
+        self.min_side = min(min_side, max_side)
+        self.smoothing = smoothing
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def side(self, chain, size, max_side=None):
+        """Long side to render ``chain`` at for an image of ``size`` (width, height)"""
+        max_side = min(max_side or self.max_side, self.max_side, max(size))
+        with self._lock:
+            rate = self._rates.get(chain)
+        if rate is None:
+            return max_side
+        # Pixels that fit the target, for this image's aspect ratio
+        aspect = min(size) / max(size)
+        side = int(math.sqrt(self.target / rate / aspect))
+        # Whole steps, so small swings in the estimate keep hitting cached previews
+        side -= side % SIDE_STEP
+        return max(min(side, max_side), min(self.min_side, max_side))
+
+    def record(self, chain, size, side, seconds):
+        """Feed back how long a preview of ``side`` took"""
+        scale = min(1.0, side / max(size))
+        pixels = max(1.0, size[0] * size[1] * scale * scale)
+        with self._lock:
+            old = self._rates.get(chain)
+            rate = seconds / pixels
+            self._rates[chain] = rate if old is None else old + self.smoothing * (rate - old)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'target_ms': self.target * 1000,
+                'max_side': self.max_side,
+                'min_side': self.min_side,
+                'ms_per_megapixel': {chain: round(rate * 1e9, 1) for chain, rate in self._rates.items()},
+            }
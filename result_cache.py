@@ -0,0 +1,211 @@
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+
+def normalize_params(params):
+    """Canonical form of effect parameters, so equal settings hash equally.
+
+    ``None`` values are dropped, numeric strings become numbers and whole
+    floats become ints (``"5"``, ``5`` and ``5.0`` are the same blur sigma).
+    """
+    normalized = {}
+    for name, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+            try:
+                value = float(value)
+            except ValueError:
+                normalized[name] = value
+                continue
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        normalized[name] = value
+    return normalized
+
+
+def make_key(data, effect, params=None):
+    """Content address of an effect result: hash of input bytes, effect and settings"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(effect.encode())
+    digest.update(b'\0')
+    digest.update(json.dumps(normalize_params(params), sort_keys=True).encode())
+    digest.update(b'\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class _MemoryTier:
+    """LRU of encoded results bounded by total bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, data, mimetype):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[0])
+        self._entries[key] = (data, mimetype)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _DiskTier:
+    """Results stored as ``<dir>/<key[:2]>/<key><ext>``, evicted least recently used first"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        # key -> (path, size), oldest access first
+        self._index = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                if name.endswith('.tmp'):
+                    # Left behind by an interrupted write
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_atime, os.path.splitext(name)[0], path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._index[key] = (path, size)
+            self.bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._index:
+            _, (path, size) = self._index.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        path, _ = entry
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self._index.pop(key, None)
+            return None
+        self._index.move_to_end(key)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return data, mimetype
+
+    def put(self, key, data, mimetype):
+        if len(data) > self.max_bytes or key in self._index:
+            return
+        ext = mimetypes.guess_extension(mimetype) or ''
+        shard_dir = os.path.join(self.directory, key[:2])
+        os.makedirs(shard_dir, exist_ok=True)
+        path = os.path.join(shard_dir, key + ext)
+        # Write then rename so readers never see a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._index[key] = (path, len(data))
+        self.bytes += len(data)
+        self._evict()
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ResultCache:
+    """Content-addressed cache of encoded effect results.
+
+    Lookups go to an in-memory LRU first and then, if configured, to a disk
+    tier; disk hits are promoted back into memory.
+    """
+
+    def __init__(self, memory_bytes=128 * 1024 * 1024, disk_dir=None, disk_bytes=1024 * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._memory = _MemoryTier(memory_bytes)
+        self._disk = _DiskTier(disk_dir, disk_bytes) if disk_dir else None
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    def get(self, key):
+        """Return ``(data, mimetype)`` for a cached result, or None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self.hits['memory'] += 1
+                return entry
+            if self._disk is not None:
+                entry = self._disk.get(key)
+                if entry is not None:
+                    self.hits['disk'] += 1
+                    self._memory.put(key, *entry)
+                    return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, data, mimetype):
+        data = bytes(data)
+        with self._lock:
+            self._memory.put(key, data, mimetype)
+            if self._disk is not None:
+                self._disk.put(key, data, mimetype)
+
+    def get_or_compute(self, key, compute, mimetype):
+        """Return ``(data, mimetype, hit)``, calling ``compute()`` for the bytes on a miss"""
+        entry = self.get(key)
+        if entry is not None:
+            return entry[0], entry[1], True
+        data = compute()
+        self.put(key, data, mimetype)
+        return bytes(data), mimetype, False
+
+    def stats(self):
+        with self._lock:
+            lookups = sum(self.hits.values()) + self.misses
+            stats = {
+                'hits': dict(self.hits),
+                'misses': self.misses,
+                'hit_ratio': round(sum(self.hits.values()) / lookups, 4) if lookups else 0.0,
+                'memory': {'entries': len(self._memory), 'bytes': self._memory.bytes,
+                           'max_bytes': self._memory.max_bytes, 'evictions': self._memory.evictions},
+            }
+            if self._disk is not None:
+                stats['disk'] = {'entries': len(self._disk), 'bytes': self._disk.bytes,
+                                 'max_bytes': self._disk.max_bytes, 'evictions': self._disk.evictions}
+            return stats
@@ -1,22 +1,150 @@
-from flask import Flask, render_template, request, send_file
+from flask import Flask, Request, render_template, request, send_file, jsonify, Response, url_for, g
 from werkzeug.utils import secure_filename
-from time import time
-from hashlib import md5
 from os.path import join
 import os
+import re
+import json
+import cProfile
+import gc
+import threading
+import time
+import zipfile
+import cv2
 from datetime import datetime 
-from img2Sketch import PencilSketch
-from img2Cartoon import Cartoon
-from colorization import Colorization
-from image_compression import ImageCompression
-from photo_enhancer import PhotoEnhancer
-from oil_painting import OilPaintingEffect
-from background_removal import BackgroundRemoval
+# Effect modules are imported by the routes (and pipeline stages) that use them
+from effect_pipeline import Pipeline, STAGES, load_stages, parse_stages
+from image_io import (MIMETYPES, ImageTooLarge, InvalidImage, check_image_size, decode_image, decode_reduced,
+                      encode_image, guess_mimetype, image_size, read_bytes, to_8bit)
+from job_queue import JobQueue, QueueFull
+from media_store import MediaStore
+import metrics
+from model_registry import registry
+from preview import PreviewSizer
+from result_cache import ResultCache, make_key
+from image_compression import ImageCompression, available_formats as compression_formats
 from io import BytesIO
+from itertools import count
+
+class UploadRequest(Request):
+    """Keeps uploaded files in memory rather than spooling those over 500 KB
+    to a temporary file, so read_bytes() hands their buffer to the decoder
+    without a copy. MAX_CONTENT_LENGTH bounds what a request can hold."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
 
-UPLOAD_FOLDER = "./static/media/"
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.request_class = UploadRequest
+# Larger requests are refused with 413, from Content-Length before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('MAX_UPLOAD_MB', 64)) * 1024 * 1024)
+# Uploads and results live in memory; set PERSIST_MEDIA=1 to also keep them on disk
+app.config['PERSIST_MEDIA'] = os.environ.get('PERSIST_MEDIA') == '1'
+# With PROFILE_REQUESTS=1, any request with ?profile=1 is run under cProfile
+# and its stats are written to PROFILE_DIR (open with snakeviz or pstats)
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS') == '1'
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', './profiles')
+
+def warmup(effects=None, models=None):
+    """Import effects and load models now rather than on first use.
+
+    Run in a pre-fork server's master process (e.g. gunicorn --preload),
+    the forked workers share the imported modules and model weights
+    copy-on-write.
+    """
+    if effects:
+        load_stages(None if effects == 'all' else effects.split(','))
+    if models:
+        # Models are registered by their effect modules
+        load_stages()
+        registry.preload(None if models == 'all' else models.split(','))
+    # Color tables of the effects loaded so far
+    from color_lut import preload_luts
+    preload_luts()
+    # Keep the garbage collector off everything loaded so far, so it does not
+    # write to (and so copy) those pages in every worker
+    gc.freeze()
+
+# Optionally import effects and load models at startup instead of on the first
+# request, e.g. PRELOAD_EFFECTS=all or PRELOAD_MODELS=colorization
+if os.environ.get('PRELOAD_EFFECTS') or os.environ.get('PRELOAD_MODELS'):
+    warmup(os.environ.get('PRELOAD_EFFECTS'), os.environ.get('PRELOAD_MODELS'))
+
+# Encoded results keyed by input bytes + effect + settings; the disk tier is optional
+result_cache = ResultCache(
+    memory_bytes=int(os.environ.get('RESULT_CACHE_MB', 128)) * 1024 * 1024,
+    disk_dir=os.environ.get('RESULT_CACHE_DIR') or None,
+    disk_bytes=int(os.environ.get('RESULT_CACHE_DISK_MB', 1024)) * 1024 * 1024,
+)
+
+def cached_send(effect, data, params, render, mimetype):
+    """Send an effect result from the cache, calling render() for the bytes on a miss"""
+    key = make_key(data, effect, params)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+    body, mimetype, hit = result_cache.get_or_compute(key, render, mimetype)
+    response = send_file(BytesIO(body), mimetype=mimetype)
+    response.set_etag(key)
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+MEDIA_KEY = re.compile(r'[0-9a-f]{40}')
+
+# Media kept on disk (saved uploads, /edit images), bounded by size, file
+# count and idle time; served only through /media/<key>
+media_store = MediaStore(
+    os.environ.get('MEDIA_ROOT', './media_store'),
+    max_bytes=int(os.environ.get('MEDIA_STORE_MB', 1024)) * 1024 * 1024,
+    max_files=int(os.environ.get('MEDIA_MAX_FILES', 0)),
+    ttl=float(os.environ.get('MEDIA_TTL_HOURS', 168)) * 3600,
+    sweep_interval=float(os.environ.get('MEDIA_SWEEP_SECONDS', 300)),
+)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024):g} MB", 413
+
+class ZipChunks:
+    """Write-only file for zipfile that hands over what was written so far"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries, download_name):
+    """Response sending a zip of (name, bytes) ``entries`` while they are still being produced"""
+    def generate():
+        sink = ZipChunks()
+        # PNGs are already compressed, so they are stored as-is
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            for name, data in entries:
+                archive.writestr(name, data)
+                yield sink.take()
+        # The central directory
+        yield sink.take()
+    return Response(generate(), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+def upload_stem(file):
+    return os.path.splitext(secure_filename(file.filename or ''))[0] or 'image'
+
+def invalid_image(e):
+    """Response for an upload that could not be decoded, or has too many pixels"""
+    if isinstance(e, ImageTooLarge):
+        return str(e), 413
+    return 'Invalid image', 400
 
 # Context processor to make 'now' available in all templates
 @app.context_processor
@@ -30,39 +158,40 @@ def upload_file():
         fileObject = request.files['file']
         effect = request.form.get('effect', 'sketch')
 
-        # Save the original file
-        original_filename = join(app.config["UPLOAD_FOLDER"], "original.jpg")
-        fileObject.seek(0)
-        fileObject.save(original_filename)
+        # Keep the original in memory under its content address, so
+        # concurrent uploads never share a file name
+        data = read_bytes(fileObject)
+        original_key = make_key(data, 'original')
+        original_type = guess_mimetype(data)
+        result_cache.put(original_key, data, original_type)
 
         # Determine extension based on effect
         ext = '.jpg' if effect in ['compression', 'oil_painting'] else '.png'
 
-        # Create a new name for converted file
-        new_filename = secure_filename(md5(str(time()).encode()).hexdigest() + ext)
-        new_filepath = join(app.config["UPLOAD_FOLDER"], new_filename)
-
-        # Reset pointer again to reuse same fileObject
-        fileObject.seek(0)
-
-        # Apply the selected effect
+        # Apply the selected effect, unless this upload was already processed
         try:
-            if effect == 'cartoon':
-                Cartoon(fileObject).convert(new_filepath)
-            elif effect == 'background_removal':
-                BackgroundRemoval(fileObject).convert_to_file(new_filepath)
-            elif effect == 'compression':
-                ImageCompression(fileObject).compress(new_filepath, quality=60)
+            if effect == 'compression':
+                params = {'quality': 60}
+                pipeline = Pipeline([(effect, params)])
+            elif effect == 'cartoon':
+                params = {'quality': request.form.get('cartoon_quality', 'full')}
+                pipeline = Pipeline([(effect, params)], output=ext)
             elif effect == 'colorization':
-                Colorization(fileObject).convert(new_filepath)
-            elif effect == 'enhancer':
-                PhotoEnhancer(fileObject).enhance(new_filepath)
-            elif effect == 'oil_painting':
-                OilPaintingEffect(fileObject).apply_oil_painting(new_filepath)
+                params = {'quality': request.form.get('colorization_quality', 'full')}
+                pipeline = Pipeline([(effect, params)], output=ext)
             else:
-                PencilSketch().convert(new_filepath)
+                params = None
+                pipeline = Pipeline([effect if effect in STAGES else 'sketch'], output=ext)
+            key = make_key(data, effect, params)
+            body, mimetype, _ = result_cache.get_or_compute(key, lambda: pipeline.render(data), pipeline.mimetype)
 
-            return render_template('index.html', file_url=new_filepath, original_url=original_filename)
+            # Only touch the disk when asked to
+            if app.config['PERSIST_MEDIA'] or request.form.get('save'):
+                media_store.put(original_key, data, original_type)
+                media_store.put(key, body, mimetype)
+
+            return render_template('index.html', file_url=url_for('media', key=key),
+                                   original_url=url_for('media', key=original_key))
         except Exception as e:
             return render_template('index.html', error=str(e))
     else:
@@ -72,24 +201,135 @@ def upload_file():
 @app.route('/edit', methods=['GET', 'POST'])
 def edit_image():
     if request.method == 'POST':
-        file = request.files['file']
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        return render_template('edit_page.html', image_path=filepath)
+        data = read_bytes(request.files['file'])
+        mimetype = guess_mimetype(data)
+        if not mimetype.startswith('image/'):
+            return 'Invalid image', 400
+        # Content addressed, so two users' "image.jpg" never overwrite each other
+        key = make_key(data, 'original')
+        media_store.put(key, data, mimetype)
+        return render_template('edit_page.html', image_path=url_for('media', key=key), image_key=key,
+                               effects=[name for name in STAGES if name != 'background_removal'])
 
     return render_template('edit_page.html', image_path=None)
 
+def media_bytes(key):
+    """Bytes stored under a media key, or None"""
+    if not MEDIA_KEY.fullmatch(key or ''):
+        return None
+    entry = result_cache.get(key)
+    if entry is not None:
+        return entry[0]
+    stored = media_store.get(key)
+    if stored is None:
+        return None
+    with open(stored[0], 'rb') as f:
+        return f.read()
+
+@app.route('/edit/apply', methods=['POST'])
+def edit_apply():
+    """Crop, rotate, flip and resize an image, then optionally run effects on it, in one render.
+
+    ``ops`` lists the edits as JSON (``[{"op": "rotate", "angle": 90}, ...]``)
+    or in the pipeline syntax (``rotate:angle=90,crop:x=10;y=20;width=300;height=200``),
+    and ``stages`` the effects to run on the result. The edits are composed
+    into one transform applied as the image is decoded. The image is an
+    upload, or the ``key`` /edit stored it under, so it is not sent again.
+    """
+    from edit_ops import parse_ops
+    output = '.' + request.form.get('format', 'png').lstrip('.')
+    try:
+        ops = parse_ops(request.form.get('ops'))
+        spec = request.form.get('stages', '')
+        chain = Pipeline(ops + parse_stages(spec), output=output, quality=request.form.get('quality', type=int))
+    except ValueError as e:
+        return str(e), 400
+    if not chain.stages and chain.edits is None and chain.output != '.jpg':
+        return 'No edits or stages given', 400
+    if 'image' in request.files:
+        data = read_bytes(request.files['image'])
+    else:
+        data = media_bytes(request.form.get('key'))
+        if data is None:
+            return 'Image not found', 404
+    try:
+        params = {'ops': json.dumps(ops), 'stages': spec, 'format': chain.output, 'quality': chain.quality}
+        return cached_send('edit', data, params, lambda: chain.render(data), chain.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
+    except ValueError as e:
+        # A crop box outside the image, or an output that would be too big
+        return str(e), 400
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+def background_mask_params():
+    # A mask depends on the model and the resolution the model sees
+    from background_removal import DEFAULT_MODEL, WORKING_SIZE
+    return {'model': DEFAULT_MODEL, 'working_size': WORKING_SIZE}
+
+def render_background_mask(data):
+    from background_removal import BackgroundRemoval
+    return encode_image(BackgroundRemoval.mask(decode_image(data, cv2.IMREAD_UNCHANGED)), '.png')
+
+def background_mask(data):
+    """PNG alpha mask of an upload, computed once and shared by the /remove-bg endpoints"""
+    key = make_key(data, 'background_mask', background_mask_params())
+    body, _, _ = result_cache.get_or_compute(key, lambda: render_background_mask(data), 'image/png')
+    return body
+
+def render_cutout(data):
+    from background_removal import BackgroundRemoval
+    mask = decode_image(background_mask(data), cv2.IMREAD_GRAYSCALE)
+    return encode_image(BackgroundRemoval.composite(decode_image(data, cv2.IMREAD_UNCHANGED), mask), '.png')
+
 @app.route('/remove-bg', methods=['POST'])
 def remove_bg():
     if 'image' not in request.files:
         return 'No image uploaded', 400
     file = request.files['image']
     try:
-        bg_removal = BackgroundRemoval(file)
-        output_io = bg_removal.convert()
-        output_io.seek(0)
-        return send_file(output_io, mimetype='image/png')
+        data = read_bytes(file)
+        return cached_send('background_removal', data, background_mask_params(),
+                           lambda: render_cutout(data), 'image/png')
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+@app.route('/remove-bg/mask', methods=['POST'])
+def remove_bg_mask():
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    file = request.files['image']
+    try:
+        data = read_bytes(file)
+        return cached_send('background_mask', data, background_mask_params(),
+                           lambda: render_background_mask(data), 'image/png')
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+@app.route('/remove-bg/batch', methods=['POST'])
+def remove_bg_batch():
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
+        return 'No images uploaded', 400
+    masks_only = request.form.get('output') == 'mask'
+    from background_removal import BackgroundRemoval
+    try:
+        images = [decode_image(file, cv2.IMREAD_UNCHANGED) for file in files]
+        # Segmented several images per session call
+        masks = BackgroundRemoval.masks(images)
+        suffix = 'mask' if masks_only else 'cutout'
+        names = [f"{index:04d}_{upload_stem(file)}_{suffix}.png" for index, file in enumerate(files)]
+        # Each cutout is composited and encoded as the zip is sent
+        entries = ((name, encode_image(mask if masks_only else BackgroundRemoval.composite(img, mask), '.png'))
+                   for name, img, mask in zip(names, images, masks))
+        return stream_zip(entries, 'background_removed.zip')
+    except InvalidImage as e:
+        return invalid_image(e)
     except Exception as e:
         return f'Error: {str(e)}', 500
 
@@ -98,12 +338,61 @@ def compress():
     if 'image' not in request.files:
         return 'No image uploaded', 400
     file = request.files['image']
+    form = request.form
+    max_kb = form.get('max_kb', type=float)
+    settings = {
+        'format': form.get('format', 'jpeg'),
+        'quality': form.get('quality', 40, type=int),
+        'max_bytes': form.get('max_bytes', type=int) or (int(max_kb * 1024) if max_kb else None),
+        'target_ssim': form.get('target_ssim', type=float),
+        'max_side': form.get('max_side', type=int),
+        'progressive': form.get('progressive') == '1',
+        'subsampling': form.get('subsampling') or None,
+    }
+    if settings['format'] != 'auto' and settings['format'] not in compression_formats():
+        return f"Unsupported format '{settings['format']}'; available: auto, {', '.join(compression_formats())}", 400
+    if settings['target_ssim'] is not None and not 0 < settings['target_ssim'] < 1:
+        return 'target_ssim must be between 0 and 1', 400
     try:
-        compressor = ImageCompression(file)
-        output_io = BytesIO()
-        compressor.image.convert('RGB').save(output_io, "JPEG", quality=40, optimize=True)
-        output_io.seek(0)
-        return send_file(output_io, mimetype='image/jpeg')
+        data = read_bytes(file)
+        key = make_key(data, 'compression', settings)
+        want_report = form.get('report') == '1'
+        if key in request.if_none_match and not want_report:
+            response = app.response_class(status=304)
+            response.set_etag(key)
+            return response
+
+        # The report is cached next to the image, so hits can still describe it
+        report_key = make_key(data, 'compression_report', settings)
+        start = time.perf_counter()
+        entry, report_entry = result_cache.get(key), result_cache.get(report_key)
+        hit = entry is not None and report_entry is not None
+        if hit:
+            # The time spent on this response, not on the search that filled the cache
+            body, report = entry[0], json.loads(report_entry[0])
+            report.update(candidates=0, elapsed_ms=round((time.perf_counter() - start) * 1000, 1))
+        else:
+            body, report = ImageCompression.optimize(decode_image(data, cv2.IMREAD_UNCHANGED), **settings)
+            result_cache.put(key, body, report['mimetype'])
+            result_cache.put(report_key, json.dumps(report).encode(), 'application/json')
+        if want_report:
+            return jsonify(report)
+
+        response = send_file(BytesIO(body), mimetype=report['mimetype'])
+        response.set_etag(key)
+        response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+        response.headers['X-Compression-Format'] = report['format']
+        response.headers['X-Compression-Quality'] = str(report['quality'])
+        response.headers['X-Compression-Bytes'] = str(report['bytes'])
+        response.headers['X-Compression-Target-Met'] = str(report['met']).lower()
+        if report['ssim'] is not None:
+            response.headers['X-Compression-SSIM'] = str(report['ssim'])
+        response.headers['Server-Timing'] = f"compress;dur={report['elapsed_ms']}"
+        return response
+    except InvalidImage as e:
+        return invalid_image(e)
+    except ValueError as e:
+        return str(e), 400
     except Exception as e:
         return f'Error: {str(e)}', 500
 
@@ -112,21 +401,42 @@ def colorize():
     if 'image' not in request.files:
         return 'No image uploaded', 400
     file = request.files['image']
+    quality = request.form.get('quality', 'full')
+    from colorization import QUALITY_MODES
+    if quality not in QUALITY_MODES:
+        return f"Unknown quality '{quality}'", 400
+    try:
+        data = read_bytes(file)
+        pipeline = Pipeline([('colorization', {'quality': quality})])
+        return cached_send('colorization', data, {'quality': quality},
+                           lambda: pipeline.render(data), pipeline.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+@app.route('/colorize/batch', methods=['POST'])
+def colorize_batch():
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
+        return 'No images uploaded', 400
+    batch_size = request.form.get('batch_size', type=int)
+    quality = request.form.get('quality', 'full')
+    from colorization import QUALITY_MODES, Colorization
+    if quality not in QUALITY_MODES:
+        return f"Unknown quality '{quality}'", 400
     try:
-        colorizer = Colorization(file)
-        # Output to BytesIO instead of file path
-        import tempfile
-        import os
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            temp_path = tmp.name
-        colorizer.convert(temp_path)
-        with open(temp_path, "rb") as f:
-            data = f.read()
-        os.remove(temp_path)
-        from io import BytesIO
-        output_io = BytesIO(data)
-        output_io.seek(0)
-        return send_file(output_io, mimetype='image/png')
+        if batch_size:
+            results = Colorization.convert_many(files, batch_size=batch_size, quality=quality)
+        else:
+            results = Colorization.convert_many(files, quality=quality)
+
+        names = [f"{index:04d}_{upload_stem(file)}_colorized.png" for index, file in enumerate(files)]
+        # Each result is encoded as the zip is sent
+        entries = ((name, encode_image(colorized, '.png')) for name, colorized in zip(names, results))
+        return stream_zip(entries, 'colorized.zip')
+    except InvalidImage as e:
+        return invalid_image(e)
     except Exception as e:
         return f'Error: {str(e)}', 500
 
@@ -136,14 +446,33 @@ def oil_paint():
         return 'No image uploaded', 400
     file = request.files['image']
     try:
-        from io import BytesIO
-        painter = OilPaintingEffect(file)
-        output_io = BytesIO()
-        painter.apply_oil_painting(output_io)
-        output_io.seek(0)  # <-- This is important!
-        return send_file(output_io, mimetype='image/jpeg')
+        data = read_bytes(file)
+        pipeline = Pipeline(['oil_painting'], output='.jpg')
+        return cached_send('oil_painting', data, None,
+                           lambda: pipeline.render(data), pipeline.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        app.logger.exception("Oil painting failed")
+        return f'Error: {str(e)}', 500
+
+@app.route('/cartoon', methods=['POST'])
+def cartoon():
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    file = request.files['image']
+    quality = request.form.get('quality', 'full')
+    from img2Cartoon import QUALITY_MODES
+    if quality not in QUALITY_MODES:
+        return f"Unknown quality '{quality}'", 400
+    try:
+        data = read_bytes(file)
+        pipeline = Pipeline([('cartoon', {'quality': quality})])
+        return cached_send('cartoon', data, {'quality': quality},
+                           lambda: pipeline.render(data), pipeline.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
     except Exception as e:
-        print("Oil painting error:", e)
         return f'Error: {str(e)}', 500
 
 @app.route('/pencil_sketch', methods=['POST'])
@@ -152,15 +481,8 @@ def pencil_sketch():
         return 'No image uploaded', 400
     file = request.files['image']
     try:
-        import numpy as np
-        import cv2
-        from io import BytesIO
-
         # Read image from file storage
-        file_bytes = np.frombuffer(file.read(), np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        if image is None:
-            return 'Invalid image', 400
+        data = read_bytes(file)
 
         # Get parameters from request (form or query)
         blur_sigma = request.form.get('blurSigma', type=int)
@@ -168,19 +490,440 @@ def pencil_sketch():
         # Use defaults if not provided
         if blur_sigma is None:
             blur_sigma = 5
-        # ksize is always (0,0) for now
-        sketcher = PencilSketch(blur_sigma=blur_sigma, ksize=(0,0), sharpen_value=sharpen_value)
-        sketch = sketcher(image)
-
-        # Encode to PNG in memory
-        success, buffer = cv2.imencode('.png', sketch)
-        if not success:
-            return 'Encoding failed', 500
-        output_io = BytesIO(buffer)
-        output_io.seek(0)
-        return send_file(output_io, mimetype='image/png')
+
+        # ksize is always (0,0) for now; encoded to PNG in memory
+        pipeline = Pipeline([('sketch', {'blur_sigma': blur_sigma, 'sharpen_value': sharpen_value})])
+        render = lambda: pipeline.render(data)
+        session = request.form.get('session')
+        if session:
+            # Slider changes within an editing session reuse the decoded image and earlier blurs
+            render = lambda: render_intermediates(
+                data, session, lambda i: encode_image(i.render(blur_sigma, sharpen_value), pipeline.output))
+        return cached_send('sketch', data, {'blurSigma': blur_sigma, 'sharpenValue': sharpen_value},
+                           render, pipeline.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+def render_intermediates(data, session, render):
+    """``render`` the sketch intermediates of an upload, kept for the session's next requests if one is given"""
+    from img2Sketch import SketchIntermediates
+    from sketch_variants import sessions
+    load = lambda: to_8bit(decode_image(data))
+    if session:
+        return sessions.render(session, make_key(data, 'upload'), load, render)
+    return render(SketchIntermediates(load()))
+
+@app.route('/pencil_sketch/variants', methods=['POST'])
+def pencil_sketch_variants():
+    """Several blur/sharpen variants of one image in a single call.
+
+    ``variants=10:7,5:25`` lists (blurSigma, sharpenValue) pairs; otherwise
+    every combination of ``blurSigmas`` and ``sharpenValues`` is rendered.
+    Returns a labelled contact sheet, or the full-size PNGs with
+    ``format=zip``. With a ``session`` id the intermediates are kept for the
+    session's following requests.
+    """
+    from sketch_variants import THUMB_SIDE, parse_variants, render_sheet, render_zip
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    fmt = request.form.get('format', 'png').lstrip('.').lower()
+    quality = request.form.get('quality', type=int)
+    side = min(max(request.form.get('side', THUMB_SIDE, type=int), 64), 2048)
+    try:
+        pairs, columns = parse_variants(request.form.get('variants'), request.form.get('blurSigmas'),
+                                        request.form.get('sharpenValues'))
+        if fmt != 'zip' and '.' + fmt not in MIMETYPES:
+            raise ValueError(f"Unsupported output format '{fmt}'")
+    except ValueError as e:
+        return str(e), 400
+    try:
+        data = read_bytes(request.files['image'])
+        session = request.form.get('session')
+        if fmt == 'zip':
+            mimetype = 'application/zip'
+            render = lambda: render_intermediates(data, session, lambda i: render_zip(i, pairs))
+        else:
+            mimetype = MIMETYPES['.' + fmt]
+            render = lambda: render_intermediates(
+                data, session, lambda i: render_sheet(i, pairs, columns, '.' + fmt, quality, side))
+        params = {
+            'variants': ','.join(f'{sigma}:{sharpen}' for sigma, sharpen in pairs),
+            'columns': columns, 'format': fmt, 'quality': quality, 'side': side,
+        }
+        response = cached_send('sketch_variants', data, params, render, mimetype)
+        if fmt == 'zip':
+            response.headers['Content-Disposition'] = 'attachment; filename=sketch_variants.zip'
+        return response
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+@app.route('/pencil_sketch/sessions/stats', methods=['GET'])
+def pencil_sketch_session_stats():
+    from sketch_variants import sessions
+    return jsonify(sessions.stats())
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline():
+    # Chain effects on one decode, e.g. stages=enhancer,oil_painting,compression:quality=70
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    file = request.files['image']
+    spec = request.form.get('stages', '')
+    output = '.' + request.form.get('format', 'png').lstrip('.')
+    try:
+        chain = Pipeline(parse_stages(spec), output=output, quality=request.form.get('quality', type=int))
+    except ValueError as e:
+        return str(e), 400
+    if not chain.stages and chain.edits is None and chain.output != '.jpg':
+        return 'No stages given', 400
+    try:
+        data = read_bytes(file)
+        return cached_send('pipeline', data, {'stages': spec, 'format': chain.output, 'quality': chain.quality},
+                           lambda: chain.render(data), chain.mimetype)
+    except InvalidImage as e:
+        return invalid_image(e)
+    except Exception as e:
+        return f'Error: {str(e)}', 500
+
+# Heavy effects run in worker processes; created on first use so importing
+# the app does not start a process pool
+_job_queue = None
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        limits = {'colorization': int(os.environ.get('JOB_LIMIT_COLORIZATION', 1)),
+                  'background_removal': int(os.environ.get('JOB_LIMIT_BACKGROUND_REMOVAL', 1))}
+        _job_queue = JobQueue(
+            workers=int(os.environ.get('JOB_WORKERS', 0)) or None,
+            max_depth=int(os.environ.get('JOB_MAX_DEPTH', 64)),
+            limits=limits,
+            timeout=float(os.environ.get('JOB_TIMEOUT', 120)),
+            preload=os.environ.get('PRELOAD_MODELS') or None,
+        )
+    return _job_queue
+
+def job_info(job):
+    info = job.to_dict()
+    info['status_url'] = url_for('job_status', job_id=job.id)
+    info['result_url'] = url_for('job_result', job_id=job.id)
+    return info
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def jobs():
+    if request.method == 'GET':
+        return jsonify(get_job_queue().stats())
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    spec = request.form.get('stages') or request.form.get('effect', 'sketch')
+    output = '.' + request.form.get('format', 'png').lstrip('.')
+    quality = request.form.get('quality', type=int)
+    try:
+        # Validate here so bad requests fail fast instead of in a worker
+        stages = parse_stages(spec)
+        Pipeline(stages, output=output, quality=quality)
+    except ValueError as e:
+        return str(e), 400
+    try:
+        data = read_bytes(request.files['image'])
+        # Refused here rather than failing in a worker
+        check_image_size(data)
+        job = get_job_queue().submit(data, stages, output, quality)
+    except ImageTooLarge as e:
+        return str(e), 413
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    return jsonify(job_info(job)), 202, {'Location': url_for('job_status', job_id=job.id)}
+
+@app.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+def job_status(job_id):
+    job_queue = get_job_queue()
+    if request.method == 'DELETE':
+        if not job_queue.cancel(job_id):
+            return jsonify({'error': 'Job not found or already finished'}), 404
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_info(job))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # Server-sent events: one message per status change until the job is done
+    job_queue = get_job_queue()
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        version = -1
+        while True:
+            job = job_queue.wait(job_id, version, timeout=15)
+            if job is None:
+                return
+            if job.version == version:
+                yield ': keep-alive\n\n'
+                continue
+            version = job.version
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.done:
+                return
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# Previews render at screen size within PREVIEW_TARGET_MS; the full-size
+# render of the same chain follows in the job queue
+preview_sizer = PreviewSizer()
+# Full renders in flight by result key, so repeated previews share one job
+_full_renders = {}
+_full_renders_lock = threading.Lock()
+
+def full_render(data, stages, output, quality, key):
+    """Job rendering ``key`` at full size; reuses one that is still queued or running"""
+    job_queue = get_job_queue()
+    with _full_renders_lock:
+        job = job_queue.get(_full_renders.get(key, ''))
+        if job is not None and not job.done:
+            return job
+
+        def done(job):
+            # Shared with /pipeline, which uses the same key
+            result_cache.put(key, job.result, job.mimetype)
+            with _full_renders_lock:
+                _full_renders.pop(key, None)
+
+        job = job_queue.submit(data, stages, output, quality, on_done=done)
+        _full_renders[key] = job.id
+        return job
+
+@app.route('/preview', methods=['POST'])
+def preview():
+    """Screen-sized render of a stage chain now, with the full-size render queued behind it.
+
+    X-Full-Url is where the full result can be fetched; while it is still
+    rendering, X-Full-Events streams the job status until it is done.
+    """
+    if 'image' not in request.files:
+        return 'No image uploaded', 400
+    spec = request.form.get('stages') or request.form.get('effect', 'sketch')
+    output = '.' + request.form.get('format', 'png').lstrip('.')
+    try:
+        stages = parse_stages(spec)
+        chain = Pipeline(stages, output=output, quality=request.form.get('quality', type=int))
+    except ValueError as e:
+        return str(e), 400
+    if not chain.stages and chain.edits is None and chain.output != '.jpg':
+        return 'No stages given', 400
+    try:
+        start = time.perf_counter()
+        data = read_bytes(request.files['image'])
+        size = image_size(data)
+        side = preview_sizer.side(spec, size, request.form.get('max_side', type=int))
+        params = {'stages': spec, 'format': chain.output, 'quality': chain.quality}
+        full_key = make_key(data, 'pipeline', params)
+        full = result_cache.get(full_key)
+
+        def render():
+            if full is not None:
+                # Already rendered at full size: scaling it down is cheaper and exact
+                return encode_image(decode_reduced(full[0], side, cv2.IMREAD_UNCHANGED), chain.output, chain.quality)
+            render_start = time.perf_counter()
+            body = chain.preview(data, side)
+            preview_sizer.record(spec, size, side, time.perf_counter() - render_start)
+            return body
+
+        body, mimetype, hit = result_cache.get_or_compute(make_key(data, 'preview', dict(params, side=side)),
+                                                         render, chain.mimetype)
+        response = send_file(BytesIO(body), mimetype=mimetype)
+        response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+        response.headers['X-Preview-Size'] = str(side)
+        if full is not None:
+            response.headers['X-Full-Url'] = url_for('media', key=full_key)
+        else:
+            try:
+                job = full_render(data, stages, chain.output, chain.quality, full_key)
+                response.headers['X-Full-Url'] = url_for('job_result', job_id=job.id)
+                response.headers['X-Full-Events'] = url_for('job_events', job_id=job.id)
+            except QueueFull:
+                # The client falls back to rendering the full image directly
+                pass
+        response.headers['Server-Timing'] = f'preview;dur={(time.perf_counter() - start) * 1000:.1f}'
+        return response
+    except InvalidImage as e:
+        return invalid_image(e)
     except Exception as e:
         return f'Error: {str(e)}', 500
 
+@app.route('/preview/stats', methods=['GET'])
+def preview_stats():
+    return jsonify(preview_sizer.stats())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'done':
+        code = 202 if not job.done else 409
+        return jsonify(job.to_dict()), code
+    return send_file(BytesIO(job.result), mimetype=job.mimetype)
+
+# Live MJPEG sketch streams, keyed by id, for /pencil_sketch/stream/stats
+active_streams = {}
+_stream_ids = count(1)
+
+@app.route('/pencil_sketch/stream', methods=['GET'])
+def pencil_sketch_stream():
+    from img2Sketch import PencilSketch
+    from sketch_stream import SketchStream, MjpegSink, open_source
+
+    # Only the test pattern and (when enabled) local cameras can be streamed
+    source = request.args.get('source', 'test')
+    allowed = source == 'test' or source.startswith('test:') or (
+        source.isdigit() and os.environ.get('STREAM_ALLOW_DEVICES'))
+    if not allowed:
+        return 'Unsupported stream source', 400
+    try:
+        capture = open_source(source)
+    except ImageTooLarge as e:
+        return str(e), 413
+    except ValueError as e:
+        return str(e), 400
+
+    sketcher = PencilSketch(blur_sigma=request.args.get('blurSigma', 5, type=int),
+                            sharpen_value=request.args.get('sharpenValue', type=int))
+    sink = MjpegSink(quality=request.args.get('quality', 80, type=int))
+    stream = SketchStream(capture, sink, sketcher).start()
+    stream_id = next(_stream_ids)
+    active_streams[stream_id] = stream
+    client_gone = threading.Event()
+
+    def generate():
+        try:
+            yield from sink.chunks(client_gone)
+        finally:
+            # Client disconnected or the source ended
+            client_gone.set()
+            stream.stop()
+            active_streams.pop(stream_id, None)
+
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/pencil_sketch/stream/stats', methods=['GET'])
+def pencil_sketch_stream_stats():
+    return jsonify({str(stream_id): stream.stats() for stream_id, stream in list(active_streams.items())})
+
+@app.route('/media/<key>', methods=['GET'])
+def media(key):
+    """Serve an upload or effect result by its content address"""
+    if not MEDIA_KEY.fullmatch(key):
+        return 'Not found', 404
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        entry = result_cache.get(key)
+        if entry is not None:
+            body, mimetype = entry
+            response = send_file(BytesIO(body), mimetype=mimetype)
+        else:
+            # Not (or no longer) in memory, but it may be in the media store
+            stored = media_store.get(key)
+            if stored is None:
+                return 'Not found', 404
+            path, mimetype = stored
+            response = send_file(path, mimetype=mimetype)
+    response.set_etag(key)
+    # The bytes behind a content address never change
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    if app.config['PROFILE_REQUESTS'] and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def record_request(status):
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                    endpoint=request.endpoint or 'not_found',
+                                    method=request.method, status=status)
+    g.request_recorded = True
+
+@app.after_request
+def finish_request_metrics(response):
+    # Streamed responses (MJPEG, server-sent events) are timed until their first byte
+    record_request(response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        path = join(app.config['PROFILE_DIR'],
+                    f"{request.endpoint or 'request'}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof")
+        profiler.dump_stats(path)
+        response.headers['X-Profile'] = path
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    if 'request_start' not in g:
+        return
+    metrics.REQUESTS_IN_FLIGHT.dec()
+    if not g.get('request_recorded'):
+        record_request(500)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+@metrics.registry.collector
+def queue_and_cache_metrics():
+    cache = result_cache.stats()
+    families = [
+        ('result_cache_hits_total', 'Result cache hits by tier', 'counter',
+         [({'tier': tier}, hits) for tier, hits in cache['hits'].items()]),
+        ('result_cache_misses_total', 'Result cache misses', 'counter', [({}, cache['misses'])]),
+        ('result_cache_bytes', 'Bytes held by the in-memory result cache', 'gauge',
+         [({}, cache['memory']['bytes'])]),
+    ]
+    # Only report the job queue once it exists; scraping should not start a process pool
+    if _job_queue is not None:
+        jobs = _job_queue.stats()
+        families += [
+            ('job_queue_depth', 'Jobs waiting for a worker', 'gauge', [({}, jobs['queued'])]),
+            ('jobs_in_flight', 'Jobs running in a worker', 'gauge', [({}, jobs['running'])]),
+            ('jobs_rejected_total', 'Jobs refused because the queue was full', 'counter', [({}, jobs['rejected'])]),
+        ]
+    media = media_store.stats()
+    families += [
+        ('media_store_bytes', 'Bytes held by the media store', 'gauge', [({}, media['bytes'])]),
+        ('media_store_files', 'Files held by the media store', 'gauge', [({}, media['files'])]),
+        ('media_store_evictions_total', 'Media store evictions by reason', 'counter',
+         [({'reason': reason}, n) for reason, n in media['evictions'].items()]),
+    ]
+    models = registry.stats()
+    families.append(('model_uses_total', 'Times each model was acquired', 'counter',
+                     [({'model': name}, info['uses']) for name, info in models.items()]))
+    return families
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/media/stats', methods=['GET'])
+def media_stats():
+    return jsonify(media_store.stats())
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/models', methods=['GET'])
+def model_stats():
+    # Load time and reuse counts for every registered model
+    return jsonify(registry.stats())
+
 if __name__ == '__main__':
     app.run(debug=True)
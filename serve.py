@@ -0,0 +1,87 @@
+"""Production server for the web app.
+
+    python serve.py
+    gunicorn -c serve.py run:app        # the same settings, from gunicorn's CLI
+
+The module-level names below are gunicorn settings, read from the
+environment. By default there is one worker process serving WEB_THREADS
+requests at once: the effects spend their time in OpenCV and ONNX Runtime,
+which release the GIL, and heavy jobs run in the job queue's own process
+pool. The app keeps jobs, cached results, preview renders and sketch
+sessions in process memory, so with WEB_CONCURRENCY above 1 a follow-up
+request (e.g. GET /jobs/<id>) only works if it reaches the same worker.
+For the same reason workers are not recycled unless WEB_MAX_REQUESTS is
+set: a replaced worker drops all of that state and its job pool with it.
+Workers are forked from a master that has already imported the app, and
+with PRELOAD_EFFECTS/PRELOAD_MODELS the effects and their models too, so
+they share those pages copy-on-write. Without gunicorn (e.g. on Windows)
+the app is served by waitress if it is installed, else by Werkzeug's
+threaded development server.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+# More than one only for stateless endpoints or behind sticky sessions, see above
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 0)) or max(4, 2 * multiprocessing.cpu_count())
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+keepalive = 5
+# Replace each worker after this many requests (with jitter), in case native
+# libraries leak (0: never). Off by default, as a replaced worker loses its state.
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# Threads each worker lets OpenCV use (default: its share of the cores)
+cv_threads = int(os.environ.get('CV_THREADS', 0)) or max(1, multiprocessing.cpu_count() // workers)
+
+SETTINGS = ('bind', 'workers', 'worker_class', 'threads', 'preload_app', 'timeout', 'keepalive',
+            'max_requests', 'max_requests_jitter', 'when_ready', 'post_fork')
+
+
+def when_ready(server):
+    # The app is loaded and no worker forked yet: keep the garbage collector
+    # off everything loaded so far, so it does not copy those pages per worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Every worker's OpenCV pool would otherwise use every core
+    import cv2
+    cv2.setNumThreads(cv_threads)
+
+
+def main():
+    from run import app
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        class Server(BaseApplication):
+            def load_config(self):
+                for name in SETTINGS:
+                    self.cfg.set(name, globals()[name])
+
+            def load(self):
+                return app
+
+        Server().run()
+        return
+
+    host, _, port = bind.rpartition(':')
+    try:
+        import waitress
+    except ImportError:
+        print("[Warning] gunicorn and waitress are not installed; using Werkzeug's development server")
+        from werkzeug.serving import run_simple
+        run_simple(host, int(port), app, threaded=True)
+        return
+    waitress.serve(app, host=host, port=int(port), threads=workers * threads)
+
+
+if __name__ == "__main__":
+    main()
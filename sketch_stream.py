@@ -0,0 +1,344 @@
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from image_io import MAX_IMAGE_PIXELS, ImageTooLarge
+from img2Sketch import PencilSketch
+
+# Sentinel passed down the pipeline when the source runs dry or is stopped
+_END = object()
+
+
+class TestPatternSource:
+    """Synthetic moving frames, for running the pipeline without a camera"""
+
+    def __init__(self, width=1280, height=720, fps=30.0, frames=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames = frames
+        self._index = 0
+        # (x + y) % 256, built in uint8 (which wraps at 256) so no wider full-frame array is made
+        rows = (np.arange(height) % 256).astype(np.uint8)
+        cols = (np.arange(width) % 256).astype(np.uint8)
+        self._base = rows[:, None] + cols
+
+    def read(self):
+        if self.frames is not None and self._index >= self.frames:
+            return False, None
+        shift = (self._index * 4) % 256
+        frame = cv2.merge((self._base + shift, np.roll(self._base, shift, axis=1), 255 - self._base))
+        cv2.circle(frame, ((self._index * 8) % self.width, self.height // 2), self.height // 6,
+                   (255, 255, 255), -1)
+        self._index += 1
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0
+
+    def release(self):
+        pass
+
+
+def open_source(source, frames=None):
+    """Open a video source.
+
+    ``source`` is ``"test"`` or ``"test:WIDTHxHEIGHT"`` for a test pattern,
+    a device index such as ``"0"``, ``"v4l2:/dev/video0"`` for a V4L2 device,
+    or a path to a video file. Raises ValueError for a malformed test
+    pattern size and ImageTooLarge for one over MAX_IMAGE_PIXELS.
+    """
+    if source == 'test' or source.startswith('test:'):
+        width, height = 1280, 720
+        if ':' in source:
+            width, height = (int(v) for v in source.split(':', 1)[1].lower().split('x'))
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid test pattern size '{source}'")
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(f"Test patterns are limited to {MAX_IMAGE_PIXELS / 1e6:g} megapixels")
+        return TestPatternSource(width, height, frames=frames)
+    if source.isdigit():
+        capture = cv2.VideoCapture(int(source))
+    elif source.startswith('v4l2:'):
+        capture = cv2.VideoCapture(source[len('v4l2:'):], cv2.CAP_V4L2)
+    else:
+        capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source '{source}'")
+    return capture
+
+
+def is_live(source):
+    """Cameras and test patterns run in real time; files can be read at any pace"""
+    return source.isdigit() or source.startswith(('test', 'v4l2:'))
+
+
+class DropQueue:
+    """A bounded queue that drops the oldest item instead of blocking the producer"""
+
+    def __init__(self, maxsize, drop=True):
+        self._queue = queue.Queue(maxsize)
+        self.drop = drop
+        self.dropped = 0
+
+    def put(self, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                # The end marker always gets through, even on a blocking queue
+                if not self.drop and item is not _END:
+                    continue
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                return self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+
+class StageStats:
+    """Frame count and latency for one pipeline stage"""
+
+    def __init__(self):
+        self.frames = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.frames += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            mean = self.total / self.frames if self.frames else 0.0
+            return {'frames': self.frames, 'mean_ms': round(mean * 1000, 2),
+                    'max_ms': round(self.max * 1000, 2)}
+
+
+class VideoFileSink:
+    """Encode sketched frames into a video file"""
+
+    def __init__(self, path, fps=30.0, fourcc='MJPG'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self._writer = None
+
+    def write(self, frame):
+        if self._writer is None:
+            height, width = frame.shape[:2]
+            self._writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (width, height), frame.ndim == 3)
+            if not self._writer.isOpened():
+                raise RuntimeError(f"Could not open video writer for '{self.path}'")
+        self._writer.write(frame)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+
+
+class MjpegSink:
+    """Encode sketched frames as JPEG for a multipart/x-mixed-replace response.
+
+    Only the newest ``maxsize`` frames are kept; a slow client skips frames.
+    """
+
+    def __init__(self, quality=80, maxsize=2):
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self._frames = DropQueue(maxsize)
+        self._done = threading.Event()
+
+    def write(self, frame):
+        success, buffer = cv2.imencode('.jpg', frame, self.params)
+        if success:
+            self._frames.put(buffer.tobytes(), self._done)
+
+    def close(self):
+        self._frames.put(_END, threading.Event())
+        self._done.set()
+
+    def chunks(self, stop_event):
+        """Yield multipart chunks until the stream ends"""
+        while True:
+            jpeg = self._frames.get(stop_event)
+            if jpeg is _END:
+                return
+            yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                   + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+
+
+class SketchStream:
+    """Pipelined capture -> sketch -> encode over bounded queues.
+
+    Each stage runs on its own thread; OpenCV releases the GIL so the stages
+    overlap. When a downstream stage falls behind, the queues drop the oldest
+    frames (for live sources) rather than growing without bound.
+    """
+
+    def __init__(self, source, sink, sketcher=None, queue_size=2, drop=True, max_frames=None):
+        self.source = source
+        self.sink = sink
+        self.sketcher = sketcher or PencilSketch()
+        self.max_frames = max_frames
+        self._sketch_queue = DropQueue(queue_size, drop)
+        self._encode_queue = DropQueue(queue_size, drop)
+        self._stop = threading.Event()
+        self._threads = []
+        self.stages = {'capture': StageStats(), 'sketch': StageStats(), 'encode': StageStats()}
+        # Capture-to-encoded time, including time spent waiting in the queues
+        self.latency = StageStats()
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def _capture(self):
+        try:
+            while not self._stop.is_set():
+                if self.max_frames is not None and self.stages['capture'].frames >= self.max_frames:
+                    break
+                start = time.perf_counter()
+                ok, frame = self.source.read()
+                if not ok:
+                    break
+                self.stages['capture'].add(time.perf_counter() - start)
+                self._sketch_queue.put((time.perf_counter(), frame), self._stop)
+        except Exception as e:
+            self.error = e
+            # The other stages may be blocked on a full queue waiting for this one
+            self._stop.set()
+        finally:
+            self._sketch_queue.put(_END, self._stop)
+
+    def _sketch(self):
+        try:
+            while True:
+                item = self._sketch_queue.get(self._stop)
+                if item is _END:
+                    break
+                captured, frame = item
+                start = time.perf_counter()
+                sketch = self.sketcher(frame)
+                self.stages['sketch'].add(time.perf_counter() - start)
+                self._encode_queue.put((captured, sketch), self._stop)
+        except Exception as e:
+            self.error = e
+            # The other stages may be blocked on a full queue waiting for this one
+            self._stop.set()
+        finally:
+            self._encode_queue.put(_END, self._stop)
+
+    def _encode(self):
+        try:
+            while True:
+                item = self._encode_queue.get(self._stop)
+                if item is _END:
+                    break
+                captured, sketch = item
+                start = time.perf_counter()
+                self.sink.write(sketch)
+                end = time.perf_counter()
+                self.stages['encode'].add(end - start)
+                self.latency.add(end - captured)
+        except Exception as e:
+            self.error = e
+            self._stop.set()
+        finally:
+            self.sink.close()
+            self.finished = time.perf_counter()
+
+    def start(self):
+        self.started = time.perf_counter()
+        for name, target in (('capture', self._capture), ('sketch', self._sketch), ('encode', self._encode)):
+            thread = threading.Thread(target=target, name=f'sketch-stream-{name}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+        self.source.release()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        end = self.finished or time.perf_counter()
+        elapsed = end - self.started if self.started else 0.0
+        delivered = self.stages['encode'].frames
+        return {
+            'fps': round(delivered / elapsed, 2) if elapsed else 0.0,
+            'elapsed_s': round(elapsed, 3),
+            'frames_out': delivered,
+            'dropped': self._sketch_queue.dropped + self._encode_queue.dropped,
+            'stages': {name: stage.snapshot() for name, stage in self.stages.items()},
+            'end_to_end': self.latency.snapshot(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pencil-sketch a video file, camera or test pattern.")
+    parser.add_argument("source", help="Video file, device index (0), v4l2:/dev/videoN, or test[:WxH]")
+    parser.add_argument("output", help="Output video file (e.g. sketch.avi)")
+    parser.add_argument("--frames", type=int, default=None, help="Stop after this many frames.")
+    parser.add_argument("--blur_sigma", type=int, default=5, help="Sigma value for Gaussian blur.")
+    parser.add_argument("--sharpen_value", type=int, default=None, help="Sharpening strength (optional).")
+    parser.add_argument("--queue_size", type=int, default=2, help="Frames buffered between stages.")
+    parser.add_argument("--fourcc", default="MJPG", help="Output codec (default MJPG).")
+    args = parser.parse_args()
+
+    source = open_source(args.source, frames=args.frames)
+    fps = source.get(cv2.CAP_PROP_FPS) or 30.0
+    stream = SketchStream(
+        source,
+        VideoFileSink(args.output, fps=fps, fourcc=args.fourcc),
+        PencilSketch(blur_sigma=args.blur_sigma, sharpen_value=args.sharpen_value),
+        queue_size=args.queue_size,
+        drop=is_live(args.source),
+        max_frames=args.frames,
+    ).start()
+
+    try:
+        while stream.running:
+            time.sleep(1.0)
+            stats = stream.stats()
+            print(f"\r{stats['frames_out']} frames, {stats['fps']:.1f} fps, {stats['dropped']} dropped", end="")
+    except KeyboardInterrupt:
+        stream.stop()
+    stream.join()
+
+    stats = stream.stats()
+    print(f"\n[Success] {stats['frames_out']} frames written to {args.output} "
+          f"at {stats['fps']:.1f} fps ({stats['dropped']} dropped)")
+    for name, stage in stats['stages'].items():
+        print(f"  {name:<8} mean {stage['mean_ms']:.2f} ms  max {stage['max_ms']:.2f} ms")
+    latency = stats['end_to_end']
+    print(f"  {'total':<8} mean {latency['mean_ms']:.2f} ms  max {latency['max_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
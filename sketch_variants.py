@@ -0,0 +1,209 @@
+import io
+import math
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from image_io import encode_image
+from img2Sketch import SketchIntermediates
+from metrics import timed
+
+# Intermediates kept for editing sessions, and how long an idle session keeps them
+SESSION_CACHE_BYTES = int(os.environ.get('SKETCH_SESSION_MB', 256)) * 1024 * 1024
+SESSION_TTL = float(os.environ.get('SKETCH_SESSION_TTL', 600))
+# Blur levels (and as many sketches) each session keeps, most recently used first
+SESSION_LEVELS = int(os.environ.get('SKETCH_SESSION_LEVELS', 4))
+# Variants per request, and the long side of each contact sheet cell
+MAX_VARIANTS = int(os.environ.get('SKETCH_MAX_VARIANTS', 16))
+THUMB_SIDE = 480
+LABEL_HEIGHT = 28
+PADDING = 8
+
+
+class SessionCache:
+    """Sketch intermediates of the image each editing session works on.
+
+    A session keeps one image, and only its ``levels`` most recently used
+    blur levels and sketches: uploading a different image replaces it.
+    Sessions idle for longer than ``ttl`` are dropped. The total is checked
+    after every lookup and render, and when it is over ``max_bytes`` the
+    least recently used sessions give up their levels, then their image.
+    """
+
+    def __init__(self, max_bytes=SESSION_CACHE_BYTES, ttl=SESSION_TTL, levels=SESSION_LEVELS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.levels = levels
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, image_key, load):
+        """Intermediates of ``image_key`` for ``session``; ``load()`` returns the decoded frame on a miss"""
+        with self._lock:
+            entry = self._sessions.get(session)
+            if entry is not None and entry[0] == image_key:
+                self._sessions.move_to_end(session)
+                self._sessions[session] = (image_key, entry[1], time.monotonic())
+                self.hits += 1
+                self._evict()
+                return entry[1]
+            self.misses += 1
+        intermediates = SketchIntermediates(load(), max_levels=self.levels)
+        with self._lock:
+            self._sessions.pop(session, None)
+            self._sessions[session] = (image_key, intermediates, time.monotonic())
+            self._evict()
+        return intermediates
+
+    def render(self, session, image_key, load, render):
+        """``render(intermediates)`` for the session (see get), checking the
+        total again afterwards, as rendering adds levels"""
+        try:
+            return render(self.get(session, image_key, load))
+        finally:
+            with self._lock:
+                self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        for session in [s for s, (_, _, used) in self._sessions.items() if now - used > self.ttl]:
+            del self._sessions[session]
+        # Sizes grow as variants are rendered, so they are summed now rather than tracked
+        total = sum(entry[1].nbytes for entry in self._sessions.values())
+        for session, (_, intermediates, _) in list(self._sessions.items()):
+            if total <= self.max_bytes:
+                break
+            nbytes = intermediates.nbytes
+            kept = intermediates.shrink(nbytes - (total - self.max_bytes))
+            if kept > nbytes - (total - self.max_bytes):
+                # Its image alone is over the share left for it
+                del self._sessions[session]
+                kept = 0
+            total -= nbytes - kept
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            return {
+                'sessions': len(self._sessions),
+                'bytes': sum(entry[1].nbytes for entry in self._sessions.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Process-wide, shared by every request
+sessions = SessionCache()
+
+
+def parse_variants(variants=None, blur_sigmas=None, sharpen_values=None):
+    """(blur_sigma, sharpen_value) pairs from ``"10:7,5:25"``, or every combination
+    of ``"2,5,10"`` and ``"none,5,25"``; returns (pairs, grid columns)"""
+
+    def number(value, cast):
+        value = value.strip()
+        return None if value.lower() in ('', 'none') else cast(value)
+
+    if variants:
+        pairs = []
+        for item in variants.split(','):
+            sigma, _, sharpen = item.partition(':')
+            pairs.append((number(sigma, float), number(sharpen, int)))
+        columns = math.ceil(math.sqrt(len(pairs)))
+    else:
+        sigmas = [number(v, float) for v in (blur_sigmas or '5').split(',')]
+        sharpens = [number(v, int) for v in (sharpen_values or 'none').split(',')]
+        pairs = [(sigma, sharpen) for sigma in sigmas for sharpen in sharpens]
+        columns = len(sharpens)
+    if any(sigma is None or sigma <= 0 for sigma, _ in pairs):
+        raise ValueError("Blur sigmas must be positive numbers")
+    if not 0 < len(pairs) <= MAX_VARIANTS:
+        raise ValueError(f"Between 1 and {MAX_VARIANTS} variants can be rendered at once")
+    # Whole sigmas as ints, so 5 and 5.0 share intermediates
+    pairs = [(int(sigma) if float(sigma).is_integer() else sigma, sharpen) for sigma, sharpen in pairs]
+    return pairs, columns
+
+
+def render_variants(intermediates, pairs, finish=None, incremental=True, workers=None):
+    """Render every (blur_sigma, sharpen_value) pair; returns ``finish(sketch)``
+    of each single-channel sketch, in order.
+
+    The blur levels are built one after another on this thread (with
+    ``incremental``, each from the next smaller sigma); as soon as a level
+    is ready its dodge, sharpen and ``finish`` steps run on a thread pool.
+    """
+    finish = finish or (lambda sketch: sketch)
+    sigmas = sorted({sigma for sigma, _ in pairs})
+    chains = {sigma: tuple(sigmas[:i + 1]) if incremental else (sigma,) for i, sigma in enumerate(sigmas)}
+    workers = workers or os.cpu_count() or 1
+    with timed('sketch', 'variants', intermediates.gray), \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sketch-variant') as pool:
+        futures = {}
+        for sigma in sigmas:
+            # Handed to the sketches, which may run after a bounded cache has dropped it
+            level = intermediates.blurred(chains[sigma])
+            for pair in pairs:
+                if pair[0] == sigma and pair not in futures:
+                    futures[pair] = pool.submit(
+                        lambda chain, sharpen, level: finish(intermediates.sketch(chain, sharpen, level)),
+                        chains[sigma], pair[1], level)
+        return [futures[pair].result() for pair in pairs]
+
+
+def label(pair):
+    sigma, sharpen = pair
+    return f"blur {sigma}, sharpen {'none' if sharpen is None else sharpen}"
+
+
+def thumbnail(sketch, side=THUMB_SIDE):
+    scale = min(1.0, side / max(sketch.shape[:2]))
+    if scale < 1.0:
+        size = (max(1, round(sketch.shape[1] * scale)), max(1, round(sketch.shape[0] * scale)))
+        sketch = cv2.resize(sketch, size, interpolation=cv2.INTER_AREA)
+    return sketch
+
+
+def contact_sheet(thumbnails, labels, columns):
+    """Lay labelled single-channel thumbnails out on a white grid (BGR)"""
+    cell_h = max(t.shape[0] for t in thumbnails) + LABEL_HEIGHT
+    cell_w = max(t.shape[1] for t in thumbnails)
+    rows = math.ceil(len(thumbnails) / columns)
+    sheet = np.full((rows * (cell_h + PADDING) + PADDING, columns * (cell_w + PADDING) + PADDING), 255, np.uint8)
+    for index, (thumb, text) in enumerate(zip(thumbnails, labels)):
+        y = PADDING + (index // columns) * (cell_h + PADDING)
+        x = PADDING + (index % columns) * (cell_w + PADDING)
+        sheet[y:y + thumb.shape[0], x:x + thumb.shape[1]] = thumb
+        cv2.putText(sheet, text, (x + 4, y + cell_h - 9), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 0, 1, cv2.LINE_AA)
+    return cv2.cvtColor(sheet, cv2.COLOR_GRAY2BGR)
+
+
+def render_sheet(intermediates, pairs, columns, output='.png', quality=None, side=THUMB_SIDE, incremental=True):
+    """Encoded contact sheet of the variants"""
+    thumbnails = render_variants(intermediates, pairs, lambda sketch: thumbnail(sketch, side), incremental)
+    return encode_image(contact_sheet(thumbnails, [label(pair) for pair in pairs], columns), output, quality)
+
+
+def render_zip(intermediates, pairs, incremental=True):
+    """Zip of full-size PNG variants, named after their settings"""
+    encoded = render_variants(intermediates, pairs,
+                              lambda sketch: encode_image(cv2.cvtColor(sketch, cv2.COLOR_GRAY2BGR), '.png'),
+                              incremental)
+    output = io.BytesIO()
+    # PNG is compressed already
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        names = set()
+        for (sigma, sharpen), data in zip(pairs, encoded):
+            name = f"sketch_blur{sigma}_sharpen{'none' if sharpen is None else sharpen}.png"
+            if name not in names:
+                names.add(name)
+                archive.writestr(name, data)
+    return output.getvalue()
@@ -3,6 +3,8 @@
 let sketchHistoryStack = [];
 let effectHistoryStack = [];
 let originalImageUrl = "";
+// Lets the server keep this page's sketch intermediates between slider changes
+const sketchSession = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Math.random().toString(36).slice(2);
 let activeCustomEffect = null;
 let cropper = null;
 
@@ -115,6 +117,12 @@ choose_img_Btn.addEventListener("click", () => choose_Input.click());
         undoBtn.addEventListener('click', undoSketch);
     }
 
+    // Contact sheet of every sketch variation
+    const compareBtn = document.getElementById('compare-sketch-btn');
+    if (compareBtn) {
+        compareBtn.addEventListener('click', compareSketchVariations);
+    }
+
     // Undo AI effect button
     const undoAiBtn = document.getElementById('undo-ai-btn');
     console.log('Undo AI button found:', undoAiBtn);
@@ -383,6 +391,33 @@ function handleSketchVariation() {
     applyPencilSketch(blurSigma, sharpenValue);
 }
 
+// Render every variation button's settings in one request, as a contact sheet
+function compareSketchVariations() {
+    const img = document.querySelector('#mainImage');
+    if (!img || !img.src || img.src.includes('data:,')) {
+        showToast('Please upload an image first.', 'warning');
+        return;
+    }
+    const variants = Array.from(document.querySelectorAll('.sketch-variation-btn'))
+        .map(btn => `${btn.getAttribute('data-blur')}:${btn.getAttribute('data-sharpen')}`);
+
+    document.querySelectorAll('.sketch-variation-btn.active').forEach(b => b.classList.remove('active'));
+    const source = (typeof originalImageUrl === 'string' && originalImageUrl.length > 0) ? originalImageUrl : img.src;
+    sketchHistoryStack.push(img.src);
+    showSpinner();
+
+    const blobPromise = source.startsWith('data:')
+        ? Promise.resolve(dataURLtoBlob(source))
+        : fetch(source).then(res => res.blob());
+    blobPromise.then(blob => {
+        const formData = new FormData();
+        formData.append('image', blob, 'image.png');
+        formData.append('variants', variants.join(','));
+        formData.append('session', sketchSession);
+        makeApiCall('/pencil_sketch/variants', formData, 'Pick a variation to apply it');
+    });
+}
+
 function undoSketch() {
     console.log('Undo sketch called, history stack length:', sketchHistoryStack.length);
     const img = document.querySelector('#mainImage');
@@ -468,6 +503,9 @@ function applyCustomEffect(effect) {
         case "sketch":
             pencilSketchImage();
             break;
+        case "cartoon":
+            cartoonImage();
+            break;
         case "background_removal":
             removeBackground();
             break;
@@ -758,6 +796,92 @@ function makeApiCall(endpoint, formData, successMessage) {
     });
 }
 
+// Effects show a screen-sized preview first; the full-size render replaces it when ready
+let renderGeneration = 0;
+
+function showResultBlob(blob) {
+    imgSrc.src = URL.createObjectURL(blob);
+
+    // Ensure overlay stays hidden when AI effects are applied
+    const overlay = document.querySelector('.image-overlay');
+    if (overlay) overlay.style.display = 'none';
+}
+
+function waitForFullRender(eventsUrl) {
+    if (!eventsUrl) return Promise.resolve();
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(eventsUrl);
+        source.onmessage = event => {
+            const job = JSON.parse(event.data);
+            if (job.status === 'done') {
+                source.close();
+                resolve();
+            } else if (['failed', 'cancelled', 'timeout'].includes(job.status)) {
+                source.close();
+                reject(new Error(job.error || `Full-size render ${job.status}`));
+            }
+        };
+        source.onerror = () => {
+            source.close();
+            reject(new Error('Lost connection to the full-size render'));
+        };
+    });
+}
+
+function makeProgressiveCall(stages, blob, endpoint, formData, successMessage) {
+    // Falls back to the effect's own endpoint if the preview cannot be made
+    const generation = ++renderGeneration;
+    const previewData = new FormData();
+    previewData.append('image', blob, 'image.png');
+    previewData.append('stages', stages);
+    const screenSide = Math.max(window.screen.width, window.screen.height) * (window.devicePixelRatio || 1);
+    previewData.append('max_side', Math.ceil(screenSide));
+
+    return fetch('/preview', {
+        method: 'POST',
+        body: previewData
+    })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+        }
+        const fullUrl = response.headers.get('X-Full-Url');
+        const eventsUrl = response.headers.get('X-Full-Events');
+        return response.blob().then(previewBlob => {
+            if (generation !== renderGeneration) return;
+            showResultBlob(previewBlob);
+            hideSpinner();
+            if (!fullUrl) {
+                // The full-size render could not be queued; render it directly
+                return makeApiCall(endpoint, formData, successMessage);
+            }
+            showToast('Preview ready, rendering full size...', 'info');
+            return waitForFullRender(eventsUrl)
+                .then(() => fetch(fullUrl))
+                .then(fullResponse => {
+                    if (!fullResponse.ok) {
+                        throw new Error(`HTTP ${fullResponse.status}: ${fullResponse.statusText}`);
+                    }
+                    return fullResponse.blob();
+                })
+                .then(fullBlob => {
+                    if (generation !== renderGeneration) return;
+                    showResultBlob(fullBlob);
+                    showToast(successMessage, 'success');
+                })
+                .catch(err => {
+                    showToast(`Full-size render failed: ${err.message}`, 'error');
+                    console.error('Full render error:', err);
+                });
+        });
+    }, err => {
+        console.warn('Preview failed, rendering directly:', err);
+        if (generation === renderGeneration) {
+            return makeApiCall(endpoint, formData, successMessage);
+        }
+    });
+}
+
 // API functions
 function removeBackground() {
     const imgElement = document.querySelector('#mainImage');
@@ -776,7 +900,7 @@ function removeBackground() {
     blobPromise.then(blob => {
         const formData = new FormData();
         formData.append('image', blob, 'image.png');
-        makeApiCall('/remove-bg', formData, 'Background removed successfully!');
+        makeProgressiveCall('background_removal', blob, '/remove-bg', formData, 'Background removed successfully!');
     });
 }
 
@@ -815,10 +939,13 @@ function colorizeImage() {
         blobPromise = fetch(imgElement.src).then(res => res.blob());
     }
     
+    const qualitySelect = document.getElementById('colorization-quality');
     blobPromise.then(blob => {
         const formData = new FormData();
         formData.append('image', blob, 'image.png');
-        makeApiCall('/colorize', formData, 'Image colorized successfully!');
+        const quality = qualitySelect ? qualitySelect.value : 'full';
+        formData.append('quality', quality);
+        makeProgressiveCall(`colorization:quality=${quality}`, blob, '/colorize', formData, 'Image colorized successfully!');
     });
 }
 
@@ -839,7 +966,31 @@ function oilPaintImage() {
     blobPromise.then(blob => {
         const formData = new FormData();
         formData.append('image', blob, 'image.jpg');
-        makeApiCall('/oil_paint', formData, 'Oil painting effect applied!');
+        makeProgressiveCall('oil_painting', blob, '/oil_paint', formData, 'Oil painting effect applied!');
+    });
+}
+
+function cartoonImage() {
+    const imgElement = document.querySelector('#mainImage');
+    if (!imgElement || !imgElement.src) {
+        showToast('No image found!', 'error');
+        return;
+    }
+
+    let blobPromise;
+    if (imgElement.src.startsWith('data:')) {
+        blobPromise = Promise.resolve(dataURLtoBlob(imgElement.src));
+    } else {
+        blobPromise = fetch(imgElement.src).then(res => res.blob());
+    }
+
+    const qualitySelect = document.getElementById('cartoon-quality');
+    blobPromise.then(blob => {
+        const formData = new FormData();
+        formData.append('image', blob, 'image.png');
+        const quality = qualitySelect ? qualitySelect.value : 'full';
+        formData.append('quality', quality);
+        makeProgressiveCall(`cartoon:quality=${quality}`, blob, '/cartoon', formData, 'Cartoon effect applied!');
     });
 }
 
@@ -860,7 +1011,7 @@ function pencilSketchImage() {
     blobPromise.then(blob => {
         const formData = new FormData();
         formData.append('image', blob, 'image.png');
-        makeApiCall('/pencil_sketch', formData, 'Pencil sketch created!');
+        makeProgressiveCall('sketch', blob, '/pencil_sketch', formData, 'Pencil sketch created!');
     });
 }
 
@@ -885,6 +1036,7 @@ if (typeof applyPencilSketch !== 'function') {
             formData.append('image', blob, 'image.png');
             formData.append('blurSigma', blurSigma);
             formData.append('sharpenValue', sharpenValue);
+            formData.append('session', sketchSession);
             makeApiCall('/pencil_sketch', formData, 'Sketch variation applied!');
         });
     }
@@ -0,0 +1,74 @@
+import os
+import threading
+
+# Before the import: the pipeline kind and cache location are read at import time
+os.environ['GHIBLI_PIPELINE'] = 'stub'
+os.environ.pop('GHIBLI_CACHE_DIR', None)
+
+import pytest
+
+import ghibli_cartoon
+from ghibli_cartoon import GhibliBatcher, StubPipeline, generate, generate_ghibli_image
+from model_registry import registry
+
+
+@pytest.fixture
+def pipe():
+    with registry.acquire('ghibli') as pipe:
+        pass
+    assert isinstance(pipe, StubPipeline)
+    return pipe
+
+
+def test_same_settings_share_one_call(pipe):
+    batcher = GhibliBatcher(batch_size=4, max_wait_ms=500)
+    calls = pipe.calls
+    futures = []
+    start = threading.Barrier(4)
+
+    def submit(prompt, steps):
+        start.wait()
+        futures.append(batcher.submit(prompt, 1, steps=steps, size=(64, 64)))
+
+    threads = [threading.Thread(target=submit, args=args)
+               for args in [('a fox', 4), ('a cat', 4), ('a tree', 4), ('a river', 8)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results = [future.result(timeout=10) for future in futures]
+
+    # One call for the three 4-step prompts, one for the 8-step prompt
+    assert pipe.calls - calls == 2
+    assert batcher.stats()['images'] == 4
+    assert all(data.startswith(b'\x89PNG') for data in results)
+
+
+def test_repeated_request_is_a_cache_hit(pipe):
+    first, info = generate('a castle in the sky', seed=7, steps=2, size=(64, 64))
+    calls = pipe.calls
+    again, again_info = generate('a castle in the sky', seed=7, steps=2, size=(64, 64))
+    assert not info['cached'] and again_info['cached']
+    assert again == first
+    assert pipe.calls == calls
+    other, other_info = generate('a castle in the sky', seed=8, steps=2, size=(64, 64))
+    assert not other_info['cached'] and other != first
+
+
+def test_one_file_per_request(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    paths = [generate_ghibli_image(prompt, seed=3, steps=2, size=(64, 64))
+             for prompt in ('a bakery', 'a train', 'a bakery')]
+    assert paths[0] == paths[2] and paths[0] != paths[1]
+    assert sorted(os.listdir(tmp_path / 'static' / 'generated')) == sorted({os.path.basename(p) for p in paths})
+
+
+def test_rejects_sizes_the_pipeline_cannot_make():
+    with pytest.raises(ValueError):
+        generate('a boat', seed=1, size=(100, 64))
+    with pytest.raises(ValueError):
+        generate('a boat', seed=1, size=(16384, 16384))
+    for steps in (0, 100000):
+        with pytest.raises(ValueError):
+            generate('a boat', seed=1, steps=steps, size=(64, 64))
+    assert ghibli_cartoon.PIPELINE == 'stub'